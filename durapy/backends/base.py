@@ -3,7 +3,7 @@ from typing import Optional, List
 
 from typing_extensions import Type
 
-from durapy.command.model import BaseCommand, PersistedCommand
+from durapy.command.model import BaseCommand, PersistedCommand, ScheduledCommand
 
 
 class CommandDatabase(abc.ABC):
@@ -15,7 +15,15 @@ class CommandDatabase(abc.ABC):
     """
 
     @abc.abstractmethod
-    def send_command(self, command: BaseCommand) -> PersistedCommand:
+    def send_command(
+            self,
+            command: BaseCommand,
+            correlation_id: Optional[str] = None,
+            parent_key: Optional[str] = None) -> PersistedCommand:
+        """
+        Persists a command, returning it along with its assigned key and timestamp. If given, the correlation ID and
+        parent key are stored alongside the command and returned on the PersistedCommand when it is fetched.
+        """
         ...
 
     @abc.abstractmethod
@@ -34,6 +42,74 @@ class CommandDatabase(abc.ABC):
     def fetch_by_key(self, key: str) -> Optional[PersistedCommand]:
         ...
 
+    def fetch_next_batch(self, timeout_ms: int, max_num: int) -> List[PersistedCommand]:
+        """
+        Fetches up to `max_num` of the next commands, blocking up to `timeout_ms` only if none are available. Backends
+        should override this if they can fetch several commands in a single round trip.
+        """
+        command = self.fetch_next(timeout_ms)
+        return [command] if command is not None else []
+
+    def fetch_priority(self, max_num: int) -> List[PersistedCommand]:
+        """
+        Fetches up to `max_num` HIGH priority commands that have not yet been fetched, without blocking. Commands
+        returned here are not returned again by #fetch_next / #fetch_next_batch. Backends without a priority lane
+        return nothing, in which case HIGH priority commands are simply fetched in order.
+        """
+        return []
+
+    def wakeup(self):
+        """
+        Causes a #fetch_next / #fetch_next_batch that is currently blocked (or the next one, if none is blocked) to
+        return immediately, possibly with no commands. Safe to call from any thread, but not from a signal handler, as
+        it may take locks (e.g. a connection pool's) that the interrupted code holds. Backends that cannot interrupt a
+        blocked fetch do nothing, in which case the fetch returns after its timeout.
+        """
+        pass
+
+    def close(self):
+        """
+        Releases any resources held by this command database.
+        """
+        pass
+
+    def supports_shared_schedule(self) -> bool:
+        """
+        Whether this command database keeps a shared schedule, i.e. implements #add_scheduled. Backends that do should
+        override this to return True.
+        """
+        return False
+
+    def add_scheduled(self, command: BaseCommand, at_ms: int) -> ScheduledCommand:
+        """
+        Adds a command to the shared schedule of commands due to be sent at a later time. Scheduled commands are not
+        sent by the command database itself; a process claims them via #claim_scheduled once they are due and sends
+        them. Only supported if #supports_shared_schedule.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support a shared schedule.')
+
+    def claim_scheduled(self, schedule_id: str) -> Optional[ScheduledCommand]:
+        """
+        Atomically removes a command from the shared schedule, returning it, or None if it was already claimed (or
+        never existed). Exactly one caller claims any given scheduled command. Backends without a shared schedule
+        return None.
+        """
+        return None
+
+    def fetch_scheduled(self, num: int, due_before_ms: Optional[int] = None) -> List[ScheduledCommand]:
+        """
+        Returns up to `num` commands in the shared schedule in order of when they are due, optionally only those due
+        before `due_before_ms`. Backends without a shared schedule return nothing.
+        """
+        return []
+
+    def backlog_size(self) -> Optional[int]:
+        """
+        Returns the number of commands that have been persisted but not yet fetched via #fetch_next /
+        #fetch_next_batch, i.e. how far behind the head of the stream this reader is, or None if unknown.
+        """
+        return None
+
 
 class CommandDatabaseFactory(abc.ABC):
     @abc.abstractmethod
@@ -1,3 +1,4 @@
+import threading
 import time
 import uuid
 from typing import Optional, List
@@ -6,7 +7,7 @@ from more_itertools import only
 from typing_extensions import Type
 
 from durapy.backends.base import CommandDatabase, CommandDatabaseFactory
-from durapy.command.model import BaseCommand, PersistedCommand
+from durapy.command.model import BaseCommand, PersistedCommand, CommandPriority, ScheduledCommand
 
 
 class InMemoryCommandDatabase(CommandDatabase):
@@ -19,13 +20,35 @@ class InMemoryCommandDatabase(CommandDatabase):
         self._commands = []
         self._commands_cur_idx = 0
 
-    def send_command(self, command: BaseCommand) -> PersistedCommand:
+        # Indices (into self._commands) of HIGH priority commands, and of those already fetched through this index.
+        self._priority_indices = []
+        self._priority_cur_idx = 0
+        self._fetched_via_priority = set()
+
+        # Notified whenever a command is sent or a blocked fetch should be woken up.
+        self._cond = threading.Condition()
+        self._woken = False
+
+        # Shared schedule of commands to be sent later, keyed by schedule ID.
+        self._scheduled = {}
+
+    def send_command(
+            self,
+            command: BaseCommand,
+            correlation_id: Optional[str] = None,
+            parent_key: Optional[str] = None) -> PersistedCommand:
         p = PersistedCommand(
             command=command,
             key=str(uuid.uuid4()),
             timestamp_ms=int(1e3 * time.time()),
+            correlation_id=correlation_id,
+            parent_key=parent_key,
         )
-        self._commands.append(p)
+        with self._cond:
+            self._commands.append(p)
+            if command.priority() == CommandPriority.HIGH:
+                self._priority_indices.append(len(self._commands) - 1)
+            self._cond.notify_all()
         return p
 
     def fetch_last(self, num: int, offset: int = 0, cursor=None) -> List[PersistedCommand]:
@@ -34,26 +57,75 @@ class InMemoryCommandDatabase(CommandDatabase):
         return self._commands[offset:offset + num][::-1]
 
     def fetch_from(self, num: int, offset: int = 0, cursor=None) -> List[PersistedCommand]:
-        # Being lazy
-        assert cursor is None
-        return self._commands[offset:offset + num]
+        start = 0
+        if cursor is not None:
+            # Commands strictly after the one with the given key, or none if there's no such command
+            start = 1 + next((i for i, c in enumerate(self._commands) if c.key == cursor), len(self._commands))
+        return self._commands[start + offset:start + offset + num]
 
     def fetch_next(self, timeout_ms: int) -> Optional[PersistedCommand]:
-        time_until = time.time() + timeout_ms / 1000
-        found_any = False
-        while time.time() < time_until:
-            if self._commands_cur_idx >= len(self._commands):
-                time.sleep(0.05)
-            else:
-                found_any = True
-                break
-
-        if not found_any:
-            return None
-        ret = self._commands[self._commands_cur_idx]
-        self._commands_cur_idx += 1
+        return only(self.fetch_next_batch(timeout_ms, max_num=1))
+
+    def fetch_next_batch(self, timeout_ms: int, max_num: int) -> List[PersistedCommand]:
+        time_until = time.monotonic() + timeout_ms / 1000
+        with self._cond:
+            while True:
+                ret = self.fetch_priority(max_num)
+                while len(ret) < max_num and self._commands_cur_idx < len(self._commands):
+                    idx = self._commands_cur_idx
+                    self._commands_cur_idx += 1
+                    if idx in self._fetched_via_priority:
+                        self._fetched_via_priority.remove(idx)
+                        continue
+                    ret.append(self._commands[idx])
+
+                remaining_s = time_until - time.monotonic()
+                if len(ret) > 0 or self._woken or remaining_s <= 0:
+                    self._woken = False
+                    return ret
+                self._cond.wait(remaining_s)
+
+    def fetch_priority(self, max_num: int) -> List[PersistedCommand]:
+        ret = []
+        with self._cond:
+            while len(ret) < max_num and self._priority_cur_idx < len(self._priority_indices):
+                idx = self._priority_indices[self._priority_cur_idx]
+                self._priority_cur_idx += 1
+                # Skip any that were already fetched in order
+                if idx < self._commands_cur_idx:
+                    continue
+                self._fetched_via_priority.add(idx)
+                ret.append(self._commands[idx])
         return ret
 
+    def wakeup(self):
+        with self._cond:
+            self._woken = True
+            self._cond.notify_all()
+
+    def backlog_size(self) -> Optional[int]:
+        return len(self._commands) - self._commands_cur_idx
+
+    def supports_shared_schedule(self) -> bool:
+        return True
+
+    def add_scheduled(self, command: BaseCommand, at_ms: int) -> ScheduledCommand:
+        scheduled = ScheduledCommand(schedule_id=str(uuid.uuid4()), command=command, at_ms=at_ms)
+        with self._cond:
+            self._scheduled[scheduled.schedule_id] = scheduled
+        return scheduled
+
+    def claim_scheduled(self, schedule_id: str) -> Optional[ScheduledCommand]:
+        with self._cond:
+            return self._scheduled.pop(schedule_id, None)
+
+    def fetch_scheduled(self, num: int, due_before_ms: Optional[int] = None) -> List[ScheduledCommand]:
+        with self._cond:
+            scheduled = sorted(self._scheduled.values(), key=lambda s: s.at_ms)
+        if due_before_ms is not None:
+            scheduled = [s for s in scheduled if s.at_ms < due_before_ms]
+        return scheduled[:num]
+
     def fetch_by_key(self, key: str) -> Optional[PersistedCommand]:
         return only([c for c in self._commands if c.key == key])
 
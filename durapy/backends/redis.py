@@ -1,12 +1,27 @@
 import json
 import logging
+import uuid
 from typing import Optional, Dict, Any, List, Union, Tuple, Type
 
 import redis  # type: ignore
 from more_itertools import only  # type: ignore
 
 from durapy.backends.base import CommandDatabase, CommandDatabaseFactory
-from durapy.command.model import BaseCommand, PersistedCommand
+from durapy.command._logging import CommandLogSampler
+from durapy.command.model import BaseCommand, PersistedCommand, CommandPriority, ScheduledCommand
+
+
+# How long a process's private control stream lives after its last wakeup.
+_CONTROL_STREAM_TTL_S = 24 * 60 * 60
+
+# Adds a HIGH priority command to the main stream (KEYS[1]) and indexes it in the priority stream (KEYS[2]), given the
+# command's fields as alternating names and values (ARGV). Done in a script rather than a MULTI/EXEC transaction, since
+# the priority entry holds the key that Redis generates for the main entry. Returns that key.
+_SEND_PRIORITY_SCRIPT = """
+local key = redis.call('XADD', KEYS[1], '*', unpack(ARGV))
+redis.call('XADD', KEYS[2], '*', 'key', key, unpack(ARGV))
+return key
+"""
 
 
 class RedisCommandDatabaseFactory(CommandDatabaseFactory):
@@ -32,6 +47,16 @@ class _RedisCommandDatabase(CommandDatabase):
     The key is auto-generated and contains the Redis timestamp in the form <redis timestamp ms>-<index> (see Redis docs
     for more detail). There is a single field set in this element, with field name 'command' and field value a
     JSON-encoded version of a BMI command.
+
+    HIGH priority commands are additionally indexed in a separate priority stream, whose entries hold the key of the
+    command in the main stream along with the same encoded command. Readers check the priority stream first and skip
+    those commands when they are later reached in the main stream.
+
+    Each instance also reads a private control stream alongside the command streams. Adding an entry to it (see
+    #wakeup) interrupts a blocked read immediately.
+
+    The shared schedule (see #add_scheduled) is a sorted set of schedule IDs scored by when they are due, alongside a
+    hash from schedule ID to the encoded command.
     """
     def __init__(
             self,
@@ -41,10 +66,17 @@ class _RedisCommandDatabase(CommandDatabase):
             redis_port: int,
             redis_password: Optional[str] = None):
         self._command_stream_name = f'{command_prefix}_commands'
+        self._priority_stream_name = f'{command_prefix}_commands_priority'
+        self._control_stream_name = f'{command_prefix}_control_{uuid.uuid4()}'
+        self._control_last_seen = '0-0'
+        self._scheduled_set_name = f'{command_prefix}_scheduled'
+        self._scheduled_commands_name = f'{command_prefix}_scheduled_commands'
         self._redis = redis.StrictRedis(host=redis_hostname,
                                         port=redis_port,
                                         password=redis_password)
         self._command_classes = command_classes
+        self._send_log_sampler = CommandLogSampler()
+        self._send_priority = self._redis.register_script(_SEND_PRIORITY_SCRIPT)
 
         # Initialize our internal cursor to the last entry in the stream
         last_command = self._redis.xrevrange(self._command_stream_name, count=1)
@@ -54,18 +86,48 @@ class _RedisCommandDatabase(CommandDatabase):
         else:
             self.last_seen = last_command[0][0]
 
-    def send_command(self, command: BaseCommand) -> PersistedCommand:
+        last_priority = self._redis.xrevrange(self._priority_stream_name, count=1)
+        self._priority_last_seen = last_priority[0][0] if len(last_priority) > 0 else '0-0'
+
+        # Keys of commands in the main stream after `last_seen` that were already returned via the priority stream.
+        self._fetched_via_priority = set()
+
+        # Number of entries in the stream up to and including `last_seen`. Commands are never trimmed from the stream,
+        # so the backlog is simply the stream length minus this.
+        self._num_seen = self._redis.xlen(self._command_stream_name)
+
+    def send_command(
+            self,
+            command: BaseCommand,
+            correlation_id: Optional[str] = None,
+            parent_key: Optional[str] = None) -> PersistedCommand:
         command_dict = self._command_to_dict(command)
-        logging.info("Sending command {}".format(command_dict))
+        n = self._send_log_sampler.sample(command.type())
+        if n is not None:
+            logging.info('Sending command (#%d of its type): %s', n, command_dict)
 
-        key = self._redis.xadd(self._command_stream_name, fields={
-            'command': json.dumps(command_dict)
-        })
+        fields = {
+            'command': json.dumps(command_dict),
+        }
+        if correlation_id is not None:
+            fields['correlation_id'] = correlation_id
+        if parent_key is not None:
+            fields['parent_key'] = parent_key
+        if command.priority() == CommandPriority.HIGH:
+            # Atomically and in a single round trip, so a HIGH priority command is never left out of the priority stream
+            key = self._send_priority(
+                keys=[self._command_stream_name, self._priority_stream_name],
+                args=[x for field in fields.items() for x in field])
+        else:
+            key = self._redis.xadd(self._command_stream_name, fields=fields)
         key = key.decode('ascii')
-        ret = self.fetch_by_key(key)
-        if ret is None:
-            raise ValueError(f'Could not find command even though it was just persisted? key={key}, command={command}')
-        return ret
+        # The key carries the server timestamp, so there's no need to read the command back.
+        return PersistedCommand(
+            command=command,
+            key=key,
+            timestamp_ms=_decode_key(key)[0],
+            correlation_id=correlation_id,
+            parent_key=parent_key)
 
     def fetch_last(self, num: int, offset: int = 0, cursor=None) -> List[PersistedCommand]:
         max_key = _decrement_key(cursor) if cursor is not None else '+'
@@ -79,19 +141,118 @@ class _RedisCommandDatabase(CommandDatabase):
         return [self._from_redis(key, entry) for key, entry in results[offset:]]
 
     def fetch_next(self, timeout_ms: int) -> Optional[PersistedCommand]:
+        return only(self.fetch_next_batch(timeout_ms, max_num=1))
+
+    def fetch_next_batch(self, timeout_ms: int, max_num: int) -> List[PersistedCommand]:
         results = self._redis.xread(
-            {self._command_stream_name: self.last_seen}, count=1,
+            {
+                self._control_stream_name: self._control_last_seen,
+                self._priority_stream_name: self._priority_last_seen,
+                self._command_stream_name: self.last_seen,
+            },
+            count=max_num,
             block=int(round(timeout_ms)))
-        if len(results) == 0:
+        entries_by_stream = _entries_by_stream(results)
+
+        # Entries in the control stream only exist to wake us up
+        control_entries = entries_by_stream.get(self._control_stream_name, [])
+        if len(control_entries) > 0:
+            self._control_last_seen = control_entries[-1][0]
+
+        # Priority commands go first
+        ret = self._from_priority_entries(entries_by_stream.get(self._priority_stream_name, []))
+
+        entries = entries_by_stream.get(self._command_stream_name, [])
+        if len(entries) > 0:
+            self.last_seen = entries[-1][0]
+            self._num_seen += len(entries)
+        for key, entry in entries:
+            decoded_key = key.decode('ascii') if isinstance(key, bytes) else key
+            if decoded_key in self._fetched_via_priority:
+                self._fetched_via_priority.remove(decoded_key)
+                continue
+            ret.append(self._from_redis(key, entry))
+        return ret
+
+    def fetch_priority(self, max_num: int) -> List[PersistedCommand]:
+        results = self._redis.xread({self._priority_stream_name: self._priority_last_seen}, count=max_num)
+        return self._from_priority_entries(_entries_by_stream(results).get(self._priority_stream_name, []))
+
+    def wakeup(self):
+        with self._redis.pipeline() as pipe:
+            pipe.xadd(self._control_stream_name, fields={'wakeup': '1'}, maxlen=1)
+            # Clean up after ourselves even if #close() is never called (e.g. the process is killed)
+            pipe.expire(self._control_stream_name, _CONTROL_STREAM_TTL_S)
+            pipe.execute()
+
+    def close(self):
+        self._redis.delete(self._control_stream_name)
+
+    def supports_shared_schedule(self) -> bool:
+        return True
+
+    def add_scheduled(self, command: BaseCommand, at_ms: int) -> ScheduledCommand:
+        schedule_id = str(uuid.uuid4())
+        with self._redis.pipeline() as pipe:
+            pipe.hset(self._scheduled_commands_name, schedule_id, json.dumps(self._command_to_dict(command)))
+            pipe.zadd(self._scheduled_set_name, {schedule_id: at_ms})
+            pipe.execute()
+        return ScheduledCommand(schedule_id=schedule_id, command=command, at_ms=at_ms)
+
+    def claim_scheduled(self, schedule_id: str) -> Optional[ScheduledCommand]:
+        with self._redis.pipeline() as pipe:
+            pipe.zscore(self._scheduled_set_name, schedule_id)
+            pipe.zrem(self._scheduled_set_name, schedule_id)
+            pipe.hget(self._scheduled_commands_name, schedule_id)
+            pipe.hdel(self._scheduled_commands_name, schedule_id)
+            at_ms, num_removed, encoded, _ = pipe.execute()
+        # Whoever removes it from the sorted set owns it
+        if num_removed == 0 or encoded is None:
             return None
+        return self._to_scheduled(schedule_id, encoded, at_ms)
 
-        result = only(results)
-        if len(result) != 2:
-            raise ValueError("Unexpected format; expected [stream_name, [list of results]], got {}".format(result))
+    def fetch_scheduled(self, num: int, due_before_ms: Optional[int] = None) -> List[ScheduledCommand]:
+        max_score = f'({due_before_ms}' if due_before_ms is not None else '+inf'
+        results = self._redis.zrangebyscore(
+            self._scheduled_set_name, '-inf', max_score, start=0, num=num, withscores=True)
+        if len(results) == 0:
+            return []
+        schedule_ids = [schedule_id for schedule_id, _ in results]
+        encoded_commands = self._redis.hmget(self._scheduled_commands_name, schedule_ids)
 
-        key, entry = only(result[1])
-        self.last_seen = key
-        return self._from_redis(key, entry)
+        ret = []
+        for (schedule_id, at_ms), encoded in zip(results, encoded_commands):
+            # Claimed in between the two calls
+            if encoded is None:
+                continue
+            ret.append(self._to_scheduled(schedule_id, encoded, at_ms))
+        return ret
+
+    def _to_scheduled(self, schedule_id: Union[str, bytes], encoded: bytes, at_ms: float) -> ScheduledCommand:
+        if isinstance(schedule_id, bytes):
+            schedule_id = schedule_id.decode('ascii')
+        command = self._command_from_dict(json.loads(encoded))
+        return ScheduledCommand(schedule_id=schedule_id, command=command, at_ms=int(at_ms))
+
+    def _from_priority_entries(self, entries) -> List[PersistedCommand]:
+        if len(entries) == 0:
+            return []
+        self._priority_last_seen = entries[-1][0]
+
+        ret = []
+        last_seen = _decode_key(self.last_seen)
+        for _, entry in entries:
+            command_key = entry[b'key']
+            # Already fetched in order from the main stream
+            if _decode_key(command_key) <= last_seen:
+                continue
+            persisted = self._from_redis(command_key, entry)
+            self._fetched_via_priority.add(persisted.key)
+            ret.append(persisted)
+        return ret
+
+    def backlog_size(self) -> Optional[int]:
+        return max(0, self._redis.xlen(self._command_stream_name) - self._num_seen)
 
     def fetch_by_key(self, key: str) -> Optional[PersistedCommand]:
         results = self._redis.xrevrange(self._command_stream_name, min=key, max=key, count=1)
@@ -105,18 +266,32 @@ class _RedisCommandDatabase(CommandDatabase):
         d = json.loads(redis_entry[b'command'])
         timestamp_ms = _decode_key(redis_key)[0]
         key = redis_key.decode('ascii') if isinstance(redis_key, bytes) else redis_key
-        return self._dict_to_command(d, key, timestamp_ms)
+        correlation_id = _decode_optional(redis_entry.get(b'correlation_id'))
+        parent_key = _decode_optional(redis_entry.get(b'parent_key'))
+        return self._dict_to_command(d, key, timestamp_ms, correlation_id, parent_key)
+
+    def _dict_to_command(
+            self,
+            command_dict: Dict[str, Any],
+            redis_key: str,
+            redis_timestamp_ms: int,
+            correlation_id: Optional[str] = None,
+            parent_key: Optional[str] = None) -> PersistedCommand:
+        command = self._command_from_dict(command_dict)
+        return PersistedCommand(
+            command=command,
+            key=redis_key,
+            timestamp_ms=redis_timestamp_ms,
+            correlation_id=correlation_id,
+            parent_key=parent_key)
 
-    def _dict_to_command(self, command_dict: Dict[str, Any], redis_key: str, redis_timestamp_ms: int) -> \
-            PersistedCommand:
+    def _command_from_dict(self, command_dict: Dict[str, Any]) -> BaseCommand:
         command_type = command_dict['type']
         command_class: Optional[Type[BaseCommand]] = \
             only([clazz for clazz in self._command_classes if clazz.type() == command_type])
         if command_class is None:
             raise ValueError(f'Command type {command_type} is not registered.')
-
-        command = command_class.from_dict(command_dict['command'])
-        return PersistedCommand(command=command, key=redis_key, timestamp_ms=redis_timestamp_ms)
+        return command_class.from_dict(command_dict['command'])
 
     def _command_to_dict(self, command: BaseCommand) -> Dict[str, Any]:
         command_dict = command.to_dict(encode_json=True)
@@ -130,6 +305,22 @@ class _RedisCommandDatabase(CommandDatabase):
         }
 
 
+def _entries_by_stream(xread_results) -> Dict[str, List]:
+    ret = {}
+    for result in xread_results:
+        if len(result) != 2:
+            raise ValueError("Unexpected format; expected [stream_name, [list of results]], got {}".format(result))
+        stream_name, entries = result
+        if isinstance(stream_name, bytes):
+            stream_name = stream_name.decode('ascii')
+        ret[stream_name] = entries
+    return ret
+
+
+def _decode_optional(value: Optional[bytes]) -> Optional[str]:
+    return value.decode('ascii') if value is not None else None
+
+
 def _decode_key(key: Union[str, bytes]) -> Tuple[int, int]:
     if isinstance(key, bytes):
         key = key.decode('ascii')
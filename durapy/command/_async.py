@@ -0,0 +1,84 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import Coroutine, Set
+
+from durapy.command.model import _current_command
+from durapy.command.threading import LoggingThread
+from durapy.metrics.base import MetricsSink
+
+
+class _AsyncHandlerLoop:
+    """
+    Internal asyncio event loop, running in its own thread, on which coroutine command handlers are run. Handlers are
+    scheduled without blocking the command loop, so many handlers can overlap their I/O waits on this single thread.
+    """
+
+    def __init__(self, process_name: str, metrics_sink: MetricsSink):
+        self._process_name = process_name
+        self._metrics = metrics_sink
+        self._loop = asyncio.new_event_loop()
+        self._futures: Set[concurrent.futures.Future] = set()
+        self._futures_lock = threading.Lock()
+        self._thread = LoggingThread(target=self._run_forever, name=f'{process_name}-asyncio', daemon=True)
+        self._thread.start()
+
+    def _run_forever(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def submit(self, coro: Coroutine, command_type: str):
+        """
+        Schedules a handler's coroutine on the loop and returns immediately. The command currently being dispatched
+        is carried over, so commands sent from the coroutine are attributed to it.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self._run_handler(coro, command_type, _current_command.get()), self._loop)
+        with self._futures_lock:
+            self._futures.add(future)
+            self._metrics.set_gauge('durapy_async_handlers_in_flight', len(self._futures))
+        future.add_done_callback(self._on_done)
+
+    async def _run_handler(self, coro: Coroutine, command_type: str, persisted_command):
+        _current_command.set(persisted_command)
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self._metrics.observe('durapy_handler_duration_ms', 1e3 * (time.perf_counter() - start),
+                                  labels={'type': command_type})
+
+    def _on_done(self, future: concurrent.futures.Future):
+        with self._futures_lock:
+            self._futures.discard(future)
+            self._metrics.set_gauge('durapy_async_handlers_in_flight', len(self._futures))
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            self._metrics.increment('durapy_async_handler_failures_total')
+            logging.error(f'[Process {self._process_name}] Asynchronous handler raised an exception.',
+                          exc_info=(type(e), e, e.__traceback__))
+
+    def stop(self, timeout_s: float = 5.0):
+        """
+        Cancels all outstanding handlers, waits up to `timeout_s` for them to finish, and then stops the loop.
+        """
+        async def _cancel_all():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(_cancel_all(), self._loop).result(timeout_s)
+        except concurrent.futures.TimeoutError:
+            logging.warning(f'[Process {self._process_name}] Asynchronous handlers did not finish cancelling within '
+                            f'{timeout_s}s.')
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout_s)
+        if not self._thread.is_alive():
+            self._loop.close()
@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from durapy.command.model import LifecycleListener
+from durapy.command.threading import LoggingThread
+from durapy.metrics.base import MetricsSink
+
+
+class _Heartbeater(LoggingThread):
+    """
+    Internal thread that marks heartbeats on a LifecycleListener at a fixed interval, independently of the command loop.
+    Heartbeats are coalesced: no matter how many commands are processed (or how long a heartbeat write takes), at most
+    one heartbeat is written per interval.
+
+    The command loop reports when it starts and finishes dispatching a command. If a single dispatch runs longer than
+    `stall_timeout_s`, the process is considered "stalled" and heartbeats are withheld until the dispatch returns, so
+    the lifecycle database reflects a process that is alive but no longer making progress.
+    """
+
+    def __init__(
+            self,
+            process_name: str,
+            lifecycle_listener: LifecycleListener,
+            metrics_sink: MetricsSink,
+            interval_s: float,
+            stall_timeout_s: float):
+        super().__init__(name=f'{process_name}-heartbeat', daemon=True)
+        self._process_name = process_name
+        self._lifecycle_listener = lifecycle_listener
+        self._metrics = metrics_sink
+        self._interval_s = interval_s
+        self._stall_timeout_s = stall_timeout_s
+        self._stop_event = threading.Event()
+
+        # Monotonic time at which the current dispatch started, or None if the command loop is idle / fetching.
+        self._dispatch_started_at: Optional[float] = None
+        self._reported_stall = False
+
+    def on_dispatch_started(self):
+        self._dispatch_started_at = time.monotonic()
+
+    def on_dispatch_finished(self):
+        self._dispatch_started_at = None
+
+    def stalled_for_s(self) -> Optional[float]:
+        """
+        Returns how long the current dispatch has been running if it has exceeded the stall timeout, otherwise None.
+        """
+        started_at = self._dispatch_started_at
+        if started_at is None:
+            return None
+        elapsed = time.monotonic() - started_at
+        return elapsed if elapsed > self._stall_timeout_s else None
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval_s):
+            self.beat()
+
+    def beat(self):
+        stalled_for_s = self.stalled_for_s()
+        if stalled_for_s is not None:
+            self._metrics.increment('durapy_heartbeats_withheld_total')
+            if not self._reported_stall:
+                logging.warning(f'[Process {self._process_name}] Command loop stalled: current command has been '
+                                f'processing for {stalled_for_s:.1f}s. Withholding heartbeats until it returns.')
+                self._reported_stall = True
+            self._metrics.set_gauge('durapy_stalled', 1)
+            return
+
+        self._metrics.set_gauge('durapy_stalled', 0)
+        if self._reported_stall:
+            logging.info(f'[Process {self._process_name}] Command loop recovered from stall. Resuming heartbeats.')
+            self._reported_stall = False
+
+        try:
+            self._lifecycle_listener.on_heartbeat()
+            self._metrics.increment('durapy_heartbeats_total')
+        except Exception as e:
+            self._metrics.increment('durapy_heartbeat_failures_total')
+            logging.warning('Marking heartbeat failed, hopefully transient error. Continuing. '
+                            'exception={}'.format(e))
@@ -1,28 +1,131 @@
+import atexit
+import collections
+import copy
+import itertools
+import json
 import logging
+import logging.handlers
 import os
 import platform
+import queue
+import socket
 import sys
 import tempfile
+import threading
 import traceback
 from os import path
+from typing import Callable, DefaultDict, Deque, Iterator, Optional
 
-from fluent import asynchandler as handler
-from fluent.handler import FluentRecordFormatter
+# Log files are rotated once they reach this size, keeping this many previous files around.
+LOG_FILE_MAX_BYTES = 100 * 1024 * 1024
+LOG_FILE_BACKUP_COUNT = 5
 
+# Bound on the number of log records waiting to be written. Records logged while the queue is full are dropped, so a
+# slow disk or terminal never blocks the threads doing the logging.
+_MAX_QUEUED_RECORDS = 10000
 
-def log_to_stdout():
+_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_lock = threading.Lock()
+_listener: Optional['_QueueListener'] = None
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records while its queue is full. Dropped records are reported by a warning once there's
+    room again.
+    """
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self._num_dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # As in QueueHandler, the message and traceback are rendered here, as of when they were logged, since arguments
+        # may be mutated (and frames change) by the time the listener gets to them. Unlike QueueHandler, the rest of the
+        # formatting is left to the listener's handlers, each of which has its own format.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self._num_dropped > 0:
+                self.queue.put_nowait(logging.makeLogRecord(dict(
+                    name=__name__, levelno=logging.WARNING, levelname='WARNING',
+                    msg=f'Dropped {self._num_dropped} log records, as they were logged faster than they could be '
+                        f'written.')))
+                self._num_dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._num_dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener whose #stop waits for room in a full queue, rather than raising queue.Full.
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def _add_handler(handler: logging.Handler, is_duplicate: Callable[[logging.Handler], bool]) -> bool:
+    """
+    Adds a handler that is called from a single background thread, fed by a queue that the root logger writes to, so
+    that formatting and I/O happen off of the threads that log. Returns False if an equivalent handler was already
+    added.
+    """
+    global _listener
     root = logging.getLogger()
     root.setLevel(logging.INFO)
+    with _lock:
+        if _listener is None:
+            q = queue.Queue(maxsize=_MAX_QUEUED_RECORDS)
+            root.addHandler(_DroppingQueueHandler(q))
+            _listener = _QueueListener(q, respect_handler_level=True)
+            _listener.start()
+            atexit.register(flush_logs)
+        if any(is_duplicate(h) for h in _listener.handlers):
+            return False
+        # The listener's thread reads `handlers` on each record, so it's replaced rather than mutated
+        _listener.handlers = _listener.handlers + (handler,)
+        return True
+
+
+def _remove_handler(handler: logging.Handler):
+    with _lock:
+        if _listener is not None:
+            _listener.handlers = tuple(h for h in _listener.handlers if h is not handler)
 
-    for handler in root.handlers:
-        if isinstance(handler, logging.StreamHandler) and handler.stream == sys.stdout:
+
+def flush_logs():
+    """
+    Writes out any queued log records, blocking until they've been written. Logging continues to work afterwards.
+    """
+    with _lock:
+        if _listener is None:
             return
+        _listener.stop()
+        for handler in _listener.handlers:
+            try:
+                handler.flush()
+            except (OSError, ValueError):
+                # E.g. the stream was already closed; same as logging.shutdown()
+                pass
+        _listener.start()
+
 
+def log_to_stdout():
     handler = logging.StreamHandler(sys.stdout)
     handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    root.addHandler(handler)
+    handler.setFormatter(logging.Formatter(_FORMAT))
+    _add_handler(handler, lambda h: isinstance(h, logging.StreamHandler) and h.stream == sys.stdout)
 
 
 def log_file_for(entry_point):
@@ -33,19 +136,18 @@ def log_file_for(entry_point):
     return path.join(tmpdir, f'{entry_point}.log')
 
 
-def log_to_file(logname: str):
-    root = logging.getLogger()
-    root.setLevel(logging.INFO)
-
+def log_to_file(logname: str, max_bytes: int = LOG_FILE_MAX_BYTES, backup_count: int = LOG_FILE_BACKUP_COUNT):
     log_file = log_file_for(logname)
 
     print('Logging to ', log_file)
     os.makedirs(os.path.dirname(log_file), exist_ok=True)
-    handler = logging.FileHandler(log_file)
+    handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count, delay=True)
     handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    root.addHandler(handler)
+    handler.setFormatter(logging.Formatter(_FORMAT))
+    if not _add_handler(
+            handler, lambda h: isinstance(h, logging.FileHandler) and h.baseFilename == handler.baseFilename):
+        return
 
     original_excepthook = sys.excepthook
 
@@ -57,6 +159,10 @@ def log_to_file(logname: str):
 
 
 def log_to_fluentd(process_name, fluentd_host: str, fluentd_port: int):
+    # Imported here so that processes without a fluentd configuration don't need fluent-logger
+    from fluent import asynchandler as handler
+    from fluent.handler import FluentRecordFormatter
+
     custom_format = {
         'host': '%(hostname)s',
         'where': '%(module)s.%(funcName)s',
@@ -73,3 +179,118 @@ def log_to_fluentd(process_name, fluentd_host: str, fluentd_port: int):
     h.setFormatter(formatter)
     l.addHandler(h)
     return h
+
+
+class AggregatorHandler(logging.Handler):
+    """
+    Ships log records to the webserver's log aggregator (see LogAggregatorConfiguration) as newline-delimited JSON,
+    sent in batches from a background thread. As with fluentd, records are dropped rather than blocking if the
+    aggregator can't keep up or can't be reached: at most `max_buffered` records are held, oldest dropped first.
+    """
+
+    def __init__(
+            self,
+            process_name: str,
+            hostname: str,
+            port: int,
+            flush_interval_s: float = 0.2,
+            max_buffered: int = 10000):
+        super().__init__()
+        self._process_name = process_name
+        self._address = (hostname, port)
+        self._flush_interval_s = flush_interval_s
+        self._host = socket.gethostname()
+        self._buffer: Deque[bytes] = collections.deque(maxlen=max_buffered)
+        self._socket: Optional[socket.socket] = None
+        self._send_lock = threading.Lock()
+        self._stop = threading.Event()
+        # Not a LoggingThread: logging a failure here would only feed back into this handler
+        self._thread = threading.Thread(target=self._run, name=f'{process_name}-log-shipper', daemon=True)
+        self._thread.start()
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if record.exc_info and not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            self._buffer.append(json.dumps({
+                'time': record.created,
+                'process_name': self._process_name,
+                'host': self._host,
+                'where': f'{record.module}.{record.funcName}',
+                'type': record.levelname,
+                'message': record.getMessage(),
+                'stack_trace': record.exc_text,
+            }).encode('utf-8') + b'\n')
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """
+        Sends any buffered records now, blocking until they're sent (or dropped).
+        """
+        with self._send_lock:
+            batch = []
+            while len(self._buffer) > 0:
+                batch.append(self._buffer.popleft())
+            if len(batch) == 0:
+                return
+            try:
+                if self._socket is None:
+                    self._socket = socket.create_connection(self._address, timeout=1.0)
+                self._socket.sendall(b''.join(batch))
+            except OSError:
+                # The batch is dropped; the next flush reconnects
+                self._close_socket()
+
+    def close(self):
+        _remove_handler(self)
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        super().close()
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval_s):
+            self.flush()
+        self.flush()
+        with self._send_lock:
+            self._close_socket()
+
+    def _close_socket(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+def log_to_aggregator(process_name: str, hostname: str, port: int):
+    """
+    Ships this process's logs to the webserver's log aggregator for the rest of the process's lifetime. Buffered
+    records are sent by #flush_logs().
+    """
+    handler = AggregatorHandler(process_name, hostname, port)
+    handler.setLevel(logging.INFO)
+    if not _add_handler(handler, lambda h: isinstance(h, AggregatorHandler) and h._address == handler._address):
+        handler.close()
+
+
+class CommandLogSampler:
+    """
+    Decides which commands are logged individually, so that logging cost stays bounded under load: the first
+    `first_n` commands of each type are logged, then one in every `one_in_k`.
+    """
+
+    def __init__(self, first_n: int = 100, one_in_k: int = 100):
+        self._first_n = first_n
+        self._one_in_k = one_in_k
+        # next() on an itertools.count is atomic, so no lock is needed to count from several threads
+        self._counts: DefaultDict[str, Iterator[int]] = collections.defaultdict(itertools.count)
+
+    def sample(self, command_type: str) -> Optional[int]:
+        """
+        Counts a command of the given type, returning how many of that type have been seen (including this one) if it
+        should be logged, or None if not.
+        """
+        n = next(self._counts[command_type]) + 1
+        if n <= self._first_n or (n - self._first_n) % self._one_in_k == 0:
+            return n
+        return None
@@ -0,0 +1,104 @@
+import collections
+import gc
+import logging
+import os
+import sys
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Type
+
+from durapy.command.builtin import MemoryDiagnosticsCommand, MemoryReportCommand, MemoryAction
+from durapy.command.model import BaseCommand, Context, PersistedCommand
+
+# Allocations made by tracemalloc itself, or while importing, are noise when looking for leaks.
+_IGNORED_TRACES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+class _MemoryDiagnostics:
+    """
+    Internal handler of MemoryDiagnosticsCommand for a process. Runs on the command loop's thread.
+    """
+
+    def __init__(
+            self,
+            process_name: str,
+            command_sender: Callable[[BaseCommand], PersistedCommand],
+            command_classes: List[Type[BaseCommand]]):
+        self._process_name = process_name
+        self._command_sender = command_sender
+        self._counted_classes = [PersistedCommand] + list(command_classes)
+        self._baseline_rss_bytes: Optional[int] = None
+        self._last_snapshot: Optional[tracemalloc.Snapshot] = None
+
+    def handle(self, command: MemoryDiagnosticsCommand, context: Context):
+        report = MemoryReportCommand(
+            process_name=self._process_name,
+            action=command.action,
+            tracing=False,
+            rss_bytes=0,
+            rss_growth_bytes=0,
+            num_past_commands=len(context.past_commands))
+
+        if command.action == MemoryAction.start:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(command.num_frames)
+            self._last_snapshot = self._take_snapshot()
+            self._baseline_rss_bytes = None
+        elif command.action == MemoryAction.snapshot and tracemalloc.is_tracing():
+            snapshot = self._take_snapshot()
+            report.top_allocations = [str(s) for s in snapshot.statistics('lineno')[:command.top_n]]
+            if self._last_snapshot is not None:
+                report.top_growth = [str(s) for s in snapshot.compare_to(self._last_snapshot, 'lineno')[:command.top_n]]
+            self._last_snapshot = snapshot
+        elif command.action == MemoryAction.stop:
+            tracemalloc.stop()
+            self._last_snapshot = None
+
+        report.tracing = tracemalloc.is_tracing()
+        if report.tracing:
+            report.traced_bytes = tracemalloc.get_traced_memory()[0]
+        report.rss_bytes = _rss_bytes()
+        if self._baseline_rss_bytes is None:
+            self._baseline_rss_bytes = report.rss_bytes
+        if report.rss_bytes is not None and self._baseline_rss_bytes is not None:
+            report.rss_growth_bytes = report.rss_bytes - self._baseline_rss_bytes
+        else:
+            report.rss_growth_bytes = None
+        report.object_counts = self._count_objects()
+
+        logging.info(f'[Process {self._process_name}] Memory report: rss={report.rss_bytes}, '
+                     f'growth={report.rss_growth_bytes}, traced={report.traced_bytes}, '
+                     f'past_commands={report.num_past_commands}.')
+        self._command_sender(report)
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(_IGNORED_TRACES)
+
+    def _count_objects(self) -> Dict[str, int]:
+        counts = collections.Counter(type(o) for o in gc.get_objects())
+        return {clazz.__name__: counts.get(clazz, 0) for clazz in self._counted_classes}
+
+
+def _rss_bytes() -> Optional[int]:
+    """
+    Current resident set size of this process. Falls back to the peak RSS where the current one isn't available, and
+    None where neither is (e.g. on Windows).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        # AttributeError: no os.sysconf, on Windows
+        try:
+            # Unix-only
+            import resource
+        except ImportError:
+            return None
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS, but kilobytes elsewhere
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
@@ -0,0 +1,187 @@
+import collections
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from typing import Callable, Counter, List, Optional
+
+from durapy.command._logging import log_file_for
+from durapy.command.builtin import StartProfilerCommand, ProfileWrittenCommand, ProfilerMode
+from durapy.command.model import BaseCommand, PersistedCommand
+from durapy.command.threading import LoggingThread
+
+# File extensions of written profiles, by mode.
+PROFILE_EXTENSIONS = {
+    ProfilerMode.sampling: 'collapsed',
+    ProfilerMode.cprofile: 'pstats',
+}
+
+# Number of entries in a profile's summary.
+_SUMMARY_SIZE = 10
+
+
+def profile_file_for(process_name: str, mode: ProfilerMode) -> str:
+    """
+    Path of a new profile for the given process, in the same directory as its log file. Timestamped to the microsecond,
+    so profiles taken in quick succession don't overwrite each other.
+    """
+    log_dir = os.path.dirname(log_file_for(process_name))
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    return os.path.join(log_dir, f'{process_name}.{timestamp}.{PROFILE_EXTENSIONS[mode]}')
+
+
+class _Profiler:
+    """
+    Internal on-demand profiler for a process, driven by StartProfilerCommand / StopProfilerCommand. At most one
+    profile is collected at a time.
+
+    In sampling mode, a background thread periodically records the stacks of all threads. In cProfile mode, a
+    cProfile.Profile is enabled around each dispatch on the command loop's thread; since it can only be turned off
+    from that thread, the command loop is woken up when time is up and finishes the profile via #poll().
+    """
+
+    def __init__(
+            self,
+            process_name: str,
+            command_sender: Callable[[BaseCommand], PersistedCommand],
+            wakeup: Callable[[], None]):
+        self._process_name = process_name
+        self._command_sender = command_sender
+        self._wakeup = wakeup
+
+        self._lock = threading.Lock()
+        self._command: Optional[StartProfilerCommand] = None
+        self._started_at = 0.0
+        self._deadline = 0.0
+
+        # Sampling mode
+        self._sampler: Optional[LoggingThread] = None
+        self._sampler_stop = threading.Event()
+
+        # cProfile mode
+        self._cprofile: Optional[cProfile.Profile] = None
+        self._timer: Optional[threading.Timer] = None
+
+    def start(self, command: StartProfilerCommand):
+        with self._lock:
+            if self._command is not None:
+                logging.warning(f'[Process {self._process_name}] A profiler is already running; ignoring {command}.')
+                return
+            self._command = command
+            self._started_at = time.monotonic()
+            self._deadline = self._started_at + command.duration_s
+
+        logging.info(f'[Process {self._process_name}] Starting {command.mode.name} profiler for '
+                     f'{command.duration_s}s.')
+        if command.mode == ProfilerMode.sampling:
+            self._sampler_stop.clear()
+            self._sampler = LoggingThread(
+                target=self._sample, args=(command,), name=f'{self._process_name}-profiler', daemon=True)
+            self._sampler.start()
+        else:
+            self._cprofile = cProfile.Profile()
+            self._timer = threading.Timer(command.duration_s, self._wakeup)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def stop(self):
+        """
+        Finishes the current profile early, if any. Must be called from the command loop's thread.
+        """
+        if self._sampler is not None:
+            self._sampler_stop.set()
+            self._sampler.join()
+            self._sampler = None
+        elif self._cprofile is not None:
+            self._finish_cprofile()
+
+    def on_dispatch_started(self):
+        if self._cprofile is not None:
+            self._cprofile.enable()
+
+    def on_dispatch_finished(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+
+    def poll(self):
+        """
+        Finishes a cProfile profile whose time is up. Called by the command loop between dispatches.
+        """
+        if self._cprofile is not None and time.monotonic() >= self._deadline:
+            self._finish_cprofile()
+
+    def _finish_cprofile(self):
+        profile = self._cprofile
+        self._cprofile = None
+        self._timer.cancel()
+        path = profile_file_for(self._process_name, ProfilerMode.cprofile)
+        profile.dump_stats(path)
+
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(_SUMMARY_SIZE)
+        summary = [line for line in out.getvalue().splitlines() if line.strip()]
+        self._finish(path, summary)
+
+    def _sample(self, command: StartProfilerCommand):
+        own_ident = threading.get_ident()
+        names = {}
+        stacks: Counter[str] = collections.Counter()
+        interval_s = command.sample_interval_ms / 1e3
+        while not self._sampler_stop.wait(interval_s) and time.monotonic() < self._deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stacks[_collapse(names.get(ident, str(ident)), frame)] += 1
+
+        path = profile_file_for(self._process_name, ProfilerMode.sampling)
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        self._finish(path, _summarize_samples(stacks))
+
+    def _finish(self, path: str, summary: List[str]):
+        with self._lock:
+            command = self._command
+            duration_s = time.monotonic() - self._started_at
+            self._command = None
+        logging.info(f'[Process {self._process_name}] Wrote {command.mode.name} profile to {path}.')
+        self._command_sender(ProfileWrittenCommand(
+            process_name=self._process_name,
+            mode=command.mode,
+            path=path,
+            duration_s=round(duration_s, 3),
+            summary=summary,
+        ))
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def _collapse(thread_name: str, frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    # Collapsed stacks go from the root to the leaf, semicolon-delimited
+    return ';'.join([thread_name] + names[::-1])
+
+
+def _summarize_samples(stacks: Counter[str]) -> List[str]:
+    total = sum(stacks.values())
+    if total == 0:
+        return []
+    # Samples by leaf ("self") function
+    leaves: Counter[str] = collections.Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    return [f'{100 * count / total:.1f}% {leaf}' for leaf, count in leaves.most_common(_SUMMARY_SIZE)]
@@ -0,0 +1,223 @@
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from durapy.backends.base import CommandDatabase
+from durapy.command.model import BaseCommand, PersistedCommand, ScheduledCommand, ScheduledHandle, _Scheduler
+from durapy.command.threading import LoggingThread
+from durapy.metrics.base import MetricsSink
+
+
+class _ScheduledEntry(ScheduledHandle):
+    def __init__(
+            self,
+            scheduler: '_CommandScheduler',
+            command_factory: Callable[[], BaseCommand],
+            start_deadline_s: float,
+            period_s: Optional[float],
+            shared: Optional[ScheduledCommand]):
+        self._scheduler = scheduler
+        self.command_factory = command_factory
+        self.start_deadline_s = start_deadline_s
+        self.period_s = period_s
+
+        # Deadline (in time.monotonic() seconds) of the next send, and how many periods after the start it is.
+        self.deadline_s = start_deadline_s
+        self.num_periods = 0
+
+        # Set for one-off commands that are also held in the command database's shared schedule.
+        self.shared = shared
+        self.done = False
+
+    def cancel(self) -> bool:
+        return self._scheduler._cancel(self)
+
+    def next_at_ms(self) -> Optional[int]:
+        if self.done:
+            return None
+        return int(round(1e3 * (time.time() + self.deadline_s - time.monotonic())))
+
+
+class _CommandScheduler(_Scheduler):
+    """
+    Internal timer that sends scheduled commands for a process. All schedules share a single heap of deadlines and a
+    single thread, which sleeps until the earliest deadline (or until a new, earlier one is added).
+
+    Deadlines are tracked on the monotonic clock. Periodic deadlines are always computed as start + n * period, so
+    latency in one send never pushes back the following ones.
+
+    If a command database is given, one-off commands are additionally added to its shared schedule, where they are
+    visible to other processes (e.g. the webserver) and survive this process stopping. This process still sends them
+    at their deadline; any that become overdue, e.g. because the process that scheduled them died, are picked up by
+    whichever process polls the shared schedule first.
+    """
+
+    def __init__(
+            self,
+            process_name: str,
+            command_sender: Callable[[BaseCommand], PersistedCommand],
+            metrics_sink: MetricsSink,
+            command_db: Optional[CommandDatabase] = None,
+            shared_poll_interval_s: float = 1.0,
+            shared_grace_ms: float = 1000.0):
+        self._process_name = process_name
+        self._command_sender = command_sender
+        self._metrics = metrics_sink
+        self._command_db = command_db
+        self._shared_poll_interval_s = shared_poll_interval_s
+        self._shared_grace_ms = shared_grace_ms
+
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, _ScheduledEntry]] = []
+        self._counter = itertools.count()
+        self._num_live = 0
+        self._is_stopped = False
+        self._thread: Optional[LoggingThread] = None
+
+    def start(self):
+        with self._cond:
+            self._ensure_started()
+
+    def stop(self):
+        with self._cond:
+            self._is_stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def schedule(
+            self,
+            command_factory: Callable[[], BaseCommand],
+            at_ms: float,
+            period_ms: Optional[float] = None) -> ScheduledHandle:
+        with self._cond:
+            if self._is_stopped:
+                raise RuntimeError('Cannot schedule commands on a stopped process.')
+        deadline_s = time.monotonic() + (at_ms - 1e3 * time.time()) / 1e3
+        shared = None
+        if period_ms is None and self._command_db is not None:
+            shared = self._command_db.add_scheduled(command_factory(), int(round(at_ms)))
+        entry = _ScheduledEntry(
+            scheduler=self,
+            command_factory=command_factory,
+            start_deadline_s=deadline_s,
+            period_s=period_ms / 1e3 if period_ms is not None else None,
+            shared=shared)
+        with self._cond:
+            is_stopped = self._is_stopped
+            if not is_stopped:
+                self._push(entry)
+                self._set_num_live(self._num_live + 1)
+                self._ensure_started()
+                self._cond.notify_all()
+        if is_stopped:
+            # Stopped while adding to the shared schedule; take it back out rather than leave it behind
+            if shared is not None:
+                self._command_db.claim_scheduled(shared.schedule_id)
+            raise RuntimeError('Cannot schedule commands on a stopped process.')
+        return entry
+
+    def _cancel(self, entry: _ScheduledEntry) -> bool:
+        with self._cond:
+            if entry.done:
+                return False
+            # Lazily removed from the heap once its deadline comes up
+            entry.done = True
+            self._set_num_live(self._num_live - 1)
+        if entry.shared is not None:
+            return self._command_db.claim_scheduled(entry.shared.schedule_id) is not None
+        return True
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = LoggingThread(target=self._run, name=f'{self._process_name}-scheduler', daemon=True)
+            self._thread.start()
+
+    def _push(self, entry: _ScheduledEntry):
+        heapq.heappush(self._heap, (entry.deadline_s, next(self._counter), entry))
+
+    def _set_num_live(self, num_live: int):
+        self._num_live = num_live
+        self._metrics.set_gauge('durapy_scheduled_commands', num_live)
+
+    def _run(self):
+        next_shared_poll_s = time.monotonic()
+        while True:
+            with self._cond:
+                while True:
+                    if self._is_stopped:
+                        return
+                    now_s = time.monotonic()
+                    if len(self._heap) > 0 and self._heap[0][0] <= now_s:
+                        _, _, entry = heapq.heappop(self._heap)
+                        if entry.done:
+                            continue
+                        break
+                    if self._command_db is not None and next_shared_poll_s <= now_s:
+                        entry = None
+                        break
+
+                    wait_until_s = self._heap[0][0] if len(self._heap) > 0 else math.inf
+                    if self._command_db is not None:
+                        wait_until_s = min(wait_until_s, next_shared_poll_s)
+                    self._cond.wait(None if wait_until_s == math.inf else wait_until_s - now_s)
+
+                if entry is not None:
+                    jitter_ms = 1e3 * (now_s - entry.deadline_s)
+                    if entry.period_s is None:
+                        entry.done = True
+                        self._set_num_live(self._num_live - 1)
+                    else:
+                        self._reschedule(entry, now_s)
+
+            # Send outside of the lock, so slow sends don't block (or deadlock with) scheduling.
+            if entry is not None:
+                self._metrics.observe('durapy_schedule_jitter_ms', jitter_ms)
+                self._send(entry)
+            else:
+                self._send_overdue_shared()
+                next_shared_poll_s = time.monotonic() + self._shared_poll_interval_s
+
+    def _reschedule(self, entry: _ScheduledEntry, now_s: float):
+        entry.num_periods += 1
+        next_deadline_s = entry.start_deadline_s + entry.num_periods * entry.period_s
+        if next_deadline_s <= now_s:
+            # Fell more than a period behind; skip ahead rather than sending a burst of catch-up commands.
+            num_periods = int((now_s - entry.start_deadline_s) // entry.period_s) + 1
+            self._metrics.increment('durapy_scheduled_sends_skipped_total', num_periods - entry.num_periods)
+            entry.num_periods = num_periods
+            next_deadline_s = entry.start_deadline_s + entry.num_periods * entry.period_s
+        entry.deadline_s = next_deadline_s
+        self._push(entry)
+
+    def _send(self, entry: _ScheduledEntry):
+        try:
+            if entry.shared is not None:
+                # Another process may have already picked it up from the shared schedule
+                claimed = self._command_db.claim_scheduled(entry.shared.schedule_id)
+                if claimed is None:
+                    return
+                command = claimed.command
+            else:
+                command = entry.command_factory()
+            self._command_sender(command)
+        except Exception as e:
+            logging.error(f'[Process {self._process_name}] Failed to send scheduled command: {e}', exc_info=True)
+
+    def _send_overdue_shared(self):
+        try:
+            overdue = self._command_db.fetch_scheduled(
+                num=100, due_before_ms=int(1e3 * time.time() - self._shared_grace_ms))
+            for scheduled in overdue:
+                claimed = self._command_db.claim_scheduled(scheduled.schedule_id)
+                if claimed is None:
+                    continue
+                logging.info(f'[Process {self._process_name}] Sending overdue scheduled command '
+                             f'{claimed.schedule_id}, due at {claimed.at_ms}.')
+                self._command_sender(claimed.command)
+        except Exception as e:
+            logging.error(f'[Process {self._process_name}] Failed to poll the shared schedule: {e}', exc_info=True)
@@ -0,0 +1,132 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional
+
+from durapy.command.model import LifecycleListener
+from durapy.command.threading import LoggingThread
+from durapy.metrics.base import MetricsSink
+
+
+class _Watchdog(LoggingThread):
+    """
+    Internal thread that times each dispatch against a budget for its command type. When a dispatch exceeds its
+    budget, the stacks of all threads are dumped to the log (once per dispatch), so it's visible where the handler is
+    stuck, and optionally the process is marked unhealthy in the lifecycle database until the dispatch returns.
+    """
+
+    def __init__(
+            self,
+            process_name: str,
+            metrics_sink: MetricsSink,
+            budgets_s: Dict[str, float],
+            default_budget_s: Optional[float],
+            lifecycle_listener: Optional[LifecycleListener] = None,
+            check_interval_s: float = 0.1):
+        super().__init__(name=f'{process_name}-watchdog', daemon=True)
+        self._process_name = process_name
+        self._metrics = metrics_sink
+        self._budgets_s = budgets_s
+        self._default_budget_s = default_budget_s
+        self._lifecycle_listener = lifecycle_listener
+        self._check_interval_s = check_interval_s
+        self._stop_event = threading.Event()
+
+        # Guards the state below, which both the command loop's thread and the watchdog thread update. Never held while
+        # writing to the lifecycle database, so a slow write doesn't hold up dispatches.
+        self._lock = threading.Lock()
+        # Serializes writes to the lifecycle database; each writes whatever the health is by then, so the last write
+        # always leaves the latest health behind.
+        self._health_lock = threading.Lock()
+
+        # (command type, monotonic start time, budget) of the current dispatch, or None if not dispatching. A new tuple
+        # per dispatch, so its identity also tells dispatches apart.
+        self._dispatch = None
+        # The dispatch whose overrun was reported, and why the process is unhealthy because of it, if it is.
+        self._reported_dispatch = None
+        self._unhealthy_reason: Optional[str] = None
+
+    def on_dispatch_started(self, command_type: str):
+        budget_s = self._budgets_s.get(command_type, self._default_budget_s)
+        with self._lock:
+            self._dispatch = (command_type, time.monotonic(), budget_s) if budget_s is not None else None
+
+    def on_dispatch_finished(self):
+        with self._lock:
+            dispatch = self._dispatch
+            self._dispatch = None
+            if dispatch is not None and self._reported_dispatch is dispatch:
+                command_type, started_at, _ = dispatch
+                logging.warning(f'[Process {self._process_name}] Handler for {command_type} returned after '
+                                f'{time.monotonic() - started_at:.1f}s.')
+            self._reported_dispatch = None
+            was_unhealthy = self._unhealthy_reason is not None
+            self._unhealthy_reason = None
+        if was_unhealthy:
+            self._write_health()
+
+    def reset_health(self):
+        """
+        Marks the process healthy, clearing any unhealthy mark left behind by a previous run that was killed while over
+        budget. Does nothing unless overruns mark the process unhealthy.
+        """
+        if self._lifecycle_listener is not None:
+            self._write_health()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(self._check_interval_s):
+            self.check()
+
+    def check(self):
+        with self._lock:
+            dispatch = self._dispatch
+            if dispatch is None or self._reported_dispatch is dispatch:
+                return
+            command_type, started_at, budget_s = dispatch
+            elapsed_s = time.monotonic() - started_at
+            if elapsed_s <= budget_s:
+                return
+            self._reported_dispatch = dispatch
+
+        # Stacks are formatted outside of the lock, as it can take a while and the dispatch may finish meanwhile
+        self._metrics.increment('durapy_handler_overruns_total', labels={'type': command_type})
+        logging.error(f'[Process {self._process_name}] Handler for {command_type} has been running for '
+                      f'{elapsed_s:.1f}s, exceeding its budget of {budget_s}s. Stacks of all threads:\n'
+                      f'{_format_all_stacks()}')
+        if self._lifecycle_listener is None:
+            return
+        with self._lock:
+            if self._dispatch is not dispatch:
+                # Returned while the stacks were being dumped, so it's no longer over budget
+                return
+            self._unhealthy_reason = f'Handler for {command_type} exceeded its budget of {budget_s}s'
+        self._write_health()
+
+    def _write_health(self):
+        with self._health_lock:
+            with self._lock:
+                reason = self._unhealthy_reason
+            self._set_unhealthy(reason)
+
+    def _set_unhealthy(self, reason: Optional[str]):
+        try:
+            if reason is not None:
+                self._lifecycle_listener.on_unhealthy(reason)
+            else:
+                self._lifecycle_listener.on_healthy()
+        except Exception as e:
+            logging.warning(f'[Process {self._process_name}] Failed to update health in lifecycle database: {e}')
+
+
+def _format_all_stacks() -> str:
+    names = {t.ident: t.name for t in threading.enumerate()}
+    sections = []
+    for ident, frame in sys._current_frames().items():
+        header = f'Thread {names.get(ident, "<unknown>")} ({ident}):'
+        sections.append(header + '\n' + ''.join(traceback.format_stack(frame)))
+    return '\n'.join(sections)
@@ -0,0 +1,149 @@
+"""
+Built-in control commands, handled by every ProcessRunner without being registered. Each is addressed to a single
+process by name. These are automatically known to every ProcessRunner and DurapyWebserver, so they don't need to be
+added to a Configuration's command classes.
+"""
+import dataclasses
+from typing import Dict, List, Optional, Type
+
+from durapy.command.model import BaseCommand, oneof_class
+
+
+ProfilerMode = oneof_class('ProfilerMode', [
+    # Samples the stacks of all threads at a fixed interval; low overhead. Written as collapsed stacks, suitable for
+    # flame graph tools.
+    'sampling',
+    # Deterministically profiles command handlers (on the command loop's thread) with cProfile. Written as pstats.
+    'cprofile',
+])
+
+
+@dataclasses.dataclass
+class StartProfilerCommand(BaseCommand):
+    """
+    Profiles a process for a number of seconds. When finished, the profile is written next to the process's log file
+    and a ProfileWrittenCommand is sent.
+    """
+    process_name: str
+    duration_s: float = 30.0
+    mode: ProfilerMode = ProfilerMode.sampling
+
+    # For sampling mode: how often stacks are sampled.
+    sample_interval_ms: float = 5.0
+
+    @staticmethod
+    def type() -> str:
+        return 'DURAPY_START_PROFILER'
+
+
+@dataclasses.dataclass
+class StopProfilerCommand(BaseCommand):
+    """
+    Stops a running profiler early, writing out what it has collected so far.
+    """
+    process_name: str
+
+    @staticmethod
+    def type() -> str:
+        return 'DURAPY_STOP_PROFILER'
+
+
+@dataclasses.dataclass
+class ProfileWrittenCommand(BaseCommand):
+    """
+    Sent by a process once it has written a profile.
+    """
+    process_name: str
+    mode: ProfilerMode
+
+    # Path of the written profile on the machine running the process.
+    path: str
+    duration_s: float
+
+    # Human-readable summary of the hottest functions.
+    summary: List[str] = dataclasses.field(default_factory=list)
+
+    @staticmethod
+    def type() -> str:
+        return 'DURAPY_PROFILE_WRITTEN'
+
+
+MemoryAction = oneof_class('MemoryAction', [
+    # Starts tracing allocations with tracemalloc, and takes a baseline snapshot.
+    'start',
+    # Takes a snapshot, diffing it against the previous one.
+    'snapshot',
+    # Stops tracing allocations.
+    'stop',
+])
+
+
+@dataclasses.dataclass
+class MemoryDiagnosticsCommand(BaseCommand):
+    """
+    Inspects a process's memory usage. Every action is answered with a MemoryReportCommand; allocation sites are only
+    reported while tracing (i.e. between 'start' and 'stop').
+    """
+    process_name: str
+    action: MemoryAction = MemoryAction.snapshot
+
+    # Number of allocation sites to report.
+    top_n: int = 10
+
+    # For 'start': number of frames recorded per allocation. More frames give more context at a higher overhead.
+    num_frames: int = 1
+
+    @staticmethod
+    def type() -> str:
+        return 'DURAPY_MEMORY_DIAGNOSTICS'
+
+
+@dataclasses.dataclass
+class MemoryReportCommand(BaseCommand):
+    """
+    Sent by a process in response to a MemoryDiagnosticsCommand.
+    """
+    process_name: str
+    action: MemoryAction
+    tracing: bool
+
+    # Resident set size of the process, and its growth since tracing was started (or since the first report). None
+    # where the platform doesn't report it.
+    rss_bytes: Optional[int]
+    rss_growth_bytes: Optional[int]
+
+    # Memory currently allocated by Python and traced by tracemalloc, if tracing.
+    traced_bytes: int = 0
+
+    # Allocation sites holding the most memory.
+    top_allocations: List[str] = dataclasses.field(default_factory=list)
+
+    # Allocation sites that grew the most since the previous snapshot.
+    top_growth: List[str] = dataclasses.field(default_factory=list)
+
+    # Number of live PersistedCommand and command objects, by class name.
+    object_counts: Dict[str, int] = dataclasses.field(default_factory=dict)
+
+    # Number of commands held in the process context's past_commands.
+    num_past_commands: int = 0
+
+    @staticmethod
+    def type() -> str:
+        return 'DURAPY_MEMORY_REPORT'
+
+
+BUILTIN_COMMAND_CLASSES: List[Type[BaseCommand]] = [
+    StartProfilerCommand,
+    StopProfilerCommand,
+    ProfileWrittenCommand,
+    MemoryDiagnosticsCommand,
+    MemoryReportCommand,
+]
+
+
+def with_builtin_command_classes(command_classes: List[Type[BaseCommand]]) -> List[Type[BaseCommand]]:
+    """
+    Returns the given command classes plus any built-in command classes whose types aren't already among them.
+    """
+    types = {clazz.type() for clazz in command_classes}
+    return list(command_classes) + [clazz for clazz in BUILTIN_COMMAND_CLASSES if clazz.type() not in types]
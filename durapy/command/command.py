@@ -1,11 +1,18 @@
+import concurrent.futures
 import dataclasses
+import inspect
 import logging
-from typing import TypeVar, Generic, Optional, Any, Callable, Type, Dict
+import threading
+import time
+import typing
+from typing import TypeVar, Generic, Optional, Any, Callable, Type, Dict, Hashable, List
 
-from more_itertools import only  # type: ignore
-
-from durapy.command.model import BaseCommand, BaseController, Context
+from durapy.command.model import BaseCommand, BaseController, Context, PersistedCommand, _ReplyRegistry
 from durapy.config import Configuration
+from durapy.metrics.base import MetricsSink
+
+if typing.TYPE_CHECKING:
+    from durapy.command._async import _AsyncHandlerLoop
 
 _ControllerT = TypeVar('_ControllerT', bound='BaseController')
 _CommandT = TypeVar('_CommandT', bound='BaseCommand')
@@ -29,15 +36,33 @@ class CommandRegistry:
     via #register_controller_method, and when the controller instance should be deleted (e.g. at the end of one animal's
     experiments for the day), a command can be registered as a controller deleter via #register_controller_deleter.
 
+    By default a process has at most one live controller. To serve several concurrent sessions (e.g. multiple subjects
+    or channels) from one process, pass an `instance_key` when registering the controller's commands: a function
+    extracting a key (e.g. a session ID) from the command. Each creating command then creates a separate controller
+    for its key, and controller methods and deleters are routed to the controller for their command's key.
+
     Note that any of these methods can perform any functionality necessary. However, further commands will not be
     processed until processing of a prior command returns. Thus, if a long-running computation  or polling (e.g. if
     continuously monitoring from a sensor) is necessary to perform, it is recommended to put this work in a new thread
-    and return quickly.
+    and return quickly. Alternatively, static methods, controller methods and controller deleters can be coroutine
+    functions (`async def`), which are run on an event loop owned by the process without blocking further commands;
+    any still running when the process stops are cancelled. Note that the context's command_key and
+    command_timestamp_ms fields change as further commands are processed, so coroutines should rely on the command
+    passed to them instead.
+
+    For high-rate command types, a function handling a list of commands at once can be registered via
+    #register_batch_method.
+
+    If a process falls behind, by default it processes every command in order. For high-rate commands where only
+    recent (or only the latest) values matter, a StalenessPolicy can be registered per command type via
+    #register_staleness_policy, allowing the process to skip obsolete commands when catching up.
 
     For examples, see the included `example` or `pingpong` examples on how to use this.
     """
     def __init__(self):
         self._registered_handlers: Dict[Type[_CommandT], _RegisteredHandler] = {}
+        self._staleness_policies: Dict[Type[_CommandT], StalenessPolicy] = {}
+        self._handler_budgets_s: Dict[Type[_CommandT], float] = {}
 
     def register_static_method(
             self,
@@ -57,6 +82,7 @@ class CommandRegistry:
             returns_instance=False,
             deletes_instance=False,
             is_stop_static_method=False,
+            is_async=inspect.iscoroutinefunction(method),
         )
         return self
 
@@ -81,9 +107,17 @@ class CommandRegistry:
     def register_controller_creator(
             self,
             command_class: Type[_CommandT],
-            controller_creator: Callable[[_CommandT, Context], BaseController]):
+            controller_creator: Callable[[_CommandT, Context], BaseController],
+            instance_key: Optional[Callable[[_CommandT], Hashable]] = None):
+        """
+        @param instance_key: if given, extracts the key of the controller to create from the command, allowing one
+        live controller per key. See the class docstring.
+        """
         if not issubclass(command_class, BaseCommand):
             raise ValueError(f'Did not pass a valid command class; passed {command_class}.')
+        if inspect.iscoroutinefunction(controller_creator):
+            raise ValueError(f'Controller creators must return the controller synchronously; passed coroutine '
+                             f'function {controller_creator}.')
 
         # Use default args to capture the arg
         def _method(_: Optional[_ControllerT], command: _CommandT, context: Context, h=controller_creator):
@@ -96,13 +130,19 @@ class CommandRegistry:
             returns_instance=True,
             deletes_instance=False,
             is_stop_static_method=False,
+            instance_key=instance_key,
         )
         return self
 
     def register_controller_method(
             self,
             command_class: Type[_CommandT],
-            controller_method: Callable[[_ControllerT, _CommandT, Context], Any]):
+            controller_method: Callable[[_ControllerT, _CommandT, Context], Any],
+            instance_key: Optional[Callable[[_CommandT], Hashable]] = None):
+        """
+        @param instance_key: if given, extracts the key of the controller to route the command to. See the class
+        docstring.
+        """
         def _method(
                 instance: Optional[_ControllerT],
                 command: _CommandT,
@@ -117,13 +157,20 @@ class CommandRegistry:
             returns_instance=False,
             deletes_instance=False,
             is_stop_static_method=False,
+            is_async=inspect.iscoroutinefunction(controller_method),
+            instance_key=instance_key,
         )
         return self
 
     def register_controller_deleter(
             self,
             command_class: Type[_CommandT],
-            controller_method: Callable[[_ControllerT, _CommandT, Context], Any]):
+            controller_method: Callable[[_ControllerT, _CommandT, Context], Any],
+            instance_key: Optional[Callable[[_CommandT], Hashable]] = None):
+        """
+        @param instance_key: if given, extracts the key of the controller to route the command to. See the class
+        docstring.
+        """
         def _method(
                 instance: Optional[_ControllerT],
                 command: _CommandT,
@@ -138,12 +185,128 @@ class CommandRegistry:
             returns_instance=False,
             deletes_instance=True,
             is_stop_static_method=False,
+            is_async=inspect.iscoroutinefunction(controller_method),
+            instance_key=instance_key,
+        )
+        return self
+
+    def register_batch_method(
+            self,
+            command_class: Type[_CommandT],
+            method: Callable[[List[_CommandT], Context], Any],
+            max_batch_size: Optional[int] = None):
+        """
+        Registers a function that handles commands of the given type in batches: it is passed a list of consecutive
+        commands of this type, in order, rather than one command at a time. Useful for high-rate commands (e.g. sensor
+        events) whose handling can be vectorized.
+
+        Batches are only formed from commands that have already been fetched, i.e. while the process is catching up on
+        a backlog, so batching never delays a command. When the process is keeping up, batches hold a single command.
+
+        While a batch is handled, the context refers to its last command: `context.command_key` is that command's key,
+        and commands sent meanwhile record it as their parent. Commands that are part of a request (see
+        Context#send_and_wait) are never batched with others, so replies sent while handling them are still matched to
+        their request.
+
+        @param max_batch_size: upper bound on the number of commands passed at once. Defaults to the runner's
+        `fetch_batch_size`.
+        """
+        if not issubclass(command_class, BaseCommand):
+            raise ValueError(f'Did not pass a valid command class; passed {command_class}.')
+        if inspect.iscoroutinefunction(method):
+            raise ValueError(f'Batch methods cannot be coroutine functions; passed {method}.')
+        if max_batch_size is not None and max_batch_size < 1:
+            raise ValueError(f'max_batch_size must be positive; got {max_batch_size}.')
+
+        # Use default args to capture the arg
+        def _method(_: Optional[_ControllerT], commands: List[_CommandT], context: Context, h=method):
+            return h(commands, context)
+
+        self._registered_handlers[command_class] = _RegisteredHandler(
+            command_class=command_class,
+            method=_method,
+            is_controller_method=False,
+            returns_instance=False,
+            deletes_instance=False,
+            is_stop_static_method=False,
+            is_batch_method=True,
+            max_batch_size=max_batch_size,
         )
         return self
 
+    def register_staleness_policy(
+            self,
+            command_class: Type[_CommandT],
+            policy: 'StalenessPolicy'):
+        """
+        Registers how stale commands of the given type should be treated when this process falls behind. See
+        StalenessPolicy for the available policies; commands without a policy are always processed.
+        """
+        if not issubclass(command_class, BaseCommand):
+            raise ValueError(f'Did not pass a valid command class; passed {command_class}.')
+        self._staleness_policies[command_class] = policy
+        return self
+
+    def register_handler_budget(
+            self,
+            command_class: Type[_CommandT],
+            budget_s: float):
+        """
+        Registers how long handling a command of the given type is expected to take at most. Overrides the runner's
+        default `handler_budget_s` for this type. If a handler runs over its budget, the process dumps the stacks of all
+        threads to the log (see ProcessRunner).
+        """
+        if not issubclass(command_class, BaseCommand):
+            raise ValueError(f'Did not pass a valid command class; passed {command_class}.')
+        if budget_s <= 0:
+            raise ValueError(f'Handler budget must be positive; got {budget_s}s.')
+        self._handler_budgets_s[command_class] = budget_s
+        return self
+
     def _get_registered_handlers(self):
         return self._registered_handlers.copy()
 
+    def _get_staleness_policies(self):
+        return self._staleness_policies.copy()
+
+    def _get_handler_budgets_s(self):
+        return self._handler_budgets_s.copy()
+
+
+@dataclasses.dataclass(frozen=True)
+class StalenessPolicy:
+    """
+    Describes how a command type should be handled when a process has fallen behind. Commands that are part of a request
+    (see Context#send_and_wait) are exempt. Construct via one of the static methods below, e.g.:
+
+        registry.register_staleness_policy(SetLedCommand, StalenessPolicy.latest_only())
+    """
+
+    # If set, commands older than this (in milliseconds, according to the command database's timestamp) when they are
+    # about to be dispatched are dropped.
+    ttl_ms: Optional[int] = None
+
+    # If True, of the commands of this type fetched together in a backlog, only the latest per `coalesce_key` is
+    # processed.
+    coalesce: bool = False
+
+    # Extracts the key commands are coalesced by (e.g. a channel). If None, all commands of this type share one key.
+    coalesce_key: Optional[Callable[[Any], Hashable]] = None
+
+    @staticmethod
+    def always_process() -> 'StalenessPolicy':
+        return StalenessPolicy()
+
+    @staticmethod
+    def drop_older_than(ttl_ms: int) -> 'StalenessPolicy':
+        return StalenessPolicy(ttl_ms=ttl_ms)
+
+    @staticmethod
+    def latest_only(
+            coalesce_key: Optional[Callable[[Any], Hashable]] = None,
+            ttl_ms: Optional[int] = None) -> 'StalenessPolicy':
+        return StalenessPolicy(ttl_ms=ttl_ms, coalesce=True, coalesce_key=coalesce_key)
+
 
 @dataclasses.dataclass
 class _RegisteredHandler(Generic[_ControllerT, _CommandT]):
@@ -153,53 +316,203 @@ class _RegisteredHandler(Generic[_ControllerT, _CommandT]):
     returns_instance: bool
     deletes_instance: bool
     is_stop_static_method: bool
+    is_async: bool = False
+
+    # Batch methods are passed a list of (up to max_batch_size) commands rather than a single command.
+    is_batch_method: bool = False
+    max_batch_size: Optional[int] = None
+
+    # For controller creators, methods and deleters: extracts the key of the controller instance the command is for.
+    # If None, the command is for the default (unkeyed) instance.
+    instance_key: Optional[Callable[[_CommandT], Hashable]] = None
 
 
-class _CommandListener:
+@dataclasses.dataclass
+class _PendingReply:
+    request_type: str
+    reply_type: str
+    future: concurrent.futures.Future
+    registered_at: float
+
+
+class _CommandListener(_ReplyRegistry):
     """
-    Internal class for handling any incoming commands.
+    Internal class for handling any incoming commands. Also completes futures waiting on correlated replies (see
+    Context#send_and_wait).
     """
-    def __init__(self, configuration: Configuration, registered_handlers: Dict[Type[_CommandT], _RegisteredHandler]):
+    def __init__(
+            self,
+            configuration: Configuration,
+            registered_handlers: Dict[Type[_CommandT], _RegisteredHandler],
+            metrics_sink: MetricsSink,
+            async_loop: Optional['_AsyncHandlerLoop'] = None):
         self._all_command_classes = configuration.command_classes
         self._registered_handlers = registered_handlers
-        self._instance: Optional[BaseController] = None
+        self._metrics = metrics_sink
+        self._async_loop = async_loop
+
+        # Live controller instances, keyed by the key extracted from their creating command (None if unkeyed).
+        self._instances: Dict[Hashable, BaseController] = {}
+
+        self._handlers_by_type: Dict[str, _RegisteredHandler] = {}
+        for clazz, handler in registered_handlers.items():
+            if clazz is None:
+                continue
+            if clazz.type() in self._handlers_by_type:
+                raise ValueError(f'Duplicate command type {clazz.type()}: registered for both {clazz} and '
+                                 f'{self._handlers_by_type[clazz.type()].command_class}.')
+            self._handlers_by_type[clazz.type()] = handler
+
+        # Keyed by correlation ID. Registered from any thread, so guarded by a lock.
+        self._pending_replies: Dict[str, _PendingReply] = {}
+        self._pending_replies_lock = threading.Lock()
+
+    def register(
+            self,
+            correlation_id: str,
+            request_type: str,
+            reply_class: Type[BaseCommand]) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self._pending_replies_lock:
+            self._pending_replies[correlation_id] = _PendingReply(
+                request_type=request_type,
+                reply_type=reply_class.type(),
+                future=future,
+                registered_at=time.perf_counter())
+        return future
+
+    def unregister(self, correlation_id: str):
+        with self._pending_replies_lock:
+            self._pending_replies.pop(correlation_id, None)
+
+    def complete_reply(self, persisted_command: PersistedCommand):
+        """
+        Completes the future waiting on the given command, if it is a reply that is being waited on.
+        """
+        correlation_id = persisted_command.correlation_id
+        if correlation_id is None:
+            return
+        command_type = persisted_command.command.type()
+        with self._pending_replies_lock:
+            pending = self._pending_replies.get(correlation_id)
+            if pending is None or pending.reply_type != command_type:
+                return
+            del self._pending_replies[correlation_id]
+
+        self._metrics.observe(
+            'durapy_request_round_trip_ms', 1e3 * (time.perf_counter() - pending.registered_at),
+            labels={'type': pending.request_type, 'reply_type': command_type})
+        try:
+            pending.future.set_result(persisted_command)
+        except concurrent.futures.InvalidStateError:
+            # The waiter already gave up (e.g. cancelled on timeout)
+            pass
 
     def handle_command(self, command: _CommandT, context: Context):
-        tup: Optional[_RegisteredHandler] = \
-            only([handler for handler_clazz, handler in self._registered_handlers.items()
-                  if handler_clazz is not None and handler_clazz.type() == command.type()])
+        tup: Optional[_RegisteredHandler] = self._handlers_by_type.get(command.type())
         if tup is None:
             logging.info(f'Command type {command.type()} not mapping, ignoring. Command={command}.')
+            self._metrics.increment(
+                'durapy_commands_ignored_total', labels={'type': command.type(), 'reason': 'unmapped'})
             return
 
         if not isinstance(command, tup.command_class):
             raise ValueError(f'Mismatched type and command class - is there a duplicate?? '
                              f'command={command}, expected={tup.command_class}')
 
+        if tup.is_batch_method:
+            self.handle_batch([command], context)
+            return
+
+        instance_key = tup.instance_key(command) if tup.instance_key is not None else None
         if tup.is_controller_method:
-            if self._instance is None:
+            instance = self._instances.get(instance_key)
+            if instance is None:
                 logging.warning(f'Method for command type {command.type()} is an instance method, '
-                                f'but an instance has not been created. Did you forget to invoke or setup a method '
-                                f'with returns_instance=True? Ignoring this command.')
+                                f'but an instance has not been created{self._describe_key(instance_key)}. Did you '
+                                f'forget to invoke or setup a method with returns_instance=True? Ignoring this '
+                                f'command.')
+                self._metrics.increment(
+                    'durapy_commands_ignored_total', labels={'type': command.type(), 'reason': 'no_instance'})
                 return
 
-            tup.method(self._instance, command, context)
+            context.current_instance = instance
+            try:
+                self._invoke(tup, instance, command, context)
+            finally:
+                context.current_instance = None
             if tup.deletes_instance:
-                logging.info(f'Deleting instance {self._instance}.')
-                self._instance = None
+                logging.info(f'Deleting instance {instance}{self._describe_key(instance_key)}.')
+                del self._instances[instance_key]
+                self._metrics.set_gauge('durapy_controller_instances', len(self._instances))
         else:
-            if tup.returns_instance and self._instance is not None:
+            if tup.returns_instance and instance_key in self._instances:
                 logging.warning(f'Method for command type {command.type()} should be creating an instance, '
-                                f'but an instance is already set [{self._instance}]. Ignoring.')
+                                f'but an instance is already set [{self._instances[instance_key]}]'
+                                f'{self._describe_key(instance_key)}. Ignoring.')
+                self._metrics.increment(
+                    'durapy_commands_ignored_total', labels={'type': command.type(), 'reason': 'instance_exists'})
                 return
-            ret = tup.method(None, command, context)
+            ret = self._invoke(tup, None, command, context)
             if tup.returns_instance:
-                self._instance = ret
-                logging.info(f'Successfully created instance {self._instance}.')
+                self._instances[instance_key] = ret
+                self._metrics.set_gauge('durapy_controller_instances', len(self._instances))
+                logging.info(f'Successfully created instance {ret}{self._describe_key(instance_key)}.')
+
+    def batch_handler(self, command_type: str) -> Optional[_RegisteredHandler]:
+        """
+        Returns the handler for the given command type if it's a batch method, otherwise None.
+        """
+        tup = self._handlers_by_type.get(command_type)
+        return tup if tup is not None and tup.is_batch_method else None
+
+    def handle_batch(self, commands: List[_CommandT], context: Context):
+        """
+        Passes a list of commands, all of the same type, to that type's batch method.
+        """
+        tup = self.batch_handler(commands[0].type())
+        for command in commands:
+            if not isinstance(command, tup.command_class):
+                raise ValueError(f'Mismatched type and command class - is there a duplicate?? '
+                                 f'command={command}, expected={tup.command_class}')
+        self._invoke(tup, None, commands, context)
+        self._metrics.observe('durapy_batch_size', len(commands), labels={'type': commands[0].type()})
+
+    @staticmethod
+    def _describe_key(instance_key: Hashable) -> str:
+        return f' for key {instance_key}' if instance_key is not None else ''
+
+    def _invoke(
+            self,
+            tup: _RegisteredHandler,
+            instance: Optional[BaseController],
+            command: Any,
+            context: Context):
+        labels = {'type': tup.command_class.type()}
+        num_commands = len(command) if tup.is_batch_method else 1
+        if tup.is_async:
+            # Duration is measured by the loop once the coroutine completes
+            self._async_loop.submit(tup.method(instance, command, context), tup.command_class.type())
+            self._metrics.increment('durapy_commands_dispatched_total', labels=labels)
+            return None
+
+        start = time.perf_counter()
+        try:
+            return tup.method(instance, command, context)
+        finally:
+            self._metrics.observe('durapy_handler_duration_ms', 1e3 * (time.perf_counter() - start), labels=labels)
+            self._metrics.increment('durapy_commands_dispatched_total', num_commands, labels=labels)
 
     def handle_stop(self, context: Context):
-        if self._instance is not None:
-            self._instance.stop(context)
+        if self._async_loop is not None:
+            self._async_loop.stop()
+        # Stop every live instance, even if stopping another one fails
+        for instance_key, instance in list(self._instances.items()):
+            try:
+                instance.stop(context)
+            except Exception:
+                logging.exception(f'Failed to stop instance {instance}{self._describe_key(instance_key)}.')
+        self._instances.clear()
         tup: Optional[_RegisteredHandler] = self._registered_handlers.get(None, None)
         if tup is not None:
             if not tup.is_stop_static_method:
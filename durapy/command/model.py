@@ -1,5 +1,9 @@
 import abc
+import concurrent.futures
+import contextvars
 import dataclasses
+import time
+import uuid
 from enum import Enum
 from typing import TypeVar, List, Callable, Optional, ClassVar, Type
 
@@ -7,6 +11,16 @@ import dataclasses_json
 from dataclasses_json import DataClassJsonMixin
 
 
+class CommandPriority(Enum):
+    """
+    Priority class of a command type. HIGH priority commands (e.g. stop or abort commands) are additionally indexed in a
+    separate priority lane, which processes check before any other queued commands, so they are handled promptly even
+    if the process is catching up on a backlog.
+    """
+    NORMAL = 'NORMAL'
+    HIGH = 'HIGH'
+
+
 class BaseCommand(DataClassJsonMixin):
     """
     Base class to extend for all commands. Your command class should be a Python dataclass, containing data fields
@@ -19,6 +33,13 @@ class BaseCommand(DataClassJsonMixin):
     def type() -> str:
         ...
 
+    @staticmethod
+    def priority() -> CommandPriority:
+        """
+        Priority class of this command type. Override to return CommandPriority.HIGH for safety-critical commands.
+        """
+        return CommandPriority.NORMAL
+
 
 def oneof_class(clazz_name: str, values: List[str]):
     """
@@ -58,6 +79,87 @@ class PersistedCommand(DataClassJsonMixin):
     # Timestamp in milliseconds since the Unix epoch.
     timestamp_ms: int
 
+    # Identifier shared by a request sent via Context#send_and_wait and any commands sent while handling it, so replies
+    # can be matched to their request.
+    correlation_id: Optional[str] = None
+
+    # Key of the command that was being handled when this command was sent, if any. Links commands into causal chains;
+    # see durapy.command.tracing.
+    parent_key: Optional[str] = None
+
+
+# The persisted command currently being handled in this thread (or asyncio task), if any. Set by the ProcessRunner
+# around each dispatch.
+_current_command: contextvars.ContextVar[Optional[PersistedCommand]] = \
+    contextvars.ContextVar('durapy_current_command', default=None)
+
+
+class _ReplyRegistry(abc.ABC):
+    """
+    Internal interface for registering futures that are completed once a reply with a given correlation ID arrives.
+    See Context#send_and_wait.
+    """
+    @abc.abstractmethod
+    def register(
+            self,
+            correlation_id: str,
+            request_type: str,
+            reply_class: Type[BaseCommand]) -> concurrent.futures.Future:
+        ...
+
+    @abc.abstractmethod
+    def unregister(self, correlation_id: str):
+        ...
+
+
+@dataclasses.dataclass
+class ScheduledCommand:
+    """
+    A command held by a command database for delayed delivery (see Context#schedule_command). It is sent, and so gets
+    its key and timestamp, once it is due.
+    """
+
+    # Unique ID of this delayed delivery.
+    schedule_id: str
+
+    command: BaseCommand
+
+    # Time at which the command is due to be sent, in milliseconds since the Unix epoch.
+    at_ms: int
+
+
+class ScheduledHandle(abc.ABC):
+    """
+    Handle to a command scheduled via Context#schedule_command or Context#every.
+    """
+    @abc.abstractmethod
+    def cancel(self) -> bool:
+        """
+        Cancels any future sends. Returns False if there was nothing left to cancel, i.e. a one-off command was already
+        sent or the schedule was already cancelled.
+        """
+        ...
+
+    @abc.abstractmethod
+    def next_at_ms(self) -> Optional[int]:
+        """
+        Time of the next send in milliseconds since the Unix epoch, or None if nothing further will be sent.
+        """
+        ...
+
+
+class _Scheduler(abc.ABC):
+    """
+    Internal interface for scheduling commands to be sent at a later time. See Context#schedule_command.
+    """
+    @abc.abstractmethod
+    def schedule(
+            self,
+            command_factory: Callable[[], BaseCommand],
+            at_ms: float,
+            period_ms: Optional[float] = None) -> ScheduledHandle:
+        ...
+
 
 class BaseController(abc.ABC):
     """
@@ -94,8 +196,9 @@ class Context:
     lifecycle and passed to any methods responding to commands.
     """
 
-    # Callable that sends a command. Used via #send_command(...)
-    _command_sender: Callable[[BaseCommand], PersistedCommand]
+    # Callable that sends a command, optionally stamped with a correlation ID and parent key. Used via
+    # #send_command(...)
+    _command_sender: Callable[..., PersistedCommand]
 
     # Current key of the command being processed.
     command_key: Optional[str] = None
@@ -109,8 +212,106 @@ class Context:
     # A list of persisted commands processed by this process, in *ascending* order (i.e. the first command is first).
     past_commands: List[PersistedCommand] = dataclasses.field(default_factory=list)
 
+    # Registry of pending replies, used by #send_and_wait. Only set for contexts created by a ProcessRunner.
+    _reply_registry: Optional[_ReplyRegistry] = None
+
+    # Timer used by #schedule_command and #every. Only set for contexts created by a ProcessRunner.
+    _scheduler: Optional[_Scheduler] = None
+
     def send_command(self, command: BaseCommand) -> PersistedCommand:
-        return self._command_sender(command)
+        """
+        Sends a command. If called while handling a command, the sent command records that command's key as its
+        parent; and if that command is part of a request (see #send_and_wait), the sent command carries the same
+        correlation ID, so that it can be matched as that request's reply.
+        """
+        current = _current_command.get()
+        correlation_id = current.correlation_id if current is not None else None
+        return self._send(command, correlation_id)
+
+    def send_and_wait(
+            self,
+            command: BaseCommand,
+            reply_type: Type[BaseCommand],
+            timeout_s: float) -> PersistedCommand:
+        """
+        Sends a command and blocks until a command of type `reply_type` is sent in response to it, i.e. while a
+        handler (in any process) is handling the sent command. Returns the reply, or raises TimeoutError if no reply
+        arrives within `timeout_s` seconds.
+
+        Replies are delivered by this process's command loop, so this must not be called from within a command
+        handler (which would block that loop); call it from another thread, or use #send_and_wait_async.
+        """
+        if _current_command.get() is not None:
+            raise RuntimeError('send_and_wait cannot be called while handling a command, as it would block the '
+                               'command loop that delivers the reply. Use send_and_wait_async or another thread.')
+        correlation_id, future = self._register_reply(command, reply_type)
+        try:
+            self._send(command, correlation_id)
+            return future.result(timeout=timeout_s)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError(f'No reply of type {reply_type.type()} to {command.type()} within {timeout_s}s.')
+        finally:
+            self._reply_registry.unregister(correlation_id)
+
+    async def send_and_wait_async(
+            self,
+            command: BaseCommand,
+            reply_type: Type[BaseCommand],
+            timeout_s: float) -> PersistedCommand:
+        """
+        Asyncio variant of #send_and_wait. Can be awaited from any event loop, including from asynchronous command
+        handlers.
+        """
+        # Imported here, as asyncio is slow to import and only processes with coroutines need it
+        import asyncio
+        correlation_id, future = self._register_reply(command, reply_type)
+        try:
+            self._send(command, correlation_id)
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout_s)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'No reply of type {reply_type.type()} to {command.type()} within {timeout_s}s.')
+        finally:
+            self._reply_registry.unregister(correlation_id)
+
+    def schedule_command(self, command: BaseCommand, at_ms: float) -> ScheduledHandle:
+        """
+        Sends a command at the given time, in milliseconds since the Unix epoch. Times in the past send the command as
+        soon as possible. Returns a handle that can be used to cancel the send.
+        """
+        return self._get_scheduler().schedule(lambda: command, at_ms)
+
+    def every(
+            self,
+            period_ms: float,
+            command_factory: Callable[[], BaseCommand],
+            start_at_ms: Optional[float] = None) -> ScheduledHandle:
+        """
+        Sends the command returned by `command_factory` every `period_ms` milliseconds, starting at `start_at_ms` (or
+        one period from now), until cancelled via the returned handle. Deadlines are computed from the start time
+        rather than from the previous send, so the schedule does not drift; if sends fall more than a period behind,
+        the missed ones are skipped.
+        """
+        if period_ms <= 0:
+            raise ValueError(f'Period must be positive; got {period_ms}ms.')
+        if start_at_ms is None:
+            start_at_ms = time.time() * 1e3 + period_ms
+        return self._get_scheduler().schedule(command_factory, start_at_ms, period_ms=period_ms)
+
+    def _send(self, command: BaseCommand, correlation_id: Optional[str]) -> PersistedCommand:
+        current = _current_command.get()
+        parent_key = current.key if current is not None else None
+        return self._command_sender(command, correlation_id=correlation_id, parent_key=parent_key)
+
+    def _get_scheduler(self) -> _Scheduler:
+        if self._scheduler is None:
+            raise RuntimeError('This context cannot schedule commands, as it is not attached to a ProcessRunner.')
+        return self._scheduler
+
+    def _register_reply(self, command: BaseCommand, reply_type: Type[BaseCommand]):
+        if self._reply_registry is None:
+            raise RuntimeError('This context cannot wait for replies, as it is not attached to a ProcessRunner.')
+        correlation_id = str(uuid.uuid4())
+        return correlation_id, self._reply_registry.register(correlation_id, command.type(), reply_type)
 
 
 class LifecycleListener(abc.ABC):
@@ -125,3 +326,15 @@ class LifecycleListener(abc.ABC):
     @abc.abstractmethod
     def on_heartbeat(self):
         pass
+
+    def on_unhealthy(self, reason: str):
+        """
+        Called when the process is alive but unhealthy, e.g. a handler has exceeded its time budget.
+        """
+        pass
+
+    def on_healthy(self):
+        """
+        Called when a process previously marked unhealthy has recovered.
+        """
+        pass
@@ -1,13 +1,54 @@
+import collections
+import dataclasses
 import logging
+import os
 import signal
+import threading
+import time
 import traceback
+import typing
+from typing import Optional, List, Deque, Dict, Hashable, Tuple, Type, Callable, Any
 
 from durapy.backends.base import CommandDatabase
-from durapy.command._logging import log_to_stdout, log_to_file, log_to_fluentd
-from durapy.command.command import CommandRegistry, _RegisteredHandler, _CommandListener, _CommandT
-from durapy.command.model import PersistedCommand, Context
+from durapy.command._heartbeat import _Heartbeater
+from durapy.command._scheduler import _CommandScheduler
+from durapy.command._watchdog import _Watchdog
+from durapy.command._logging import log_to_stdout, log_to_file, log_to_fluentd, log_to_aggregator, flush_logs, \
+    CommandLogSampler
+from durapy.command.builtin import StartProfilerCommand, StopProfilerCommand, MemoryDiagnosticsCommand, \
+    with_builtin_command_classes
+from durapy.command.command import CommandRegistry, _RegisteredHandler, _CommandListener, _CommandT, StalenessPolicy
+from durapy.command.model import BaseCommand, PersistedCommand, Context, LifecycleListener, _current_command
+from durapy.command.threading import LoggingThread
 from durapy.config import Configuration
-from durapy.deploy.status.status import ProcessStatusDatabase
+from durapy.metrics.base import MetricsSink
+from durapy.metrics.memory import InMemoryMetricsSink
+
+if typing.TYPE_CHECKING:
+    from durapy.command._memory import _MemoryDiagnostics
+    from durapy.command._profiler import _Profiler
+
+
+# Bound on how many locally-delivered keys are remembered while waiting for them to come back from the database.
+_MAX_LOCALLY_DELIVERED_KEYS = 10000
+
+# Written to the signal pipe (see ProcessRunner#_on_stop_signal)
+_STOP_SIGNALLED = b's'
+_RUN_FINISHED = b'f'
+
+
+@dataclasses.dataclass
+class ConsumerLag:
+    """
+    How far behind the head of the command stream a process is.
+    """
+
+    # Number of commands persisted but not yet dispatched by this process, or None if the backend cannot tell.
+    commands: Optional[int]
+
+    # Age (now minus the command database's timestamp) of the most recently dispatched command at dispatch time, in
+    # milliseconds. None if no command has been dispatched yet.
+    age_ms: Optional[float]
 
 
 class ProcessRunner:
@@ -29,91 +70,487 @@ class ProcessRunner:
                  configuration: Configuration,
                  process_name: str,
                  command_registry: CommandRegistry,
-                 override_signal_handlers: bool = True):
+                 override_signal_handlers: bool = True,
+                 heartbeat_interval_s: float = 5.0,
+                 stall_timeout_s: float = 60.0,
+                 metrics_sink: Optional[MetricsSink] = None,
+                 metrics_port: Optional[int] = None,
+                 fetch_batch_size: int = 32,
+                 priority_poll_interval_ms: float = 10.0,
+                 local_delivery: bool = True,
+                 fetch_timeout_ms: int = 10000,
+                 shared_schedule: bool = False,
+                 handler_budget_s: Optional[float] = None,
+                 mark_unhealthy_on_overrun: bool = False,
+                 on_fetched: Optional[Callable[[List[PersistedCommand]], None]] = None):
+        """
+        @param heartbeat_interval_s: interval at which heartbeats are marked in the lifecycle database, if configured.
+        Heartbeats are written from a background thread, so they never block command processing.
+        @param stall_timeout_s: if a single command takes longer than this to process, the process is considered
+        stalled and heartbeats are withheld until processing returns.
+        @param metrics_sink: where to record runner metrics (fetch latency, dispatch lag, handler durations, etc.).
+        Defaults to an InMemoryMetricsSink.
+        @param metrics_port: if given, serves this process's metrics in the Prometheus text format at
+        http://<host>:<metrics_port>/metrics. Requires an InMemoryMetricsSink.
+        @param fetch_batch_size: maximum number of commands fetched from the command database at once when catching
+        up on a backlog. Staleness policies (see CommandRegistry#register_staleness_policy) coalesce within a batch.
+        @param priority_poll_interval_ms: while working through fetched commands, how often to check the command
+        database's priority lane for HIGH priority commands, which then jump ahead of everything already fetched.
+        @param local_delivery: if True, commands sent from within this process's handlers that this process also
+        handles are dispatched directly to its handlers, rather than waiting for them to round-trip through the
+        command database. Such commands are handled once, right after the current command, ahead of any other
+        already-fetched commands. Commands sent from other threads always go through the command database.
+        @param fetch_timeout_ms: how long to block waiting for new commands. Stopping the process (and other in-process
+        events) wake up a blocked fetch immediately, so this can be long.
+        @param shared_schedule: if True, one-off commands scheduled via Context#schedule_command are also kept in the
+        command database's shared schedule, so they are visible to other processes (e.g. in the webserver) and are
+        still sent if this process stops before they are due. This process then also sends any overdue commands it
+        finds in the shared schedule.
+        @param handler_budget_s: how long a single command is expected to take to handle at most; per-type budgets can
+        be set via CommandRegistry#register_handler_budget. If a handler runs over its budget, a watchdog thread dumps
+        the stacks of all threads to the log and counts it in durapy_handler_overruns_total. Without any budgets,
+        there's no watchdog.
+        @param mark_unhealthy_on_overrun: if True, while a handler is over its budget the process is also marked
+        unhealthy in the lifecycle database, if configured.
+        @param on_fetched: called from the command loop's thread with every batch of commands fetched from the command
+        database, before any are coalesced, expired or otherwise dropped. Lets others observe the stream without
+        tailing it separately, e.g. the webserver's live command stream.
+        """
         log_to_stdout()
         log_to_file(process_name)
+        self._fetch_log_sampler = CommandLogSampler()
         if configuration.fluentd is not None:
             self._fluentd_handler = log_to_fluentd(
                 process_name, configuration.fluentd.hostname, configuration.fluentd.port)
         else:
             self._fluentd_handler = None
+        if configuration.log_aggregator is not None:
+            log_to_aggregator(process_name, configuration.log_aggregator.hostname, configuration.log_aggregator.port)
 
         self._process_name = process_name
+        self._metrics = metrics_sink if metrics_sink is not None else InMemoryMetricsSink()
+        if metrics_port is not None and not isinstance(self._metrics, InMemoryMetricsSink):
+            raise ValueError(f'Serving metrics requires an InMemoryMetricsSink; got {self._metrics}.')
+        # Served from #run(), which also shuts it down
+        self._metrics_port = metrics_port
+        self._metrics_server = None
 
-        # Fill in no-ops for all command classes
+        # Built-in control commands, unless overridden by the registry
         registered_handlers = command_registry._get_registered_handlers()
-        for clazz in configuration.command_classes:
+        self._handled_types = {clazz.type() for clazz in registered_handlers if clazz is not None}
+        # Created when first used, so processes that are never profiled or diagnosed don't pay for importing them
+        self._profiler: Optional['_Profiler'] = None
+        self._memory: Optional['_MemoryDiagnostics'] = None
+        self._command_classes = configuration.command_classes
+        for clazz, method in self._builtin_handlers().items():
+            if clazz.type() in self._handled_types:
+                continue
+            registered_handlers[clazz] = _RegisteredHandler(
+                command_class=clazz,
+                method=method,
+                is_controller_method=False,
+                returns_instance=False,
+                deletes_instance=False,
+                is_stop_static_method=False,
+            )
+
+        # Fill in no-ops for all command classes
+        for clazz in with_builtin_command_classes(configuration.command_classes):
             if clazz in registered_handlers:
                 continue
             registered_handlers[clazz] = _RegisteredHandler(
                 command_class=clazz,
-                method=lambda *args, clazz_type=clazz.type(), **kwargs: logging.info(f'Ignoring command of type {clazz_type}.'),
+                method=lambda *args, clazz_type=clazz.type(), **kwargs: self._ignore_command(clazz_type),
                 is_controller_method=False,
                 returns_instance=False,
                 deletes_instance=False,
                 is_stop_static_method=False,
             )
 
+        # Only spin up an event loop if there are coroutine handlers to run on it
+        if any(h.is_async for h in registered_handlers.values()):
+            # Imported here, as asyncio is slow to import and most processes have no coroutine handlers
+            from durapy.command._async import _AsyncHandlerLoop
+            async_loop = _AsyncHandlerLoop(process_name, self._metrics)
+        else:
+            async_loop = None
         self._command_listener = _CommandListener(
             configuration=configuration,
-            registered_handlers=registered_handlers
+            registered_handlers=registered_handlers,
+            metrics_sink=self._metrics,
+            async_loop=async_loop,
         )
+        self._staleness_policies: Dict[str, StalenessPolicy] = {
+            clazz.type(): policy for clazz, policy in command_registry._get_staleness_policies().items()}
         registered_command_classes = [h.command_class for h in registered_handlers.values()]
         self._command_db: CommandDatabase = configuration.command_db_factory.create(
             configuration.command_prefix, registered_command_classes)
 
         self.is_stopped = False
+        self._fetch_batch_size = fetch_batch_size
+        self._fetch_timeout_ms = fetch_timeout_ms
+        self._priority_poll_interval_s = priority_poll_interval_ms / 1e3
+        self._last_priority_poll = 0.0
+        self._pending: Deque[PersistedCommand] = collections.deque()
+        self._on_fetched = on_fetched
+        self._backlog_at_fetch: Optional[int] = 0
+        self._last_dispatch_age_ms: Optional[float] = None
+
+        # Commands sent from the command loop's thread that are dispatched locally, and the keys of those that have
+        # been delivered locally but not yet seen come back from the command database. Only touched by the command
+        # loop's thread, which avoids racing with the fetches that dedupe them.
+        self._local_delivery = local_delivery
+        self._run_thread_ident: Optional[int] = None
+        self._local_deliveries: List[PersistedCommand] = []
+        self._locally_delivered_keys: 'collections.OrderedDict[str, None]' = collections.OrderedDict()
 
+        if shared_schedule and not self._command_db.supports_shared_schedule():
+            raise ValueError(f'shared_schedule requires a command database with a shared schedule, which '
+                             f'{type(self._command_db).__name__} does not have.')
+        self._shared_schedule = shared_schedule
+        self._scheduler = _CommandScheduler(
+            process_name=process_name,
+            command_sender=self.send_command,
+            metrics_sink=self._metrics,
+            command_db=self._command_db if shared_schedule else None)
+
+        self._lifecycle_listener: Optional[LifecycleListener] = None
         if configuration.deploy is not None and configuration.deploy.lifecycle_database_configuration is not None:
+            # Imported here, as it pulls in sqlalchemy, which processes without a lifecycle database don't need
+            from durapy.deploy.status.status import ProcessStatusDatabase
             self._lifecycle_listener = ProcessStatusDatabase(
                 process_name, configuration.deploy.lifecycle_database_configuration)
-        else:
-            self._lifecycle_listener = None
+        self._heartbeat_interval_s = heartbeat_interval_s
+        self._stall_timeout_s = stall_timeout_s
+        self._heartbeater: Optional[_Heartbeater] = None
 
+        handler_budgets_s = {clazz.type(): budget_s
+                             for clazz, budget_s in command_registry._get_handler_budgets_s().items()}
+        self._mark_unhealthy_on_overrun = mark_unhealthy_on_overrun and self._lifecycle_listener is not None
+        self._watchdog: Optional[_Watchdog] = None
+        if handler_budget_s is not None or len(handler_budgets_s) > 0:
+            self._watchdog = _Watchdog(
+                process_name=process_name,
+                metrics_sink=self._metrics,
+                budgets_s=handler_budgets_s,
+                default_budget_s=handler_budget_s,
+                lifecycle_listener=self._lifecycle_listener if self._mark_unhealthy_on_overrun else None)
+
+        # Waking up the command loop can take locks that whatever the signal interrupted holds, so signal handlers only
+        # write to a pipe, which a thread started by #run() watches to stop the process.
+        self._signal_pipe: Optional[Tuple[int, int]] = None
+        self._signal_thread: Optional[LoggingThread] = None
         if override_signal_handlers:
-            signal.signal(signal.SIGINT, self.stop)
-            signal.signal(signal.SIGTERM, self.stop)
+            self._signal_pipe = os.pipe()
+            signal.signal(signal.SIGINT, self._on_stop_signal)
+            signal.signal(signal.SIGTERM, self._on_stop_signal)
+
+    def _builtin_handlers(self) -> Dict[Type[BaseCommand], Callable[[Any, Any, Context], Any]]:
+        def _for_this_process(method: Callable[[Any, Context], Any]):
+            def _method(_, command, context: Context):
+                if command.process_name == self._process_name:
+                    method(command, context)
+            return _method
+
+        return {
+            StartProfilerCommand: _for_this_process(self._start_profiler),
+            StopProfilerCommand: _for_this_process(lambda *_: self._stop_profiler()),
+            MemoryDiagnosticsCommand: _for_this_process(self._handle_memory_diagnostics),
+        }
+
+    def _start_profiler(self, command: StartProfilerCommand, context: Context):
+        if self._profiler is None:
+            from durapy.command._profiler import _Profiler
+            self._profiler = _Profiler(self._process_name, self.send_command, self.wakeup)
+        self._profiler.start(command)
+
+    def _stop_profiler(self):
+        if self._profiler is not None:
+            self._profiler.stop()
+
+    def _handle_memory_diagnostics(self, command: MemoryDiagnosticsCommand, context: Context):
+        if self._memory is None:
+            from durapy.command._memory import _MemoryDiagnostics
+            self._memory = _MemoryDiagnostics(self._process_name, self.send_command, self._command_classes)
+        self._memory.handle(command, context)
 
     def stop(self, signum=None, frame=None):
         logging.info("BMI process {} received stop signal.".format(self._process_name))
         self.is_stopped = True
+        self.wakeup()
+
+    def _on_stop_signal(self, signum=None, frame=None):
+        self.is_stopped = True
+        os.write(self._signal_pipe[1], _STOP_SIGNALLED)
+
+    def _stop_on_signal(self):
+        while os.read(self._signal_pipe[0], 1) == _STOP_SIGNALLED:
+            self.stop()
+
+    def wakeup(self):
+        """
+        Wakes up the command loop if it's blocked waiting for commands. Safe to call from any thread, but not from a
+        signal handler.
+        """
+        self._command_db.wakeup()
+
+    def is_stalled(self) -> bool:
+        """
+        Whether the command loop is currently stuck processing a single command for longer than the stall timeout.
+        Only tracked if a lifecycle database is configured.
+        """
+        return self._heartbeater is not None and self._heartbeater.stalled_for_s() is not None
+
+    def lag(self) -> ConsumerLag:
+        """
+        Returns how far behind the head of the command stream this process currently is.
+        """
+        backlog = self._backlog_at_fetch
+        return ConsumerLag(
+            commands=backlog + len(self._pending) if backlog is not None else None,
+            age_ms=self._last_dispatch_age_ms)
+
+    def metrics(self) -> MetricsSink:
+        return self._metrics
+
+    def send_command(
+            self,
+            command: _CommandT,
+            correlation_id: Optional[str] = None,
+            parent_key: Optional[str] = None) -> PersistedCommand:
+        start = time.perf_counter()
+        try:
+            persisted = self._command_db.send_command(command, correlation_id=correlation_id, parent_key=parent_key)
+        finally:
+            self._metrics.observe('durapy_send_command_latency_ms', 1e3 * (time.perf_counter() - start),
+                                  labels={'type': command.type()})
+
+        if self._local_delivery and \
+                command.type() in self._handled_types and \
+                threading.get_ident() == self._run_thread_ident:
+            self._locally_delivered_keys[persisted.key] = None
+            if len(self._locally_delivered_keys) > _MAX_LOCALLY_DELIVERED_KEYS:
+                self._locally_delivered_keys.popitem(last=False)
+            self._local_deliveries.append(persisted)
+            self._metrics.increment('durapy_commands_delivered_locally_total', labels={'type': command.type()})
+        return persisted
+
+    def _without_locally_delivered(self, fetched: List[PersistedCommand]) -> List[PersistedCommand]:
+        """
+        Filters out commands that were already dispatched via local delivery.
+        """
+        if len(self._locally_delivered_keys) == 0:
+            return fetched
+        ret = []
+        for persisted in fetched:
+            if persisted.key in self._locally_delivered_keys:
+                del self._locally_delivered_keys[persisted.key]
+            else:
+                ret.append(persisted)
+        return ret
+
+    def _complete_replies(self, commands: List[PersistedCommand]):
+        """
+        Completes any requests (see Context#send_and_wait) waiting on the given commands. Done as soon as commands are
+        fetched, so that a reply that is later dropped by its type's staleness policy still reaches its waiter.
+        """
+        for persisted in commands:
+            self._command_listener.complete_reply(persisted)
+
+    def _ignore_command(self, command_type: str):
+        logging.info(f'Ignoring command of type {command_type}.')
+        self._metrics.increment(
+            'durapy_commands_ignored_total', labels={'type': command_type, 'reason': 'unregistered'})
 
-    def send_command(self, command: _CommandT) -> PersistedCommand:
-        return self._command_db.send_command(command)
+    def _coalesce(self, fetched: List[PersistedCommand]) -> List[PersistedCommand]:
+        """
+        Applies coalescing staleness policies to a freshly-fetched batch, keeping only the latest command per coalesce
+        key for those command types. Relative order of the remaining commands is preserved. Commands that are part of a
+        request (see Context#send_and_wait) are never coalesced.
+        """
+        latest: Dict[Tuple[str, Hashable], int] = {}
+        for idx, persisted in enumerate(fetched):
+            policy = self._staleness_policy(persisted)
+            if policy is not None and policy.coalesce:
+                latest[self._coalesce_key(persisted, policy)] = idx
+        if len(latest) == 0:
+            return fetched
+
+        ret = []
+        for idx, persisted in enumerate(fetched):
+            policy = self._staleness_policy(persisted)
+            if policy is not None and policy.coalesce and latest[self._coalesce_key(persisted, policy)] != idx:
+                self._metrics.increment(
+                    'durapy_commands_dropped_total', labels={'type': persisted.command.type(), 'reason': 'coalesced'})
+                continue
+            ret.append(persisted)
+        return ret
+
+    def _staleness_policy(self, persisted: PersistedCommand) -> Optional[StalenessPolicy]:
+        # Dropping part of a request would leave whoever sent it waiting until they time out
+        if persisted.correlation_id is not None:
+            return None
+        return self._staleness_policies.get(persisted.command.type())
+
+    @staticmethod
+    def _coalesce_key(persisted: PersistedCommand, policy: StalenessPolicy) -> Tuple[str, Hashable]:
+        key = policy.coalesce_key(persisted.command) if policy.coalesce_key is not None else None
+        return persisted.command.type(), key
+
+    def _record_lag(self, age_ms: float):
+        self._last_dispatch_age_ms = age_ms
+        self._metrics.set_gauge('durapy_consumer_lag_ms', age_ms)
+        if self._backlog_at_fetch is not None:
+            self._metrics.set_gauge('durapy_consumer_lag_commands', self._backlog_at_fetch + len(self._pending))
+
+    def _accept(self, command: PersistedCommand) -> bool:
+        """
+        Records lag for a command about to be dispatched, and returns whether it should be dispatched (i.e. it hasn't
+        exceeded its type's TTL). Commands that are part of a request are never dropped.
+        """
+        age_ms = time.time() * 1e3 - command.timestamp_ms
+        self._record_lag(age_ms)
+        policy = self._staleness_policy(command)
+        if policy is not None and policy.ttl_ms is not None and age_ms > policy.ttl_ms:
+            logging.info(f'[Process {self._process_name}] Dropping command {command.key} of type '
+                         f'{command.command.type()}: {age_ms:.0f}ms old, exceeds TTL of {policy.ttl_ms}ms.')
+            self._metrics.increment(
+                'durapy_commands_dropped_total', labels={'type': command.command.type(), 'reason': 'expired'})
+            return False
+        self._metrics.observe('durapy_dispatch_lag_ms', age_ms, labels={'type': command.command.type()})
+        return True
 
     def run(self):
         logging.info("Beginning process {}".format(self._process_name))
+        # Started before anything else, so that failing to bind the port doesn't leave threads running
+        if self._metrics_port is not None:
+            from durapy.metrics.prometheus import serve_metrics
+            self._metrics_server = serve_metrics(self._metrics, self._metrics_port)
 
         if self._lifecycle_listener is not None:
             self._lifecycle_listener.on_started_up()
+            self._heartbeater = _Heartbeater(
+                process_name=self._process_name,
+                lifecycle_listener=self._lifecycle_listener,
+                metrics_sink=self._metrics,
+                interval_s=self._heartbeat_interval_s,
+                stall_timeout_s=self._stall_timeout_s)
+            self._heartbeater.start()
+        if self._watchdog is not None:
+            self._watchdog.reset_health()
+            self._watchdog.start()
+
+        if self._signal_pipe is not None:
+            self._signal_thread = LoggingThread(
+                target=self._stop_on_signal, name=f'{self._process_name}-signals', daemon=True)
+            self._signal_thread.start()
 
-        context = Context(_command_sender=self._command_db.send_command)
+        if self._shared_schedule:
+            # Start polling the shared schedule right away, rather than once something is first scheduled
+            self._scheduler.start()
+
+        self._run_thread_ident = threading.get_ident()
+        context = Context(
+            _command_sender=self.send_command,
+            _reply_registry=self._command_listener,
+            _scheduler=self._scheduler)
         print_idx = 0
         try:
             while not self.is_stopped:
-                if self._lifecycle_listener is not None:
-                    try:
-                        self._lifecycle_listener.on_heartbeat()
-                    except Exception as e:
-                        logging.warning('Marking heartbeat failed, hopefully transient error. Continuing. '
-                                        'exception={}'.format(e))
-
-                command = self._command_db.fetch_next(1000)
-                if command is None:
-                    print_idx += 1
-                    if print_idx < 10:
-                        logging.info("[Process {}] No commands found to process.".format(self._process_name))
-                    elif print_idx == 10:
-                        logging.info(
-                            "[Process {}] No commands found to process. Not printing anymore.".format(
-                                self._process_name))
+                if self._profiler is not None:
+                    self._profiler.poll()
+
+                # Commands sent by the previous handler go first, in the order they were sent.
+                if len(self._local_deliveries) > 0:
+                    self._complete_replies(self._local_deliveries)
+                    self._pending.extendleft(reversed(self._local_deliveries))
+                    self._local_deliveries = []
+
+                if len(self._pending) == 0:
+                    fetch_start = time.perf_counter()
+                    fetched = self._command_db.fetch_next_batch(self._fetch_timeout_ms, self._fetch_batch_size)
+                    self._metrics.observe('durapy_fetch_latency_ms', 1e3 * (time.perf_counter() - fetch_start),
+                                          labels={'result': 'empty' if len(fetched) == 0 else 'command'})
+                    if len(fetched) == 0:
+                        print_idx += 1
+                        if print_idx < 10:
+                            logging.info("[Process {}] No commands found to process.".format(self._process_name))
+                        elif print_idx == 10:
+                            logging.info(
+                                "[Process {}] No commands found to process. Not printing anymore.".format(
+                                    self._process_name))
+                        continue
+                    if self._on_fetched is not None:
+                        self._on_fetched(fetched)
+
+                    # A partial batch means we've caught up to the head of the stream, so skip asking the backend.
+                    if len(fetched) < self._fetch_batch_size:
+                        self._backlog_at_fetch = 0
+                    else:
+                        self._backlog_at_fetch = self._command_db.backlog_size()
+                    self._complete_replies(fetched)
+                    self._pending.extend(self._coalesce(self._without_locally_delivered(fetched)))
+                    self._last_priority_poll = time.monotonic()
+                    if len(self._pending) == 0:
+                        continue
+                elif time.monotonic() - self._last_priority_poll >= self._priority_poll_interval_s:
+                    # Still working through a backlog; let any HIGH priority commands jump the queue.
+                    priority = self._command_db.fetch_priority(self._fetch_batch_size)
+                    if self._on_fetched is not None and len(priority) > 0:
+                        self._on_fetched(priority)
+                    self._complete_replies(priority)
+                    self._pending.extendleft(reversed(self._without_locally_delivered(priority)))
+                    self._last_priority_poll = time.monotonic()
+
+                command = self._pending.popleft()
+                if not self._accept(command):
                     continue
 
-                logging.info("[Process {}] Fetched command: {}".format(self._process_name, command))
+                # Batch methods also take any directly following commands of the same type that were already fetched.
+                # Commands that are part of a request (see Context#send_and_wait) are dispatched on their own, so that
+                # whatever is sent while handling them is matched to that request.
+                batch = [command]
+                batch_handler = self._command_listener.batch_handler(command.command.type())
+                if batch_handler is not None and command.correlation_id is None:
+                    max_batch_size = batch_handler.max_batch_size or self._fetch_batch_size
+                    while len(batch) < max_batch_size and len(self._pending) > 0 and \
+                            self._pending[0].command.type() == command.command.type() and \
+                            self._pending[0].correlation_id is None:
+                        next_command = self._pending.popleft()
+                        if self._accept(next_command):
+                            batch.append(next_command)
+
+                n = self._fetch_log_sampler.sample(command.command.type())
+                if n is not None and len(batch) == 1:
+                    logging.info('[Process %s] Fetched command (#%d of its type): %s', self._process_name, n, command)
+                elif n is not None:
+                    logging.info('[Process %s] Fetched batch of %d commands of type %s (#%d of its type): %s to %s',
+                                 self._process_name, len(batch), command.command.type(), n, batch[0].key,
+                                 batch[-1].key)
+                command = batch[-1]
                 context.command_key = command.key
                 context.command_timestamp_ms = command.timestamp_ms
-                self._command_listener.handle_command(command.command, context)
-                context.past_commands.append(command)
+                if self._heartbeater is not None:
+                    self._heartbeater.on_dispatch_started()
+                if self._watchdog is not None:
+                    self._watchdog.on_dispatch_started(command.command.type())
+                if self._profiler is not None:
+                    self._profiler.on_dispatch_started()
+                token = _current_command.set(command)
+                try:
+                    if batch_handler is not None:
+                        self._command_listener.handle_batch([p.command for p in batch], context)
+                    else:
+                        self._command_listener.handle_command(command.command, context)
+                finally:
+                    _current_command.reset(token)
+                    if self._profiler is not None:
+                        self._profiler.on_dispatch_finished()
+                    if self._heartbeater is not None:
+                        self._heartbeater.on_dispatch_finished()
+                    if self._watchdog is not None:
+                        self._watchdog.on_dispatch_finished()
+                context.past_commands.extend(batch)
             # Fall through to `finally` block, where handle_stop() is called.
         except Exception as e:
             logging.error('ProcessRunner [process {}] caught exception: {}. Traceback:'.format(self._process_name, e))
@@ -128,6 +565,23 @@ class ProcessRunner:
                 # Always execute #handle_stop(), even if the above calls throw exceptions.
                 logging.info('ProcessRunner [process {}] stopped.'.format(self._process_name))
             finally:
+                self._stop_profiler()
+                self._scheduler.stop()
+                if self._heartbeater is not None:
+                    self._heartbeater.stop()
+                if self._watchdog is not None:
+                    self._watchdog.stop()
+                if self._signal_thread is not None:
+                    os.write(self._signal_pipe[1], _RUN_FINISHED)
+                    self._signal_thread.join()
+                    self._signal_thread = None
+                if self._metrics_server is not None:
+                    self._metrics_server.shutdown()
+                    self._metrics_server.server_close()
+                    self._metrics_server = None
+                self._command_db.close()
+
                 # Always execute #close() here, even if the above throw exceptions
                 if self._fluentd_handler is not None:
                     self._fluentd_handler.close()
+                flush_logs()
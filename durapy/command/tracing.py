@@ -0,0 +1,117 @@
+"""
+Causal chains of commands. Every command sent via Context#send_command while handling another command records that
+command's key as its parent, so commands that trigger one another (e.g. a PING handled in one process sending a PONG
+that is handled in another) form a tree, rooted at the command that started it. This module rebuilds such trees from
+the command history, along with the latency of each hop.
+"""
+import dataclasses
+from typing import Dict, List, Optional
+
+from durapy.backends.base import CommandDatabase
+from durapy.command.model import PersistedCommand
+
+
+@dataclasses.dataclass
+class TraceHop:
+    persisted_command: PersistedCommand
+
+    # Number of hops from the root of the trace; 0 for the root itself.
+    depth: int
+
+    # Time between the parent command being sent and this command being sent, according to the command database's
+    # timestamps. This spans the parent's time in the stream, its handler, and this command being sent. None for the
+    # root.
+    latency_ms: Optional[int] = None
+
+    # Key of the parent command, or None for the root.
+    parent_key: Optional[str] = None
+
+
+@dataclasses.dataclass
+class Trace:
+    # The command that started the chain, i.e. the earliest ancestor that could be found.
+    root_key: str
+
+    # Commands in the trace, in the order they were sent. Every command comes after its parent.
+    hops: List[TraceHop]
+
+    # Whether the trace may be missing commands, because the scan of the history stopped early.
+    truncated: bool = False
+
+    def hop(self, key: str) -> Optional[TraceHop]:
+        return next((h for h in self.hops if h.persisted_command.key == key), None)
+
+    def path_to(self, key: str) -> List[TraceHop]:
+        """
+        The hops from the root to the command with the given key, inclusive, or an empty list if it isn't in the trace.
+        """
+        by_key = {h.persisted_command.key: h for h in self.hops}
+        path = []
+        hop = by_key.get(key)
+        while hop is not None:
+            path.append(hop)
+            hop = by_key.get(hop.parent_key) if hop.parent_key is not None else None
+        return path[::-1]
+
+    def total_latency_ms(self) -> int:
+        """
+        Time between the root command and the last command in the trace being sent.
+        """
+        return self.hops[-1].persisted_command.timestamp_ms - self.hops[0].persisted_command.timestamp_ms
+
+
+def fetch_trace(
+        command_db: CommandDatabase,
+        key: str,
+        max_commands: int = 1000,
+        max_duration_ms: int = 60 * 1000,
+        page_size: int = 100) -> Optional[Trace]:
+    """
+    Rebuilds the trace containing the command with the given key, or returns None if there is no such command.
+
+    The command's ancestors are followed up to the root; the history after the root is then scanned for descendants.
+    Since every command is sent after its parent, a single forward scan finds them all. The scan stops after
+    `max_commands` commands or once commands are more than `max_duration_ms` newer than the root, in which case the
+    trace is marked as truncated.
+    """
+    persisted = command_db.fetch_by_key(key)
+    if persisted is None:
+        return None
+
+    root = persisted
+    while root.parent_key is not None:
+        parent = command_db.fetch_by_key(root.parent_key)
+        # The parent may no longer be in the history
+        if parent is None:
+            break
+        root = parent
+
+    hops_by_key: Dict[str, TraceHop] = {root.key: TraceHop(persisted_command=root, depth=0)}
+    hops = [hops_by_key[root.key]]
+    truncated = False
+    num_scanned = 0
+    cursor = root.key
+    while True:
+        page = command_db.fetch_from(page_size, cursor=cursor)
+        if len(page) == 0:
+            break
+        for command in page:
+            num_scanned += 1
+            if num_scanned > max_commands or command.timestamp_ms - root.timestamp_ms > max_duration_ms:
+                truncated = True
+                break
+            parent_hop = hops_by_key.get(command.parent_key) if command.parent_key is not None else None
+            if parent_hop is None:
+                continue
+            hop = TraceHop(
+                persisted_command=command,
+                depth=parent_hop.depth + 1,
+                latency_ms=command.timestamp_ms - parent_hop.persisted_command.timestamp_ms,
+                parent_key=command.parent_key)
+            hops_by_key[command.key] = hop
+            hops.append(hop)
+        if truncated:
+            break
+        cursor = page[-1].key
+
+    return Trace(root_key=root.key, hops=hops, truncated=truncated)
@@ -39,6 +39,10 @@ class Configuration:
     # correspond to the same machine running the webserver.
     fluentd: Optional['FluentDConfiguration'] = None
 
+    # Optional. Configuration of the webserver's built-in log aggregator, an alternative to fluentd for log tailing
+    # that needs no external daemon. If given, every process ships its logs to the webserver.
+    log_aggregator: Optional['LogAggregatorConfiguration'] = None
+
 @dataclasses.dataclass
 class DeployConfiguration:
     # Optional. Configuration details on the database used to track lifecycle updates, if desired.
@@ -62,5 +66,24 @@ class FluentDConfiguration:
     # Preferably, give the absolute filename (e.g. /path/to/foo) rather than relative (e.g. ./foo).
     log_file_dir: str
 
-    # The "tail" executable to call for tailing fluentd output. Can specify full path if needed by overriding this.
+    # Deprecated and unused: the webserver now follows fluentd's output itself rather than calling "tail".
     tail_bin: str = 'tail'
+
+
+@dataclasses.dataclass
+class LogAggregatorConfiguration:
+    # The hostname/port of the webserver's log aggregator. Processes send their logs here, and the webserver listens
+    # on this port.
+    hostname: str
+    port: int
+
+    # Directory on the webserver's machine to which aggregated logs are written, as a series of segment files in the
+    # same format as fluentd's output.
+    log_dir: str
+
+    # Size at which a new segment file is started, and the number of segment files kept; older ones are deleted.
+    segment_max_bytes: int = 64 * 1024 * 1024
+    max_segments: int = 20
+
+    # Number of recent log lines kept in memory for each process, which are sent to tail clients when they connect.
+    ring_size: int = 1000
@@ -21,6 +21,9 @@ class ProcessStatus(DataClassJsonMixin):
     last_heartbeat_ago: int
     git_sha: str
 
+    # Why the process is currently unhealthy (e.g. a handler exceeding its time budget), or None if healthy.
+    unhealthy_reason: Optional[str] = None
+
 
 class ProcessStatusDatabase(LifecycleListener):
     db: sqlalchemy.Engine
@@ -37,9 +40,15 @@ class ProcessStatusDatabase(LifecycleListener):
             f'{config.db_username}:{config.db_password}'
             f'@{config.db_hostname}:{config.db_port}/{config.db_name}',
             pool_pre_ping=True)
-        self._sha = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+        # Looked up when first needed, so that instances only used for fetching don't shell out to git
+        self._sha: Optional[bytes] = None
         self._process_name = process_name
 
+    def _git_sha(self) -> bytes:
+        if self._sha is None:
+            self._sha = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+        return self._sha
+
     def __enter__(self):
         return self
 
@@ -64,6 +73,7 @@ class ProcessStatusDatabase(LifecycleListener):
                 last_heartbeat_at=row['last_heartbeat_at'],
                 last_heartbeat_ago=int(row['last_heartbeat_ago']),
                 git_sha=row['git_sha'],
+                unhealthy_reason=row.get('unhealthy_reason'),
             ))
         return ret
 
@@ -78,7 +88,7 @@ class ProcessStatusDatabase(LifecycleListener):
             ', git_sha = :git_sha'
         with self.db.begin() as conn:
             conn.execute(sqlalchemy.text(s),
-                         dict(process_name=self._process_name, git_sha=self._sha))
+                         dict(process_name=self._process_name, git_sha=self._git_sha()))
 
     def on_heartbeat(self):
         s = 'UPDATE process_statuses SET ' \
@@ -86,3 +96,16 @@ class ProcessStatusDatabase(LifecycleListener):
             'WHERE process_name = :process_name'
         with self.db.begin() as conn:
             conn.execute(sqlalchemy.text(s), dict(process_name=self._process_name))
+
+    def on_unhealthy(self, reason: str):
+        self._set_unhealthy_reason(reason)
+
+    def on_healthy(self):
+        self._set_unhealthy_reason(None)
+
+    def _set_unhealthy_reason(self, reason: Optional[str]):
+        s = 'UPDATE process_statuses SET ' \
+            '  unhealthy_reason = :reason ' \
+            'WHERE process_name = :process_name'
+        with self.db.begin() as conn:
+            conn.execute(sqlalchemy.text(s), dict(process_name=self._process_name, reason=reason))
@@ -4,7 +4,11 @@ CREATE TABLE `process_statuses` (
                                     `last_started_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
                                     `last_heartbeat_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
                                     `git_sha` VARCHAR(255) NOT NULL,
+                                    `unhealthy_reason` VARCHAR(1024) NULL DEFAULT NULL,
                                     PRIMARY KEY (`id`),
                                     UNIQUE KEY `unq_proces_name` (`process_name`)
 ) ENGINE=InnoDB DEFAULT CHARSET=UTF8MB4;
 
+
+-- For tables created before `unhealthy_reason` was added:
+-- ALTER TABLE `process_statuses` ADD COLUMN `unhealthy_reason` VARCHAR(1024) NULL DEFAULT NULL AFTER `git_sha`;
@@ -0,0 +1,49 @@
+import abc
+from typing import Dict, Optional
+
+
+class MetricsSink(abc.ABC):
+    """
+    Destination for metrics recorded by DuraPy processes (e.g. handler durations, fetch latencies, ignored commands).
+    The ProcessRunner records into a sink on its hot path, so implementations should be cheap and never block on I/O;
+    exporting (e.g. to Prometheus or statsd) should happen elsewhere.
+
+    Metric names are plain strings (e.g. `durapy_handler_duration_ms`), and labels are an optional mapping of label
+    name to value (e.g. `{'type': 'PING'}`).
+    """
+
+    @abc.abstractmethod
+    def increment(self, name: str, amount: float = 1, labels: Optional[Dict[str, str]] = None):
+        """
+        Increments a monotonically-increasing counter.
+        """
+        ...
+
+    @abc.abstractmethod
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        """
+        Sets a gauge to the given value, overwriting the previous value.
+        """
+        ...
+
+    @abc.abstractmethod
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        """
+        Records a single observation (e.g. a latency in milliseconds) into a histogram.
+        """
+        ...
+
+
+class NoopMetricsSink(MetricsSink):
+    """
+    Metrics sink that discards everything. Useful if metrics are not desired at all.
+    """
+
+    def increment(self, name: str, amount: float = 1, labels: Optional[Dict[str, str]] = None):
+        pass
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        pass
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        pass
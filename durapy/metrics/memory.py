@@ -0,0 +1,148 @@
+import math
+import threading
+from typing import Dict, Optional, Tuple, List
+
+from durapy.metrics.base import MetricsSink
+
+# Labels are stored as a sorted tuple of (name, value) pairs so they can be used as dictionary keys.
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+# Number of linear sub-buckets per power of two. 16 sub-buckets bound the relative error of any reported quantile to
+# roughly 1/32 (~3%), independent of the magnitude of the recorded values.
+_SUB_BUCKETS = 16
+
+
+class Histogram:
+    """
+    HDR-style histogram with log-linear buckets: each power-of-two range is split into a fixed number of linear
+    sub-buckets, so quantiles have bounded relative error over any range of values while memory stays proportional to
+    the number of distinct buckets actually hit. Recording is O(1).
+    """
+
+    def __init__(self):
+        self._buckets: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def record(self, value: float):
+        idx = _bucket_index(value)
+        self._buckets[idx] = self._buckets.get(idx, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Returns an upper bound for the given quantile (0 <= q <= 1), or None if nothing has been recorded.
+        """
+        if self.count == 0:
+            return None
+        target = max(1, int(math.ceil(q * self.count)))
+        seen = 0
+        for idx in sorted(self._buckets):
+            seen += self._buckets[idx]
+            if seen >= target:
+                return min(_bucket_upper_bound(idx), self.max)
+        return self.max
+
+    def mean(self) -> Optional[float]:
+        return self.sum / self.count if self.count > 0 else None
+
+    def copy(self) -> 'Histogram':
+        ret = Histogram()
+        ret._buckets = dict(self._buckets)
+        ret.count = self.count
+        ret.sum = self.sum
+        ret.min = self.min
+        ret.max = self.max
+        return ret
+
+
+def _bucket_index(value: float) -> int:
+    if value <= 0:
+        return -(1 << 30)
+    mantissa, exponent = math.frexp(value)
+    # mantissa is in [0.5, 1); map it onto [0, _SUB_BUCKETS)
+    sub_bucket = int((mantissa - 0.5) * 2 * _SUB_BUCKETS)
+    return exponent * _SUB_BUCKETS + sub_bucket
+
+
+def _bucket_upper_bound(idx: int) -> float:
+    if idx == -(1 << 30):
+        return 0.0
+    exponent, sub_bucket = divmod(idx, _SUB_BUCKETS)
+    return math.ldexp(0.5 + (sub_bucket + 1) / (2 * _SUB_BUCKETS), exponent)
+
+
+class InMemoryMetricsSink(MetricsSink):
+    """
+    Metrics sink that aggregates counters, gauges and histograms in this process's memory. This is the default sink
+    used by the ProcessRunner, and can be exported via the Prometheus text format (see `durapy.metrics.prometheus`).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelsKey, float]] = {}
+        self._gauges: Dict[str, Dict[LabelsKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelsKey, Histogram]] = {}
+
+    def increment(self, name: str, amount: float = 1, labels: Optional[Dict[str, str]] = None):
+        key = _labels_key(labels)
+        with self._lock:
+            by_labels = self._counters.setdefault(name, {})
+            by_labels[key] = by_labels.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        key = _labels_key(labels)
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        key = _labels_key(labels)
+        with self._lock:
+            by_labels = self._histograms.setdefault(name, {})
+            histogram = by_labels.get(key)
+            if histogram is None:
+                histogram = by_labels[key] = Histogram()
+            histogram.record(value)
+
+    def counter_value(self, name: str, labels: Optional[Dict[str, str]] = None) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(_labels_key(labels), 0)
+
+    def gauge_value(self, name: str, labels: Optional[Dict[str, str]] = None) -> Optional[float]:
+        with self._lock:
+            return self._gauges.get(name, {}).get(_labels_key(labels))
+
+    def histogram(self, name: str, labels: Optional[Dict[str, str]] = None) -> Optional[Histogram]:
+        """
+        Returns a copy of the histogram for the given name and labels, or None if nothing has been recorded.
+        """
+        with self._lock:
+            histogram = self._histograms.get(name, {}).get(_labels_key(labels))
+            return histogram.copy() if histogram is not None else None
+
+    def snapshot(self) -> Tuple[
+            Dict[str, List[Tuple[LabelsKey, float]]],
+            Dict[str, List[Tuple[LabelsKey, float]]],
+            Dict[str, List[Tuple[LabelsKey, Histogram]]]]:
+        """
+        Returns a consistent copy of all (counters, gauges, histograms), keyed by metric name.
+        """
+        with self._lock:
+            counters = {name: list(by_labels.items()) for name, by_labels in self._counters.items()}
+            gauges = {name: list(by_labels.items()) for name, by_labels in self._gauges.items()}
+            histograms = {name: [(k, h.copy()) for k, h in by_labels.items()]
+                          for name, by_labels in self._histograms.items()}
+        return counters, gauges, histograms
+
+
+def _labels_key(labels: Optional[Dict[str, str]]) -> LabelsKey:
+    if not labels:
+        return ()
+    return tuple(sorted(labels.items()))
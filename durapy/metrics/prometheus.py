@@ -0,0 +1,83 @@
+import http.server
+import logging
+from typing import List
+
+from durapy.command.threading import LoggingThread
+from durapy.metrics.memory import InMemoryMetricsSink, LabelsKey
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Quantiles exported for each histogram, rendered as a Prometheus "summary".
+_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def render_prometheus_text(sink: InMemoryMetricsSink) -> str:
+    """
+    Renders all metrics in the given sink in the Prometheus text exposition format. Histograms are exported as
+    summaries (quantiles + _sum + _count), since their HDR-style buckets are not stable across scrapes.
+    """
+    counters, gauges, histograms = sink.snapshot()
+    lines: List[str] = []
+    for name in sorted(counters):
+        lines.append(f'# TYPE {name} counter')
+        for labels, value in sorted(counters[name]):
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    for name in sorted(gauges):
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in sorted(gauges[name]):
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    for name in sorted(histograms):
+        lines.append(f'# TYPE {name} summary')
+        for labels, histogram in sorted(histograms[name], key=lambda t: t[0]):
+            for q in _QUANTILES:
+                quantile_labels = labels + (('quantile', str(q)),)
+                lines.append(f'{name}{_format_labels(quantile_labels)} {_format_value(histogram.quantile(q))}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}')
+            lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(sink: InMemoryMetricsSink, port: int, host: str = '0.0.0.0') -> http.server.ThreadingHTTPServer:
+    """
+    Starts a tiny HTTP listener in a background thread that serves the given sink's metrics at GET /metrics. Call
+    #shutdown() on the returned server to stop it.
+    """
+    class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render_prometheus_text(sink).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are frequent; don't spam the process log with them.
+            logging.debug(format, *args)
+
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    LoggingThread(target=server.serve_forever, name=f'metrics-{port}', daemon=True).start()
+    logging.info(f'Serving metrics at http://{host}:{server.server_address[1]}/metrics')
+    return server
+
+
+def _format_labels(labels: LabelsKey) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _escape(v) -> str:
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(v) -> str:
+    if v is None:
+        return 'NaN'
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
@@ -0,0 +1,50 @@
+from durapy.command._heartbeat import _Heartbeater
+from durapy.command.model import LifecycleListener
+from durapy.metrics.memory import InMemoryMetricsSink
+
+
+class _CountingListener(LifecycleListener):
+    def __init__(self, fail: bool = False):
+        self.heartbeats = 0
+        self._fail = fail
+
+    def on_started_up(self):
+        pass
+
+    def on_heartbeat(self):
+        if self._fail:
+            raise RuntimeError('db down')
+        self.heartbeats += 1
+
+
+class TestHeartbeater:
+    def test_beats_when_idle(self):
+        listener = _CountingListener()
+        metrics = InMemoryMetricsSink()
+        h = _Heartbeater('test', listener, metrics, interval_s=1.0, stall_timeout_s=10.0)
+        h.beat()
+        h.beat()
+        assert listener.heartbeats == 2
+        assert metrics.counter_value('durapy_heartbeats_total') == 2
+
+    def test_withholds_heartbeat_when_stalled(self):
+        listener = _CountingListener()
+        metrics = InMemoryMetricsSink()
+        h = _Heartbeater('test', listener, metrics, interval_s=1.0, stall_timeout_s=0.0)
+        h.on_dispatch_started()
+        h.beat()
+        assert listener.heartbeats == 0
+        assert metrics.counter_value('durapy_heartbeats_withheld_total') == 1
+        assert metrics.gauge_value('durapy_stalled') == 1
+        assert h.stalled_for_s() is not None
+
+        h.on_dispatch_finished()
+        h.beat()
+        assert listener.heartbeats == 1
+        assert h.stalled_for_s() is None
+
+    def test_counts_failures(self):
+        metrics = InMemoryMetricsSink()
+        h = _Heartbeater('test', _CountingListener(fail=True), metrics, interval_s=1.0, stall_timeout_s=10.0)
+        h.beat()
+        assert metrics.counter_value('durapy_heartbeat_failures_total') == 1
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+from typing import Dict
+
+import pytest
+
+# Optional dependencies that processes shouldn't load unless configured to use them.
+_OPTIONAL_MODULES = [
+    # Lifecycle database
+    'sqlalchemy',
+    'pymysql',
+    'durapy.deploy.status.status',
+    'durapy.deploy.lifecycle',
+    # fluentd logging
+    'fluent',
+    'msgpack',
+]
+
+# Slow-to-import modules that the runner only loads once they're first used.
+_LAZY_MODULES = [
+    # Coroutine handlers
+    'asyncio',
+    'durapy.command._async',
+    # Metrics server
+    'http.server',
+    'durapy.metrics.prometheus',
+    # Profiling and memory diagnostics
+    'cProfile',
+    'pstats',
+    'tracemalloc',
+    'durapy.command._profiler',
+    'durapy.command._memory',
+]
+
+# Budget for the runner's own imports, i.e. excluding durapy.command.model (dominated by dataclasses_json), which every
+# process needs anyway. Importing sqlalchemy alone exceeds this. Wall-clock time varies from machine to machine, so this
+# is only checked when benchmarks are asked for, via the DURAPY_BENCHMARKS environment variable.
+_RUNNER_IMPORT_BUDGET_US = 150 * 1000
+
+
+def _import_times_us(module: str) -> Dict[str, int]:
+    """
+    Imports the given module in a fresh interpreter with `-X importtime`, returning the cumulative import time of every
+    module that was imported, in microseconds.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        # Same import path as this process, so it finds the same durapy regardless of working directory
+        env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)},
+        capture_output=True, text=True, check=True)
+    ret = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        ret[name.strip()] = int(cumulative_us)
+    return ret
+
+
+class TestImports:
+    def test_runner_skips_optional_dependencies(self):
+        imported = _import_times_us('durapy.command.runner')
+        assert 'durapy.command.runner' in imported
+        assert [m for m in _OPTIONAL_MODULES if m in imported] == []
+
+    def test_runner_defers_slow_imports(self):
+        imported = _import_times_us('durapy.command.runner')
+        assert [m for m in _LAZY_MODULES if m in imported] == []
+
+    @pytest.mark.skipif(not os.environ.get('DURAPY_BENCHMARKS'), reason='Benchmark; set DURAPY_BENCHMARKS to run')
+    def test_runner_import_time(self):
+        own_times_us = []
+        # Best of a few runs, to smooth over noise from e.g. a cold disk cache
+        for _ in range(3):
+            imported = _import_times_us('durapy.command.runner')
+            own_times_us.append(imported['durapy.command.runner'] - imported['durapy.command.model'])
+        assert min(own_times_us) < _RUNNER_IMPORT_BUDGET_US
@@ -0,0 +1,96 @@
+import logging
+import queue
+import sys
+import threading
+
+from durapy.command import _logging
+from durapy.command._logging import CommandLogSampler, _DroppingQueueHandler, _QueueListener, log_to_file, \
+    log_file_for, flush_logs
+
+
+class TestCommandLogSampler:
+    def test_first_n_then_one_in_k(self):
+        sampler = CommandLogSampler(first_n=3, one_in_k=4)
+        sampled = [sampler.sample('A') for _ in range(12)]
+        assert sampled == [1, 2, 3, None, None, None, 7, None, None, None, 11, None]
+
+    def test_counts_per_type(self):
+        sampler = CommandLogSampler(first_n=1, one_in_k=100)
+        assert sampler.sample('A') == 1
+        assert sampler.sample('A') is None
+        assert sampler.sample('B') == 1
+
+
+class TestAsyncLogging:
+    def test_writes_and_rotates(self, monkeypatch, tmp_path):
+        monkeypatch.setenv('GLOG_log_dir', str(tmp_path))
+        monkeypatch.setattr(sys, 'excepthook', sys.excepthook)
+        log_file = log_file_for('test_logging')
+        log_to_file('test_logging', max_bytes=1000, backup_count=2)
+        try:
+            # Adding the same file again is a no-op
+            log_to_file('test_logging', max_bytes=1000, backup_count=2)
+
+            log = logging.getLogger('durapy.tests.test_logging')
+            for i in range(50):
+                log.info('Message %d: %s', i, 'x' * 50)
+            flush_logs()
+        finally:
+            for handler in _logging._listener.handlers:
+                if isinstance(handler, logging.FileHandler) and handler.baseFilename == log_file:
+                    _logging._remove_handler(handler)
+                    handler.close()
+
+        with open(log_file) as f:
+            lines = f.read().splitlines()
+        assert lines[-1].endswith(f'Message 49: {"x" * 50}')
+        assert sorted(p.name for p in tmp_path.iterdir()) == \
+            ['test_logging.log', 'test_logging.log.1', 'test_logging.log.2']
+
+    def test_drops_when_full(self):
+        q = queue.Queue(maxsize=2)
+        handler = _DroppingQueueHandler(q)
+        log = logging.getLogger('durapy.tests.test_logging.drops')
+        log.propagate = False
+        log.addHandler(handler)
+        try:
+            for i in range(5):
+                log.warning('Message %d', i)
+            assert [q.get_nowait().getMessage() for _ in range(2)] == ['Message 0', 'Message 1']
+
+            log.warning('Message 5')
+            assert [q.get_nowait().getMessage() for _ in range(2)] == \
+                ['Dropped 3 log records, as they were logged faster than they could be written.', 'Message 5']
+        finally:
+            log.removeHandler(handler)
+
+    def test_message_rendered_when_logged(self):
+        q = queue.Queue()
+        handler = _DroppingQueueHandler(q)
+        log = logging.getLogger('durapy.tests.test_logging.rendered')
+        log.propagate = False
+        log.addHandler(handler)
+        try:
+            values = [1]
+            log.warning('Values: %s', values)
+            values.append(2)
+            assert q.get_nowait().getMessage() == 'Values: [1]'
+        finally:
+            log.removeHandler(handler)
+
+    def test_stop_waits_for_room_in_full_queue(self):
+        q = queue.Queue(maxsize=2)
+        unblock = threading.Event()
+
+        class _BlockingHandler(logging.Handler):
+            def handle(self, record):
+                unblock.wait()
+
+        listener = _QueueListener(q, _BlockingHandler())
+        listener.start()
+        # One record is held by the blocked listener, the rest fill the queue
+        for i in range(3):
+            q.put(logging.makeLogRecord(dict(msg=f'Message {i}')))
+        threading.Timer(0.05, unblock.set).start()
+        listener.stop()
+        assert q.empty()
@@ -0,0 +1,58 @@
+import sys
+import tracemalloc
+
+from durapy.command.builtin import MemoryDiagnosticsCommand, MemoryReportCommand, MemoryAction
+from durapy.command.command import CommandRegistry
+from durapy.command.model import Context
+from durapy.tests.command.test_runner import SetValueCommand, _run
+
+# Keeps allocations alive so they show up in snapshots
+_leaked = []
+
+
+def _leak(c, context: Context):
+    _leaked.append(bytearray(100000))
+
+
+def _reports(runner):
+    return [p.command for p in runner._command_db.fetch_from(100) if isinstance(p.command, MemoryReportCommand)]
+
+
+class TestMemoryDiagnostics:
+    def test_snapshot_diff(self):
+        _leaked.clear()
+        try:
+            runner = _run(CommandRegistry().register_static_method(SetValueCommand, _leak), [
+                MemoryDiagnosticsCommand(process_name='test_runner', action=MemoryAction.start),
+                *[SetValueCommand(channel=0, value=i) for i in range(10)],
+                MemoryDiagnosticsCommand(process_name='test_runner', action=MemoryAction.snapshot),
+                MemoryDiagnosticsCommand(process_name='test_runner', action=MemoryAction.stop),
+            ])
+        finally:
+            tracemalloc.stop()
+
+        start, snapshot, stop = _reports(runner)
+        assert start.tracing and snapshot.tracing and not stop.tracing
+        assert snapshot.traced_bytes >= 10 * 100000
+        assert any('test_memory.py' in line for line in snapshot.top_growth[:1])
+        assert snapshot.rss_bytes > 0
+        # The 10 SetValueCommands, plus the START
+        assert snapshot.num_past_commands == 11
+        assert snapshot.object_counts['PersistedCommand'] > 0
+        assert snapshot.object_counts['SetValueCommand'] >= 10
+
+    def test_reports_without_tracing(self):
+        runner = _run(CommandRegistry(), [MemoryDiagnosticsCommand(process_name='test_runner')])
+        report, = _reports(runner)
+        assert not report.tracing
+        assert report.top_allocations == []
+        assert report.rss_growth_bytes == 0
+
+    def test_reports_without_rss(self, monkeypatch):
+        # As on Windows: no /proc, no os.sysconf, and no resource module
+        monkeypatch.delattr('os.sysconf')
+        monkeypatch.setitem(sys.modules, 'resource', None)
+        runner = _run(CommandRegistry(), [MemoryDiagnosticsCommand(process_name='test_runner')])
+        report, = _reports(runner)
+        assert report.rss_bytes is None
+        assert report.rss_growth_bytes is None
@@ -0,0 +1,52 @@
+import os
+import pstats
+import time
+
+from durapy.command.builtin import StartProfilerCommand, ProfileWrittenCommand, ProfilerMode
+from durapy.command.command import CommandRegistry
+from durapy.command.model import Context
+from durapy.tests.command.test_runner import SetValueCommand, _run
+
+
+def _written_profiles(runner):
+    return [p.command for p in runner._command_db.fetch_from(100) if isinstance(p.command, ProfileWrittenCommand)]
+
+
+def _busy(c, context: Context):
+    deadline = time.monotonic() + 0.02
+    while time.monotonic() < deadline:
+        pass
+
+
+class TestProfiler:
+    def test_sampling(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('GLOG_log_dir', str(tmp_path))
+        runner = _run(CommandRegistry().register_static_method(SetValueCommand, _busy), [
+            StartProfilerCommand(process_name='test_runner', duration_s=10, sample_interval_ms=1),
+            *[SetValueCommand(channel=0, value=i) for i in range(5)],
+        ])
+        # Stopping the process writes out the profile early
+        written = _written_profiles(runner)
+        assert len(written) == 1
+        assert written[0].mode == ProfilerMode.sampling
+        assert os.path.dirname(written[0].path) == str(tmp_path)
+        with open(written[0].path) as f:
+            lines = f.read().splitlines()
+        assert any('_busy' in line for line in lines)
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+
+    def test_cprofile(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('GLOG_log_dir', str(tmp_path))
+        runner = _run(CommandRegistry().register_static_method(SetValueCommand, _busy), [
+            StartProfilerCommand(process_name='test_runner', duration_s=10, mode=ProfilerMode.cprofile),
+            *[SetValueCommand(channel=0, value=i) for i in range(3)],
+        ])
+        written = _written_profiles(runner)
+        assert len(written) == 1
+        stats = pstats.Stats(written[0].path)
+        assert any(func_name == '_busy' for _, _, func_name in stats.stats)
+
+    def test_ignores_other_processes(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('GLOG_log_dir', str(tmp_path))
+        runner = _run(CommandRegistry(), [StartProfilerCommand(process_name='other', duration_s=10)])
+        assert _written_profiles(runner) == []
@@ -0,0 +1,525 @@
+import asyncio
+import dataclasses
+import signal
+import socket
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from durapy.backends.memory import InMemoryCommandDatabaseFactory
+from durapy.command.command import CommandRegistry, StalenessPolicy
+from durapy.command.threading import LoggingThread
+from durapy.command.model import BaseCommand, BaseController, CommandPriority, Context
+from durapy.command.runner import ProcessRunner
+from durapy.config import Configuration
+
+
+@dataclasses.dataclass
+class SetValueCommand(BaseCommand):
+    channel: int
+    value: int
+
+    @staticmethod
+    def type() -> str:
+        return 'SET_VALUE'
+
+
+@dataclasses.dataclass
+class DoneCommand(BaseCommand):
+    @staticmethod
+    def type() -> str:
+        return 'DONE'
+
+
+@dataclasses.dataclass
+class AbortCommand(BaseCommand):
+    @staticmethod
+    def type() -> str:
+        return 'ABORT'
+
+    @staticmethod
+    def priority() -> CommandPriority:
+        return CommandPriority.HIGH
+
+
+@dataclasses.dataclass
+class ReplyCommand(BaseCommand):
+    value: int
+
+    @staticmethod
+    def type() -> str:
+        return 'REPLY'
+
+
+@dataclasses.dataclass
+class StartSessionCommand(BaseCommand):
+    session_id: str
+
+    @staticmethod
+    def type() -> str:
+        return 'START_SESSION'
+
+
+@dataclasses.dataclass
+class EndSessionCommand(BaseCommand):
+    session_id: str
+
+    @staticmethod
+    def type() -> str:
+        return 'END_SESSION'
+
+
+ALL_COMMAND_CLASSES = [
+    SetValueCommand, DoneCommand, AbortCommand, ReplyCommand, StartSessionCommand, EndSessionCommand]
+
+
+def _run(registry: CommandRegistry, commands, stop: bool = True, **kwargs) -> ProcessRunner:
+    """
+    Sends the given commands, followed by a DoneCommand that stops the runner (unless `stop` is False), and then runs
+    until stopped.
+    """
+    configuration = Configuration(
+        command_prefix='test',
+        command_db_factory=InMemoryCommandDatabaseFactory(),
+        command_classes=ALL_COMMAND_CLASSES)
+    runner = ProcessRunner(
+        configuration=configuration,
+        process_name='test_runner',
+        command_registry=registry.register_static_method(DoneCommand, lambda c, ctx: runner.stop()),
+        override_signal_handlers=False,
+        **kwargs)
+    for command in commands:
+        runner.send_command(command)
+    if stop:
+        runner.send_command(DoneCommand())
+    runner.run()
+    return runner
+
+
+class TestStalenessPolicies:
+    def test_processes_everything_by_default(self):
+        seen = []
+        registry = CommandRegistry().register_static_method(
+            SetValueCommand, lambda c, ctx: seen.append((c.channel, c.value)))
+        _run(registry, [SetValueCommand(channel=0, value=v) for v in range(5)])
+        assert seen == [(0, v) for v in range(5)]
+
+    def test_coalesces_to_latest_per_key(self):
+        seen = []
+        registry = (
+            CommandRegistry()
+            .register_static_method(SetValueCommand, lambda c, ctx: seen.append((c.channel, c.value)))
+            .register_staleness_policy(SetValueCommand, StalenessPolicy.latest_only(lambda c: c.channel))
+        )
+        commands = [SetValueCommand(channel=v % 2, value=v) for v in range(6)]
+        runner = _run(registry, commands)
+        assert seen == [(0, 4), (1, 5)]
+        assert runner.metrics().counter_value(
+            'durapy_commands_dropped_total', {'type': 'SET_VALUE', 'reason': 'coalesced'}) == 4
+
+    def test_observes_fetched_before_coalescing(self):
+        fetched = []
+        registry = (
+            CommandRegistry()
+            .register_static_method(SetValueCommand, lambda c, ctx: None)
+            .register_staleness_policy(SetValueCommand, StalenessPolicy.latest_only(lambda c: c.channel))
+        )
+        _run(registry, [SetValueCommand(channel=0, value=v) for v in range(3)], on_fetched=fetched.extend)
+        assert [p.command.type() for p in fetched] == ['SET_VALUE'] * 3 + ['DONE']
+
+    def test_drops_expired(self):
+        seen = []
+        registry = (
+            CommandRegistry()
+            .register_static_method(SetValueCommand, lambda c, ctx: seen.append(c.value))
+            .register_staleness_policy(SetValueCommand, StalenessPolicy.drop_older_than(ttl_ms=-1))
+        )
+        _run(registry, [SetValueCommand(channel=0, value=1)])
+        assert seen == []
+
+    def test_tracks_lag(self):
+        registry = CommandRegistry().register_static_method(SetValueCommand, lambda c, ctx: None)
+        runner = _run(registry, [SetValueCommand(channel=0, value=v) for v in range(10)], fetch_batch_size=4)
+        lag = runner.lag()
+        assert lag.commands == 0
+        assert lag.age_ms is not None
+
+
+class TestPriority:
+    def test_high_priority_jumps_backlog(self):
+        seen = []
+        registry = (
+            CommandRegistry()
+            .register_static_method(SetValueCommand, lambda c, ctx: seen.append(c.value))
+            .register_static_method(AbortCommand, lambda c, ctx: seen.append('abort'))
+        )
+        commands = [SetValueCommand(channel=0, value=v) for v in range(10)] + [AbortCommand()]
+        _run(registry, commands, fetch_batch_size=4, priority_poll_interval_ms=0)
+        assert seen == ['abort'] + list(range(10))
+
+
+class TestSendAndWait:
+    def test_round_trip(self):
+        replies = []
+
+        def _request(context: Context):
+            replies.append(context.send_and_wait(SetValueCommand(channel=0, value=21), ReplyCommand, timeout_s=5))
+            context.send_command(DoneCommand())
+
+        registry = (
+            CommandRegistry()
+            .register_static_method(AbortCommand, lambda c, ctx: LoggingThread(target=_request, args=(ctx,)).start())
+            .register_static_method(SetValueCommand, lambda c, ctx: ctx.send_command(ReplyCommand(value=2 * c.value)))
+        )
+        runner = _run(registry, [AbortCommand()], stop=False)
+        assert len(replies) == 1
+        assert replies[0].command.value == 42
+        assert replies[0].correlation_id is not None
+        assert runner.metrics().histogram(
+            'durapy_request_round_trip_ms', {'type': 'SET_VALUE', 'reply_type': 'REPLY'}).count == 1
+
+    def test_expired_reply_still_completes_request(self):
+        replies = []
+
+        def _request(context: Context):
+            try:
+                replies.append(context.send_and_wait(SetValueCommand(channel=0, value=21), ReplyCommand, timeout_s=5))
+            finally:
+                context.send_command(DoneCommand())
+
+        registry = (
+            CommandRegistry()
+            .register_static_method(AbortCommand, lambda c, ctx: LoggingThread(target=_request, args=(ctx,)).start())
+            .register_static_method(SetValueCommand, lambda c, ctx: ctx.send_command(ReplyCommand(value=2 * c.value)))
+            .register_static_method(ReplyCommand, lambda c, ctx: None)
+            .register_staleness_policy(ReplyCommand, StalenessPolicy.latest_only(ttl_ms=-1))
+        )
+        _run(registry, [AbortCommand()], stop=False)
+        assert [r.command.value for r in replies] == [42]
+
+    def test_requests_exempt_from_staleness_policies(self):
+        replies = []
+
+        def _request(context: Context):
+            try:
+                replies.append(context.send_and_wait(SetValueCommand(channel=0, value=21), ReplyCommand, timeout_s=5))
+            finally:
+                context.send_command(DoneCommand())
+
+        registry = (
+            CommandRegistry()
+            .register_static_method(AbortCommand, lambda c, ctx: LoggingThread(target=_request, args=(ctx,)).start())
+            .register_static_method(SetValueCommand, lambda c, ctx: ctx.send_command(ReplyCommand(value=2 * c.value)))
+            .register_staleness_policy(SetValueCommand, StalenessPolicy.latest_only(ttl_ms=-1))
+        )
+        runner = _run(registry, [AbortCommand()], stop=False)
+        assert [r.command.value for r in replies] == [42]
+        assert runner.metrics().counter_value(
+            'durapy_commands_dropped_total', {'type': 'SET_VALUE', 'reason': 'expired'}) == 0
+
+    def test_times_out(self):
+        errors = []
+
+        def _request(context: Context):
+            try:
+                context.send_and_wait(SetValueCommand(channel=0, value=1), ReplyCommand, timeout_s=0.1)
+            except TimeoutError as e:
+                errors.append(e)
+            context.send_command(DoneCommand())
+
+        registry = CommandRegistry().register_static_method(
+            AbortCommand, lambda c, ctx: LoggingThread(target=_request, args=(ctx,)).start())
+        _run(registry, [AbortCommand()], stop=False)
+        assert len(errors) == 1
+
+    def test_cannot_block_command_loop(self):
+        errors = []
+
+        def _handle(c, context: Context):
+            try:
+                context.send_and_wait(SetValueCommand(channel=0, value=1), ReplyCommand, timeout_s=1)
+            except RuntimeError as e:
+                errors.append(e)
+
+        _run(CommandRegistry().register_static_method(AbortCommand, _handle), [AbortCommand()])
+        assert len(errors) == 1
+
+
+class TestLocalDelivery:
+    def test_self_addressed_commands_handled_once(self):
+        seen = []
+
+        def _handle_set(c, context: Context):
+            seen.append(c.value)
+            if c.value < 3:
+                context.send_command(SetValueCommand(channel=0, value=c.value + 1))
+            else:
+                context.send_command(DoneCommand())
+
+        runner = _run(
+            CommandRegistry().register_static_method(SetValueCommand, _handle_set),
+            [SetValueCommand(channel=0, value=0)],
+            stop=False)
+        assert seen == [0, 1, 2, 3]
+        assert runner.metrics().counter_value('durapy_commands_delivered_locally_total', {'type': 'SET_VALUE'}) == 3
+
+
+class TestWakeup:
+    def test_stop_interrupts_blocked_fetch(self):
+        configuration = Configuration(
+            command_prefix='test',
+            command_db_factory=InMemoryCommandDatabaseFactory(),
+            command_classes=ALL_COMMAND_CLASSES)
+        runner = ProcessRunner(
+            configuration=configuration,
+            process_name='test_runner',
+            command_registry=CommandRegistry(),
+            override_signal_handlers=False,
+            fetch_timeout_ms=60000)
+        threading.Timer(0.1, runner.stop).start()
+        start = time.monotonic()
+        runner.run()
+        assert time.monotonic() - start < 5
+
+    @pytest.mark.skipif(not hasattr(signal, 'pthread_kill'), reason='Signals a specific thread')
+    def test_stop_signal_interrupts_blocked_fetch(self):
+        configuration = Configuration(
+            command_prefix='test',
+            command_db_factory=InMemoryCommandDatabaseFactory(),
+            command_classes=ALL_COMMAND_CLASSES)
+        orig_sigint = signal.getsignal(signal.SIGINT)
+        orig_sigterm = signal.getsignal(signal.SIGTERM)
+        try:
+            runner = ProcessRunner(
+                configuration=configuration,
+                process_name='test_runner',
+                command_registry=CommandRegistry(),
+                fetch_timeout_ms=60000)
+            threading.Timer(
+                0.1, signal.pthread_kill, args=(threading.main_thread().ident, signal.SIGTERM)).start()
+            start = time.monotonic()
+            runner.run()
+            assert time.monotonic() - start < 5
+        finally:
+            signal.signal(signal.SIGINT, orig_sigint)
+            signal.signal(signal.SIGTERM, orig_sigterm)
+
+
+class TestAsyncHandlers:
+    def test_handlers_overlap(self):
+        finished = []
+        all_started = threading.Event()
+        started = []
+
+        async def _handle_set(c, context: Context):
+            started.append(c.value)
+            if len(started) == 3:
+                all_started.set()
+            # Only completes once every handler has started, i.e. if they run concurrently
+            await asyncio.get_running_loop().run_in_executor(None, all_started.wait, 5)
+            finished.append(c.value)
+            if len(finished) == 3:
+                context.send_command(DoneCommand())
+
+        _run(
+            CommandRegistry().register_static_method(SetValueCommand, _handle_set),
+            [SetValueCommand(channel=0, value=i) for i in range(3)],
+            stop=False)
+        assert sorted(finished) == [0, 1, 2]
+
+    def test_cancelled_on_stop(self):
+        cancelled = threading.Event()
+
+        async def _handle_set(c, context: Context):
+            context.send_command(DoneCommand())
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        start = time.monotonic()
+        _run(
+            CommandRegistry().register_static_method(SetValueCommand, _handle_set),
+            [SetValueCommand(channel=0, value=0)],
+            stop=False)
+        assert cancelled.is_set()
+        assert time.monotonic() - start < 5
+
+
+class TestSchedule:
+    def test_every_until_cancelled(self):
+        seen = []
+
+        def _handle_set(c, context: Context):
+            seen.append(c.value)
+            if len(seen) == 3:
+                handle.cancel()
+                context.send_command(DoneCommand())
+
+        def _start(c, context: Context):
+            nonlocal handle
+            values = iter(range(100))
+            handle = context.every(50, lambda: SetValueCommand(channel=0, value=next(values)))
+
+        handle = None
+        _run(
+            CommandRegistry()
+            .register_static_method(SetValueCommand, _handle_set)
+            .register_static_method(ReplyCommand, _start),
+            [ReplyCommand(value=0)],
+            stop=False)
+        assert seen == [0, 1, 2]
+
+
+# Sessions created by _Session, in order
+sessions = []
+
+
+class _Session(BaseController):
+    def __init__(self, command: StartSessionCommand, context: Context):
+        self.session_id = command.session_id
+        self.values = []
+        self.stopped = False
+        sessions.append(self)
+
+    def handle_value(self, command: SetValueCommand, context: Context):
+        assert context.current_instance is self
+        self.values.append(command.value)
+
+    def handle_end(self, command: EndSessionCommand, context: Context):
+        self.stop(context)
+
+    def stop(self, context: Context):
+        self.stopped = True
+
+
+class TestControllerInstances:
+    def test_routes_by_key(self):
+        sessions.clear()
+        registry = (
+            CommandRegistry()
+            .register_controller_creator(StartSessionCommand, _Session, instance_key=lambda c: c.session_id)
+            .register_controller_method(
+                SetValueCommand, _Session.handle_value, instance_key=lambda c: f'session{c.channel}')
+            .register_controller_deleter(EndSessionCommand, _Session.handle_end, instance_key=lambda c: c.session_id)
+        )
+        runner = _run(registry, [
+            StartSessionCommand(session_id='session0'),
+            StartSessionCommand(session_id='session1'),
+            SetValueCommand(channel=0, value=1),
+            SetValueCommand(channel=1, value=2),
+            SetValueCommand(channel=2, value=3),
+            EndSessionCommand(session_id='session0'),
+            SetValueCommand(channel=0, value=4),
+            SetValueCommand(channel=1, value=5),
+        ])
+        assert [(s.session_id, s.values) for s in sessions] == [('session0', [1]), ('session1', [2, 5])]
+        # session0 was deleted by its command; session1 was stopped along with the process
+        assert [s.stopped for s in sessions] == [True, True]
+        assert runner.metrics().counter_value(
+            'durapy_commands_ignored_total', {'type': 'SET_VALUE', 'reason': 'no_instance'}) == 2
+
+    def test_single_instance_by_default(self):
+        sessions.clear()
+        registry = CommandRegistry().register_controller_creator(StartSessionCommand, _Session)
+        runner = _run(registry, [StartSessionCommand(session_id='a'), StartSessionCommand(session_id='b')])
+        assert [s.session_id for s in sessions] == ['a']
+        assert runner.metrics().counter_value(
+            'durapy_commands_ignored_total', {'type': 'START_SESSION', 'reason': 'instance_exists'}) == 1
+
+
+class TestBatchMethods:
+    def test_batches_consecutive_backlog(self):
+        batches = []
+        registry = CommandRegistry().register_batch_method(
+            SetValueCommand, lambda commands, context: batches.append([c.value for c in commands]), max_batch_size=3)
+        runner = _run(registry, [
+            SetValueCommand(channel=0, value=0),
+            SetValueCommand(channel=0, value=1),
+            SetValueCommand(channel=0, value=2),
+            SetValueCommand(channel=0, value=3),
+            ReplyCommand(value=0),
+            SetValueCommand(channel=0, value=4),
+        ])
+        # Bounded by max_batch_size, and never reordered around other command types
+        assert batches == [[0, 1, 2], [3], [4]]
+        assert runner.metrics().counter_value('durapy_commands_dispatched_total', {'type': 'SET_VALUE'}) == 5
+
+    def test_requests_dispatched_alone(self):
+        batches = []
+
+        def _handle(commands, context: Context):
+            batches.append([c.value for c in commands])
+            context.send_command(ReplyCommand(value=commands[-1].value))
+
+        configuration = Configuration(
+            command_prefix='test',
+            command_db_factory=InMemoryCommandDatabaseFactory(),
+            command_classes=ALL_COMMAND_CLASSES)
+        runner = ProcessRunner(
+            configuration=configuration,
+            process_name='test_runner',
+            command_registry=CommandRegistry()
+            .register_batch_method(SetValueCommand, _handle)
+            .register_static_method(ReplyCommand, lambda c, ctx: None)
+            .register_static_method(DoneCommand, lambda c, ctx: runner.stop()),
+            override_signal_handlers=False)
+        runner.send_command(SetValueCommand(channel=0, value=0))
+        runner.send_command(SetValueCommand(channel=0, value=1), correlation_id='request')
+        runner.send_command(SetValueCommand(channel=0, value=2))
+        runner.send_command(SetValueCommand(channel=0, value=3))
+        runner.send_command(DoneCommand())
+        runner.run()
+
+        assert batches == [[0], [1], [2, 3]]
+        replies = [p for p in runner._command_db.fetch_from(100) if p.command.type() == 'REPLY']
+        assert [(p.command.value, p.correlation_id) for p in replies] == [(0, None), (1, 'request'), (3, None)]
+
+
+class TestMetricsServer:
+    def test_served_only_while_running(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        scraped = []
+
+        def _scrape(c, context: Context):
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+                scraped.append(response.status)
+
+        registry = CommandRegistry().register_static_method(SetValueCommand, _scrape)
+        configuration = Configuration(
+            command_prefix='test',
+            command_db_factory=InMemoryCommandDatabaseFactory(),
+            command_classes=ALL_COMMAND_CLASSES)
+        # Constructing a runner that's never run doesn't take the port
+        ProcessRunner(configuration=configuration, process_name='unused', command_registry=CommandRegistry(),
+                      override_signal_handlers=False, metrics_port=port)
+        _assert_port_free(port)
+
+        _run(registry, [SetValueCommand(channel=0, value=0)], metrics_port=port)
+        assert scraped == [200]
+        _assert_port_free(port)
+
+    def test_port_in_use_starts_nothing(self):
+        with socket.socket() as s:
+            s.bind(('0.0.0.0', 0))
+            s.listen()
+            port = s.getsockname()[1]
+
+            before = set(threading.enumerate())
+            with pytest.raises(OSError):
+                _run(CommandRegistry(), [], metrics_port=port, shared_schedule=True, handler_budget_s=1.0)
+            assert set(threading.enumerate()) - before == set()
+
+
+def _assert_port_free(port: int):
+    with socket.socket() as s:
+        # As set by the metrics server, so that connections it has closed don't count
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(('0.0.0.0', port))
+        s.listen()
@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from durapy.backends.memory import InMemoryCommandDatabase
+from durapy.command._scheduler import _CommandScheduler
+from durapy.metrics.memory import InMemoryMetricsSink
+from durapy.tests.command.test_runner import SetValueCommand
+
+
+class _RecordingSender:
+    def __init__(self, num_expected: int = 1):
+        self.sent = []
+        self.sent_at = []
+        self._num_expected = num_expected
+        self.done = threading.Event()
+
+    def __call__(self, command):
+        self.sent.append(command)
+        self.sent_at.append(time.monotonic())
+        if len(self.sent) >= self._num_expected:
+            self.done.set()
+
+
+def _now_ms() -> float:
+    return time.time() * 1e3
+
+
+class TestCommandScheduler:
+    def test_one_off(self):
+        sender = _RecordingSender()
+        scheduler = _CommandScheduler('test', sender, InMemoryMetricsSink())
+        start = time.monotonic()
+        scheduler.schedule(lambda: SetValueCommand(channel=0, value=1), _now_ms() + 50)
+        assert sender.done.wait(5)
+        scheduler.stop()
+        assert sender.sent == [SetValueCommand(channel=0, value=1)]
+        assert sender.sent_at[0] - start >= 0.045
+
+    def test_periodic_does_not_drift(self):
+        sender = _RecordingSender(num_expected=10)
+        scheduler = _CommandScheduler('test', sender, InMemoryMetricsSink())
+        start_ms = _now_ms() + 20
+        start = time.monotonic() + 0.02
+
+        def _slow_factory():
+            # Latency of each send must not push back the next deadline
+            time.sleep(0.005)
+            return SetValueCommand(channel=0, value=0)
+
+        scheduler.schedule(_slow_factory, start_ms, period_ms=20)
+        assert sender.done.wait(5)
+        scheduler.stop()
+        # Deadlines are start + n * period, so the last send is ~9 periods after the first
+        elapsed = sender.sent_at[9] - start
+        assert 0.18 - 0.01 <= elapsed < 0.18 + 0.05
+
+    def test_cancel(self):
+        sender = _RecordingSender()
+        scheduler = _CommandScheduler('test', sender, InMemoryMetricsSink())
+        handle = scheduler.schedule(lambda: SetValueCommand(channel=0, value=1), _now_ms() + 50)
+        scheduler.schedule(lambda: SetValueCommand(channel=0, value=2), _now_ms() + 100)
+        assert handle.cancel()
+        assert not handle.cancel()
+        assert handle.next_at_ms() is None
+        assert sender.done.wait(5)
+        scheduler.stop()
+        assert sender.sent == [SetValueCommand(channel=0, value=2)]
+
+    def test_shared_schedule_survives_scheduler(self):
+        db = InMemoryCommandDatabase()
+        first = _CommandScheduler('first', _RecordingSender(), InMemoryMetricsSink(), command_db=db)
+        first.schedule(lambda: SetValueCommand(channel=0, value=1), _now_ms() + 10)
+        # Stops before the command is due, as if the process died
+        first.stop()
+        assert [s.command for s in db.fetch_scheduled(10)] == [SetValueCommand(channel=0, value=1)]
+
+        sender = _RecordingSender()
+        second = _CommandScheduler(
+            'second', sender, InMemoryMetricsSink(), command_db=db, shared_poll_interval_s=0.01, shared_grace_ms=0)
+        second.start()
+        assert sender.done.wait(5)
+        second.stop()
+        assert sender.sent == [SetValueCommand(channel=0, value=1)]
+        assert db.fetch_scheduled(10) == []
+
+    def test_stopped_scheduler_leaves_shared_schedule_alone(self):
+        db = InMemoryCommandDatabase()
+        scheduler = _CommandScheduler('test', _RecordingSender(), InMemoryMetricsSink(), command_db=db)
+        scheduler.stop()
+        with pytest.raises(RuntimeError):
+            scheduler.schedule(lambda: SetValueCommand(channel=0, value=1), _now_ms() + 10)
+        assert db.fetch_scheduled(10) == []
@@ -0,0 +1,86 @@
+from durapy.backends.memory import InMemoryCommandDatabase
+from durapy.command.command import CommandRegistry
+from durapy.command.model import Context
+from durapy.command.tracing import fetch_trace
+from durapy.tests.command.test_runner import SetValueCommand, ReplyCommand, DoneCommand, _run
+
+
+def _count_down(c: SetValueCommand, context: Context):
+    if c.value > 0:
+        context.send_command(SetValueCommand(channel=c.channel, value=c.value - 1))
+    elif c.channel == 0:
+        context.send_command(ReplyCommand(value=c.channel))
+
+
+class TestTracing:
+    def test_records_parent_keys(self):
+        registry = (
+            CommandRegistry()
+            .register_static_method(SetValueCommand, _count_down)
+            .register_static_method(ReplyCommand, lambda c, ctx: ctx.send_command(DoneCommand()))
+        )
+        runner = _run(registry, [SetValueCommand(channel=0, value=2)], stop=False)
+
+        commands = runner._command_db.fetch_from(100)
+        assert [type(p.command) for p in commands] == \
+            [SetValueCommand, SetValueCommand, SetValueCommand, ReplyCommand, DoneCommand]
+        # Sent from outside of a handler
+        assert commands[0].parent_key is None
+        for parent, child in zip(commands, commands[1:]):
+            assert child.parent_key == parent.key
+
+    def test_rebuilds_chain(self):
+        registry = (
+            CommandRegistry()
+            .register_static_method(SetValueCommand, _count_down)
+            .register_static_method(ReplyCommand, lambda c, ctx: ctx.send_command(DoneCommand()))
+        )
+        # An unrelated chain, interleaved with the traced one
+        runner = _run(registry, [SetValueCommand(channel=0, value=1), SetValueCommand(channel=1, value=1)], stop=False)
+        commands = runner._command_db.fetch_from(100)
+        done = commands[-1]
+        assert isinstance(done.command, DoneCommand)
+
+        trace = fetch_trace(runner._command_db, done.key)
+        assert trace.root_key == commands[0].key
+        assert not trace.truncated
+        assert [(h.persisted_command.command, h.depth) for h in trace.hops] == [
+            (SetValueCommand(channel=0, value=1), 0),
+            (SetValueCommand(channel=0, value=0), 1),
+            (ReplyCommand(value=0), 2),
+            (DoneCommand(), 3),
+        ]
+        assert trace.hops[0].latency_ms is None
+        assert all(h.latency_ms >= 0 for h in trace.hops[1:])
+        assert trace.total_latency_ms() == sum(h.latency_ms for h in trace.hops[1:])
+
+        # Any command in the chain gives the same trace
+        assert fetch_trace(runner._command_db, trace.hops[1].persisted_command.key) == trace
+        assert [h.depth for h in trace.path_to(done.key)] == [0, 1, 2, 3]
+
+    def test_fans_out(self):
+        db = InMemoryCommandDatabase()
+        root = db.send_command(SetValueCommand(channel=0, value=0))
+        children = [db.send_command(SetValueCommand(channel=i, value=1), parent_key=root.key) for i in range(3)]
+        db.send_command(DoneCommand())
+        grandchild = db.send_command(ReplyCommand(value=0), parent_key=children[1].key)
+
+        trace = fetch_trace(db, root.key, page_size=2)
+        assert [h.persisted_command.key for h in trace.hops] == \
+            [root.key] + [c.key for c in children] + [grandchild.key]
+        assert [h.persisted_command.key for h in trace.path_to(grandchild.key)] == \
+            [root.key, children[1].key, grandchild.key]
+
+    def test_truncates(self):
+        db = InMemoryCommandDatabase()
+        root = db.send_command(SetValueCommand(channel=0, value=0))
+        for _ in range(5):
+            db.send_command(DoneCommand())
+        child = db.send_command(ReplyCommand(value=0), parent_key=root.key)
+
+        trace = fetch_trace(db, child.key, max_commands=3)
+        assert trace.truncated
+        assert [h.persisted_command.key for h in trace.hops] == [root.key]
+
+    def test_unknown_key(self):
+        assert fetch_trace(InMemoryCommandDatabase(), 'missing') is None
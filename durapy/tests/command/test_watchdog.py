@@ -0,0 +1,129 @@
+import threading
+import time
+
+from durapy.command import _watchdog
+from durapy.command._watchdog import _Watchdog
+from durapy.command.model import LifecycleListener
+from durapy.metrics.memory import InMemoryMetricsSink
+
+
+class _HealthListener(LifecycleListener):
+    def __init__(self):
+        self.unhealthy_reasons = []
+        self.num_healthy = 0
+
+    def on_started_up(self):
+        pass
+
+    def on_heartbeat(self):
+        pass
+
+    def on_unhealthy(self, reason: str):
+        self.unhealthy_reasons.append(reason)
+
+    def on_healthy(self):
+        self.num_healthy += 1
+
+
+class TestWatchdog:
+    def test_within_budget(self):
+        metrics = InMemoryMetricsSink()
+        w = _Watchdog('test', metrics, budgets_s={}, default_budget_s=10.0)
+        w.on_dispatch_started('SLOW')
+        w.check()
+        w.on_dispatch_finished()
+        assert metrics.counter_value('durapy_handler_overruns_total', {'type': 'SLOW'}) == 0
+
+    def test_overrun_dumps_stacks_once(self, caplog):
+        metrics = InMemoryMetricsSink()
+        listener = _HealthListener()
+        w = _Watchdog('test', metrics, budgets_s={'SLOW': 0.01}, default_budget_s=None, lifecycle_listener=listener)
+        blocked = threading.Event()
+        t = threading.Thread(target=blocked.wait, name='stuck-handler')
+        t.start()
+
+        w.on_dispatch_started('SLOW')
+        time.sleep(0.02)
+        w.check()
+        w.check()
+        blocked.set()
+        t.join()
+        w.on_dispatch_finished()
+
+        assert metrics.counter_value('durapy_handler_overruns_total', {'type': 'SLOW'}) == 1
+        assert 'Thread stuck-handler' in caplog.text
+        assert len(listener.unhealthy_reasons) == 1
+        assert listener.num_healthy == 1
+
+    def test_types_without_budget_ignored(self):
+        metrics = InMemoryMetricsSink()
+        w = _Watchdog('test', metrics, budgets_s={'SLOW': 0.01}, default_budget_s=None)
+        w.on_dispatch_started('FAST')
+        time.sleep(0.02)
+        w.check()
+        assert metrics.counter_value('durapy_handler_overruns_total', {'type': 'FAST'}) == 0
+
+    def test_dispatch_finishing_during_report(self, monkeypatch):
+        metrics = InMemoryMetricsSink()
+        listener = _HealthListener()
+        w = _Watchdog('test', metrics, budgets_s={'SLOW': 0.01}, default_budget_s=None, lifecycle_listener=listener)
+
+        def _finish_while_formatting():
+            # The handler returns while the watchdog thread is dumping stacks
+            w.on_dispatch_finished()
+            return ''
+        monkeypatch.setattr(_watchdog, '_format_all_stacks', _finish_while_formatting)
+
+        w.on_dispatch_started('SLOW')
+        time.sleep(0.02)
+        w.check()
+        assert listener.unhealthy_reasons == []
+
+        # The next dispatch's overrun is still reported
+        w.on_dispatch_started('SLOW')
+        time.sleep(0.02)
+        w.check()
+        assert metrics.counter_value('durapy_handler_overruns_total', {'type': 'SLOW'}) == 2
+
+    def test_reset_health_tolerates_failures(self):
+        class _OldSchemaListener(_HealthListener):
+            def on_healthy(self):
+                raise RuntimeError("Unknown column 'unhealthy_reason'")
+
+        w = _Watchdog('test', InMemoryMetricsSink(), budgets_s={}, default_budget_s=1.0,
+                      lifecycle_listener=_OldSchemaListener())
+        w.reset_health()
+
+    def test_dispatches_not_held_up_by_health_writes(self):
+        writing = threading.Event()
+        release = threading.Event()
+
+        class _SlowListener(_HealthListener):
+            def on_unhealthy(self, reason: str):
+                writing.set()
+                release.wait()
+                super().on_unhealthy(reason)
+
+        listener = _SlowListener()
+        w = _Watchdog('test', InMemoryMetricsSink(), budgets_s={'SLOW': 0.01}, default_budget_s=None,
+                      lifecycle_listener=listener)
+        w.on_dispatch_started('SLOW')
+        time.sleep(0.02)
+        t = threading.Thread(target=w.check)
+        t.start()
+        assert writing.wait(5)
+
+        # Starting the next dispatch doesn't wait for the write; marking healthy again does, and so lands after it
+        finished = threading.Thread(target=w.on_dispatch_finished)
+        finished.start()
+        started = threading.Thread(target=w.on_dispatch_started, args=('FAST',))
+        started.start()
+        try:
+            started.join(5)
+            assert not started.is_alive()
+        finally:
+            release.set()
+        t.join()
+        finished.join()
+        assert len(listener.unhealthy_reasons) == 1
+        assert listener.num_healthy == 1
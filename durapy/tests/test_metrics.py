@@ -0,0 +1,37 @@
+from durapy.metrics.memory import InMemoryMetricsSink, Histogram
+from durapy.metrics.prometheus import render_prometheus_text
+
+
+class TestHistogram:
+    def test_quantiles_bounded_relative_error(self):
+        h = Histogram()
+        for v in range(1, 10001):
+            h.record(float(v))
+        assert h.count == 10000
+        for q in (0.5, 0.9, 0.99):
+            expected = q * 10000
+            assert abs(h.quantile(q) - expected) / expected < 0.05
+        assert h.quantile(1.0) == 10000
+
+    def test_empty(self):
+        assert Histogram().quantile(0.5) is None
+
+
+class TestInMemoryMetricsSink:
+    def test_counters_and_histograms(self):
+        sink = InMemoryMetricsSink()
+        sink.increment('foo_total', labels={'type': 'PING'})
+        sink.increment('foo_total', 2, labels={'type': 'PING'})
+        sink.observe('lat_ms', 1.5, labels={'type': 'PING'})
+        sink.set_gauge('lag', 3)
+        assert sink.counter_value('foo_total', {'type': 'PING'}) == 3
+        assert sink.counter_value('foo_total', {'type': 'PONG'}) == 0
+        assert sink.histogram('lat_ms', {'type': 'PING'}).count == 1
+        assert sink.gauge_value('lag') == 3
+
+        text = render_prometheus_text(sink)
+        assert '# TYPE foo_total counter' in text
+        assert 'foo_total{type="PING"} 3' in text
+        assert 'lat_ms_count{type="PING"} 1' in text
+        assert 'lat_ms{type="PING",quantile="0.5"}' in text
+        assert 'lag 3' in text
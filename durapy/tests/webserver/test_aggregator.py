@@ -0,0 +1,133 @@
+import asyncio
+import json
+import logging
+import socket
+
+from durapy.command._logging import AggregatorHandler
+from durapy.config import LogAggregatorConfiguration
+from durapy.metrics.memory import InMemoryMetricsSink
+from durapy.webserver._aggregator import LogAggregator, _MAX_LINE_BYTES
+from durapy.webserver._tail import LogFilter, LogLine
+
+
+def _record(process_name: str, time: float, message: str):
+    return {'time': time, 'process_name': process_name, 'host': 'h', 'where': 'm.f', 'type': 'INFO',
+            'message': message, 'stack_trace': None}
+
+
+def _unused_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestLogAggregator:
+    def test_keeps_recent_lines_per_process(self, tmp_path):
+        aggregator = LogAggregator(LogAggregatorConfiguration('127.0.0.1', 0, str(tmp_path), ring_size=2))
+        aggregator.add([_record('a', 1.0, 'a1'), _record('b', 2.0, 'b1'), _record('a', 3.0, 'a2')])
+        aggregator.add([_record('a', 4.0, 'a3')])
+
+        lines = aggregator.recent(10)
+        # a1 fell out of process a's ring
+        assert [json.loads(line.text.split('\t')[2])['message'] for line in lines] == ['b1', 'a2', 'a3']
+        assert lines[0].text.split('\t')[:2] == ['1970-01-01T00:00:02+00:00', 'process.b']
+        assert lines[0] == LogLine.parse(lines[0].text)
+        assert len(aggregator.recent(1)) == 1
+        assert [line.process_name for line in aggregator.recent(10, LogFilter(process_names={'b'}))] == ['b']
+        aggregator.stop()
+
+        with open(tmp_path / 'aggregated.000000.log') as f:
+            assert len(f.read().splitlines()) == 4
+
+    def test_publishes_batches(self, tmp_path):
+        aggregator = LogAggregator(LogAggregatorConfiguration('127.0.0.1', 0, str(tmp_path)))
+        batches = []
+        aggregator.subscribe(batches.append)
+        aggregator.add([_record('a', 1.0, 'a1'), _record('a', 2.0, 'a2')])
+        aggregator.unsubscribe(batches.append)
+        aggregator.add([_record('a', 3.0, 'a3')])
+        aggregator.stop()
+        assert [len(batch) for batch in batches] == [2]
+
+    def test_rotates_segments(self, tmp_path):
+        config = LogAggregatorConfiguration('127.0.0.1', 0, str(tmp_path), segment_max_bytes=200, max_segments=2)
+        aggregator = LogAggregator(config)
+        for i in range(10):
+            aggregator.add([_record('a', float(i), 'x' * 100)])
+        aggregator.stop()
+        # Each line fills a segment
+        assert sorted(p.name for p in tmp_path.iterdir()) == ['aggregated.000009.log', 'aggregated.000010.log']
+
+        # Picks up where it left off
+        aggregator = LogAggregator(config)
+        aggregator.add([_record('a', 10.0, 'x')])
+        aggregator.stop()
+        assert sorted(p.name for p in tmp_path.iterdir()) == ['aggregated.000009.log', 'aggregated.000010.log']
+        with open(tmp_path / 'aggregated.000010.log') as f:
+            assert len(f.read().splitlines()) == 1
+
+    def test_receives_from_handler(self, tmp_path):
+        async def run():
+            port = _unused_port()
+            aggregator = LogAggregator(LogAggregatorConfiguration('127.0.0.1', port, str(tmp_path)))
+            aggregator.listen()
+            handler = AggregatorHandler('proc', '127.0.0.1', port, flush_interval_s=60)
+            try:
+                for i in range(3):
+                    handler.handle(logging.makeLogRecord(dict(msg='Message %d', args=(i,), levelname='INFO')))
+                # Sends synchronously, so off of the event loop that's serving the aggregator
+                await asyncio.get_running_loop().run_in_executor(None, handler.flush)
+                for _ in range(100):
+                    if len(aggregator.recent(10)) == 3:
+                        break
+                    await asyncio.sleep(0.01)
+                return aggregator.recent(10)
+            finally:
+                handler.close()
+                aggregator.stop()
+
+        lines = asyncio.run(run())
+        assert [json.loads(line.text.split('\t')[2])['message'] for line in lines] == \
+            ['Message 0', 'Message 1', 'Message 2']
+        assert all(line.process_name == 'proc' for line in lines)
+
+    def test_rejects_malformed_records(self, tmp_path):
+        metrics = InMemoryMetricsSink()
+        aggregator = LogAggregator(LogAggregatorConfiguration('127.0.0.1', 0, str(tmp_path)), metrics)
+        aggregator.add([
+            _record('a', 1.0, 'a1'),
+            {'time': 2.0, 'message': 'no process'},
+            {'process_name': 'a', 'message': 'no time'},
+            _record('a', 1e20, 'time out of range'),
+            [1, 2],
+            'not an object',
+        ])
+        aggregator.stop()
+        assert [json.loads(line.text.split('\t')[2])['message'] for line in aggregator.recent(10)] == ['a1']
+        assert metrics.counter_value('durapy_log_aggregator_rejected_total') == 5
+
+    def test_discards_overlong_lines(self, tmp_path):
+        async def run():
+            port = _unused_port()
+            metrics = InMemoryMetricsSink()
+            aggregator = LogAggregator(LogAggregatorConfiguration('127.0.0.1', port, str(tmp_path)), metrics)
+            aggregator.listen()
+
+            def send():
+                with socket.create_connection(('127.0.0.1', port)) as s:
+                    # Without a newline for longer than is accepted, then a valid record
+                    s.sendall(b'x' * (2 * _MAX_LINE_BYTES) + b'\n')
+                    s.sendall(json.dumps(_record('a', 1.0, 'a1')).encode() + b'\n')
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, send)
+                for _ in range(100):
+                    if len(aggregator.recent(10)) == 1:
+                        break
+                    await asyncio.sleep(0.01)
+                return aggregator.recent(10), metrics.counter_value('durapy_log_aggregator_rejected_total')
+            finally:
+                aggregator.stop()
+
+        lines, num_rejected = asyncio.run(run())
+        assert [json.loads(line.text.split('\t')[2])['message'] for line in lines] == ['a1']
+        assert num_rejected == 1
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import time
+
+from durapy.metrics.memory import InMemoryMetricsSink
+from durapy.webserver._blocking import BlockingExecutor, IOLoopLagMonitor
+
+
+class TestBlockingExecutor:
+    def test_limits_each_pool(self):
+        metrics = InMemoryMetricsSink()
+        blocking = BlockingExecutor(metrics, pool_limits={'slow': 1, 'fast': 2})
+        release = threading.Event()
+        running = []
+
+        def slow(i):
+            running.append(i)
+            release.wait(5)
+            return i
+
+        async def run():
+            slow_calls = [asyncio.ensure_future(blocking.run('slow', slow, i)) for i in range(2)]
+            while len(running) == 0:
+                await asyncio.sleep(0.01)
+            # The slow pool is full, but doesn't hold up other pools
+            assert await blocking.run('fast', lambda: 'fast') == 'fast'
+            await asyncio.sleep(0.05)
+            assert running == [0]
+            release.set()
+            return await asyncio.gather(*slow_calls)
+
+        try:
+            assert asyncio.run(run()) == [0, 1]
+        finally:
+            blocking.shutdown()
+        assert running == [0, 1]
+        assert metrics.gauge_value('durapy_webserver_blocking_in_flight', {'pool': 'slow'}) == 0
+
+
+class TestIOLoopLagMonitor:
+    def test_records_lag(self):
+        metrics = InMemoryMetricsSink()
+
+        async def run():
+            monitor = IOLoopLagMonitor(metrics, interval_s=0.01, warn_lag_s=10)
+            monitor.start()
+            await asyncio.sleep(0)
+            # Blocks the IOLoop
+            time.sleep(0.1)
+            await asyncio.sleep(0.05)
+            monitor.stop()
+
+        asyncio.run(run())
+        assert metrics.gauge_value('durapy_webserver_ioloop_lag_last_ms') is not None
+        assert metrics.histogram('durapy_webserver_ioloop_lag_ms').max >= 50
@@ -0,0 +1,42 @@
+import asyncio
+
+from durapy.backends.memory import InMemoryCommandDatabaseFactory
+from durapy.metrics.base import NoopMetricsSink
+from durapy.tests.command.test_runner import ALL_COMMAND_CLASSES, DoneCommand, SetValueCommand
+from durapy.webserver._blocking import BlockingExecutor
+from durapy.webserver._command_stream import CommandStream
+
+
+class TestCommandStream:
+    def test_broadcasts_and_resumes(self):
+        command_db = InMemoryCommandDatabaseFactory().create('test', ALL_COMMAND_CLASSES)
+        described = []
+
+        def describe(persisted):
+            described.append(persisted.key)
+            return {'key': persisted.key}
+
+        async def run():
+            stream = CommandStream(command_db, describe, BlockingExecutor(NoopMetricsSink()), ring_size=2)
+            batches = []
+            stream.subscribe(batches.append)
+            sent = [command_db.send_command(SetValueCommand(channel=0, value=v)) for v in range(3)]
+            stream.publish(sent)
+            sent.append(command_db.send_command(DoneCommand()))
+            stream.publish(sent[-1:])
+            await asyncio.sleep(0)
+
+            # Only the last two commands are kept in memory; resuming from before those reads the command database
+            from_ring = await stream.since(sent[2].key, 10)
+            from_db = await stream.since(sent[0].key, 2)
+            assert await stream.since('unknown', 10) == []
+            return sent, batches, from_ring, from_db
+
+        sent, batches, from_ring, from_db = asyncio.run(run())
+        keys = [p.key for p in sent]
+        assert [[c.key for c in batch] for batch in batches] == [keys[:3], keys[3:]]
+        assert [c.type for c in batches[0]] == ['SET_VALUE'] * 3
+        assert [c.description for c in from_ring] == [{'key': keys[3]}]
+        assert [c.key for c in from_db] == keys[1:3]
+        # Described once as published, and again only when read back from the command database
+        assert described == keys + keys[1:3]
@@ -0,0 +1,113 @@
+import datetime
+import json
+import logging
+
+from durapy.webserver._index import LogIndex, _BLOCK_SIZE
+
+
+def _line(seconds: int, process_name: str, level: str, message: str) -> str:
+    timestamp = datetime.datetime.fromtimestamp(seconds, tz=datetime.timezone.utc).isoformat()
+    return f'{timestamp}\tprocess.{process_name}\t{json.dumps({"type": level, "message": message})}\n'
+
+
+class TestLogIndex:
+    def test_searches_by_token_process_level_and_time(self, tmp_path):
+        with open(tmp_path / 'a.log', 'w') as f:
+            f.write(_line(100, 'pinger', 'INFO', 'Sent ping #1'))
+            f.write(_line(101, 'ponger', 'WARNING', 'Slow PING handler'))
+            f.write(_line(102, 'pinger', 'ERROR', 'Lost connection'))
+            f.write(_line(103, 'pinger', 'INFO', 'Sent ping #2'))
+        index = LogIndex(str(tmp_path))
+        index.index_once()
+        assert index.num_lines() == 4
+
+        def texts(**kwargs):
+            return [r.text.split('"message": ')[1] for r in index.search(**kwargs).results]
+
+        assert texts(query='ping') == ['"Sent ping #2"}', '"Slow PING handler"}', '"Sent ping #1"}']
+        assert texts(query='sent ping') == ['"Sent ping #2"}', '"Sent ping #1"}']
+        assert texts(query='ping', process_names={'ponger'}) == ['"Slow PING handler"}']
+        assert texts(min_level=logging.WARNING) == ['"Lost connection"}', '"Slow PING handler"}']
+        assert texts(since=101, until=102) == ['"Lost connection"}', '"Slow PING handler"}']
+        assert texts(query='pong') == []
+        assert texts(process_names={'unknown'}) == []
+
+        result = index.search(query='lost').results[0]
+        assert (result.time, result.process_name, result.level) == (102, 'pinger', 'ERROR')
+
+    def test_paginates(self, tmp_path):
+        with open(tmp_path / 'a.log', 'w') as f:
+            for i in range(10):
+                f.write(_line(i, 'pinger', 'INFO', f'message {i}'))
+        index = LogIndex(str(tmp_path))
+        index.index_once()
+
+        seen = []
+        cursor = None
+        while True:
+            page = index.search(query='message', cursor=cursor, limit=3)
+            seen.extend(r.line_id for r in page.results)
+            if page.next_cursor is None:
+                break
+            cursor = page.next_cursor
+        assert seen == list(range(9, -1, -1))
+
+        # Bounding the scan still leaves a cursor to continue from
+        page = index.search(query='message', limit=5, max_scanned=2)
+        assert [r.line_id for r in page.results] == [9, 8]
+        assert [r.line_id for r in index.search(cursor=page.next_cursor, limit=1).results] == [7]
+
+    def test_indexes_incrementally(self, tmp_path):
+        path = tmp_path / 'a.log'
+        with open(path, 'w') as f:
+            f.write(_line(0, 'pinger', 'INFO', 'first'))
+            # Not yet terminated, so not yet indexed
+            f.write(_line(1, 'pinger', 'INFO', 'second').rstrip('\n'))
+        index = LogIndex(str(tmp_path))
+        index.index_once()
+        assert index.num_lines() == 1
+
+        with open(path, 'a') as f:
+            f.write('\n')
+        with open(tmp_path / 'b.log', 'w') as f:
+            f.write(_line(2, 'ponger', 'INFO', 'third'))
+        index.index_once()
+        assert [r.line_id for r in index.search().results] == [2, 1, 0]
+        assert index.search(query='second').results[0].text == _line(1, 'pinger', 'INFO', 'second').rstrip('\n')
+
+        # Lines of a replaced file are no longer returned
+        with open(tmp_path / 'a.log.new', 'w') as f:
+            f.write(_line(3, 'pinger', 'INFO', 'fourth'))
+        (tmp_path / 'a.log.new').replace(path)
+        index.index_once()
+        assert [r.text.split('"message": ')[1] for r in index.search().results] == ['"fourth"}', '"third"}']
+
+    def test_evicts_deleted_files(self, tmp_path):
+        with open(tmp_path / 'a.log', 'w') as f:
+            for i in range(2 * _BLOCK_SIZE):
+                f.write(_line(i, 'pinger', 'INFO', f'hello {i}'))
+        index = LogIndex(str(tmp_path))
+        index.index_once()
+        with open(tmp_path / 'b.log', 'w') as f:
+            f.write(_line(10000, 'pinger', 'INFO', 'hello again'))
+        index.index_once()
+        cursor = index.search(query='hello', limit=1).next_cursor
+
+        (tmp_path / 'a.log').unlink()
+        index.index_once()
+        assert index.num_lines() == 1
+        assert [r.text.split('"message": ')[1] for r in index.search(query='hello').results] == ['"hello again"}']
+        assert index.search(query='hello', cursor=cursor).results == []
+        assert index.search(process_names={'pinger'}, since=0, until=20000).results[0].line_id == 2 * _BLOCK_SIZE
+
+    def test_bounds_number_of_lines(self, tmp_path):
+        with open(tmp_path / 'a.log', 'w') as f:
+            for i in range(4 * _BLOCK_SIZE):
+                f.write(_line(i, 'pinger', 'INFO', f'message {i}'))
+        index = LogIndex(str(tmp_path), max_lines=2 * _BLOCK_SIZE)
+        index.index_once()
+        assert index.num_lines() <= 2 * _BLOCK_SIZE
+        page = index.search(query='message', limit=1)
+        assert page.results[0].text.endswith(f'"message {4 * _BLOCK_SIZE - 1}"}}')
+        assert index.search(query='message', cursor=page.next_cursor, limit=1).results[0].line_id == \
+            4 * _BLOCK_SIZE - 2
@@ -1,8 +1,11 @@
 import dataclasses
-from typing import List
+from enum import Enum
+from typing import List, Optional
+
+import pytest
 
 from durapy.webserver._inspect import _extract_flattened_field_descriptions_class, \
-    populate_from_field_descriptions_class
+    populate_from_field_descriptions_class, populator_for, schema_for, PopulationError
 from durapy.command.model import BaseCommand
 
 
@@ -44,4 +47,82 @@ class TestInspect2:
                 'nested.nested_str': 'zxcv',
                 # 'nested.nested_list_int': json.dumps([1, 2, 5]),
             }
-        ))
\ No newline at end of file
+        ))
+
+
+@dataclasses.dataclass
+class OptionalNestedCommand(BaseCommand):
+    nested: Optional[Nested] = None
+    flag: bool = True
+
+    @staticmethod
+    def type() -> str:
+        return 'OPTIONAL_NESTED'
+
+
+class TestClassSchema:
+    def test_matches_reflection(self):
+        instances = [
+            TestCommandPrint(msg='msg', nested=Nested(nested_int=1, nested_str='s', nested_list_int=[1, 2])),
+            OptionalNestedCommand(),
+            OptionalNestedCommand(nested=Nested(nested_int=2, nested_str='t'), flag=False),
+        ]
+        for instance in instances:
+            schema = schema_for(instance.__class__)
+            assert schema is schema_for(instance.__class__)
+            assert schema.describe_instance(instance) == [
+                fd.to_dict(encode_json=True)
+                for fd in _extract_flattened_field_descriptions_class(instance.__class__, instance)]
+            assert schema.describe() == [
+                fd.to_dict(encode_json=True)
+                for fd in _extract_flattened_field_descriptions_class(instance.__class__, None)]
+
+
+class Color(Enum):
+    RED = 1
+    BLUE = 2
+
+
+@dataclasses.dataclass
+class TypedCommand(BaseCommand):
+    count: int
+    color: Color = Color.RED
+    enabled: bool = False
+    ratios: List[float] = dataclasses.field(default_factory=list)
+    nested: Optional[Nested] = None
+
+    @staticmethod
+    def type() -> str:
+        return 'TYPED'
+
+
+class TestPopulator:
+    def test_converts_flattened_fields(self):
+        assert populate_from_field_descriptions_class(TypedCommand, id_value_map={
+            'count': '3',
+            'color': 'BLUE',
+            'enabled': 'true',
+            'ratios': '[0.5, 1]',
+            'nested.nested_int': '4',
+            'nested.nested_str': 's',
+            'nested.nested_list_int': "[1, '2']",
+        }) == TypedCommand(
+            count=3, color=Color.BLUE, enabled=True, ratios=[0.5, 1.0],
+            nested=Nested(nested_int=4, nested_str='s', nested_list_int=[1, 2]))
+
+    def test_defaults(self):
+        assert populate_from_field_descriptions_class(TypedCommand, id_value_map={'count': 1, 'enabled': ''}) == \
+            TypedCommand(count=1)
+        assert populator_for(TypedCommand) is populator_for(TypedCommand)
+
+    def test_reports_every_invalid_field(self):
+        with pytest.raises(PopulationError) as e:
+            populate_from_field_descriptions_class(TypedCommand, id_value_map={
+                'color': 'GREEN',
+                'ratios': '[1, "x"]',
+                'nested.nested_int': 'x',
+                'unknown': 1,
+            })
+        assert set(e.value.errors) == {'count', 'color', 'ratios', 'nested.nested_int', 'nested.nested_str', 'unknown'}
+        assert e.value.errors['count'] == 'Required.'
+        assert e.value.errors['nested.nested_int'].startswith("Invalid value 'x'")
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+
+from durapy.deploy.status.config import LifecycleDatabaseConfiguration
+from durapy.metrics.base import NoopMetricsSink
+from durapy.webserver._blocking import BlockingExecutor
+from durapy.webserver._statuses import ProcessStatusCache
+
+
+class _FakeStatusDatabase:
+    def __init__(self):
+        self.num_fetches = 0
+        self.release = threading.Event()
+
+    def fetch_all(self):
+        self.release.wait(5)
+        self.num_fetches += 1
+        return [f'status #{self.num_fetches}']
+
+
+class TestProcessStatusCache:
+    def test_coalesces_and_caches(self):
+        blocking = BlockingExecutor(NoopMetricsSink())
+        cache = ProcessStatusCache(LifecycleDatabaseConfiguration('user', 'host', 'db'), blocking, ttl_s=60)
+        db = cache._db = _FakeStatusDatabase()
+
+        async def run():
+            concurrent = [asyncio.ensure_future(cache.fetch_all()) for _ in range(5)]
+            await asyncio.sleep(0.05)
+            db.release.set()
+            results = await asyncio.gather(*concurrent)
+            return results, await cache.fetch_all()
+
+        try:
+            results, cached = asyncio.run(run())
+        finally:
+            blocking.shutdown()
+        assert results == [['status #1']] * 5
+        assert cached == ['status #1']
+        assert db.num_fetches == 1
+
+    def test_refetches_after_ttl(self):
+        blocking = BlockingExecutor(NoopMetricsSink())
+        cache = ProcessStatusCache(LifecycleDatabaseConfiguration('user', 'host', 'db'), blocking, ttl_s=0)
+        db = cache._db = _FakeStatusDatabase()
+        db.release.set()
+
+        async def run():
+            return [await cache.fetch_all() for _ in range(2)]
+
+        try:
+            assert asyncio.run(run()) == [['status #1'], ['status #2']]
+        finally:
+            blocking.shutdown()
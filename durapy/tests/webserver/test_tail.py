@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+
+import pytest
+
+from durapy.webserver._tail import LogFilter, LogFollower, LogLine
+
+
+def _line(timestamp: str, process_name: str, level: str, message: str) -> str:
+    return f'{timestamp}\tprocess.{process_name}\t{json.dumps({"type": level, "message": message})}\n'
+
+
+async def _wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError()
+
+
+class TestLogLine:
+    def test_parses_fluentd_format(self):
+        line = LogLine.parse(_line('2024-01-01T00:00:00+00:00', 'pinger', 'WARNING', 'hi').rstrip('\n'))
+        assert (line.timestamp, line.process_name, line.level) == ('2024-01-01T00:00:00+00:00', 'pinger', 'WARNING')
+        assert LogLine.parse('not a log line') == LogLine(text='not a log line')
+
+    def test_filters(self):
+        line = LogLine.parse(_line('t', 'pinger', 'WARNING', 'hi').rstrip('\n'))
+        assert LogFilter().matches(line)
+        assert LogFilter(process_names={'pinger'}, min_level=logging.WARNING).matches(line)
+        assert not LogFilter(process_names={'ponger'}).matches(line)
+        assert not LogFilter(min_level=logging.ERROR).matches(line)
+        assert not LogFilter(min_level=logging.INFO).matches(LogLine(text='unparsed'))
+
+
+class TestLogFollower:
+    @pytest.mark.parametrize('use_inotify', [True, False])
+    def test_backfills_and_follows(self, tmp_path, use_inotify):
+        with open(tmp_path / 'a.log', 'w') as f:
+            f.write(_line('2024-01-01T00:00:01', 'a', 'INFO', 'a1'))
+        with open(tmp_path / 'b.log', 'w') as f:
+            f.write(_line('2024-01-01T00:00:00', 'b', 'INFO', 'b1'))
+
+        async def run():
+            follower = LogFollower(str(tmp_path), poll_interval_s=0.01, use_inotify=use_inotify)
+            batches = []
+            try:
+                follower.subscribe(batches.append)
+                backfill = [line.process_name for line in follower.recent(10)]
+
+                with open(tmp_path / 'a.log', 'a') as f:
+                    f.write(_line('2024-01-01T00:00:02', 'a', 'ERROR', 'a2'))
+                    # Incomplete lines wait for their newline
+                    f.write(_line('2024-01-01T00:00:03', 'a', 'INFO', 'a3')[:10])
+                await _wait_for(lambda: len(batches) > 0)
+                with open(tmp_path / 'c.log', 'w') as f:
+                    f.write(_line('2024-01-01T00:00:04', 'c', 'INFO', 'c1'))
+                await _wait_for(lambda: len(batches) > 1)
+            finally:
+                follower.stop()
+            return backfill, batches, follower.recent(10, LogFilter(min_level=logging.ERROR))
+
+        backfill, batches, errors = asyncio.run(run())
+        # Oldest first across files
+        assert backfill == ['b', 'a']
+        assert [[line.process_name for line in batch] for batch in batches] == [['a'], ['c']]
+        assert [line.level for line in errors] == ['ERROR']
+
+    def test_follows_truncated_files(self, tmp_path):
+        with open(tmp_path / 'a.log', 'w') as f:
+            f.write(_line('t', 'a', 'INFO', 'before'))
+
+        async def run():
+            follower = LogFollower(str(tmp_path), poll_interval_s=0.01, use_inotify=False)
+            batches = []
+            try:
+                follower.subscribe(batches.append)
+                with open(tmp_path / 'a.log', 'w') as f:
+                    f.write(_line('t', 'a', 'INFO', 'x'))
+                await _wait_for(lambda: len(batches) > 0)
+            finally:
+                follower.stop()
+            return batches
+
+        batches = asyncio.run(run())
+        assert [json.loads(line.text.split('\t')[2])['message'] for line in batches[0]] == ['x']
+
+    def test_follows_files_removed_and_recreated(self, tmp_path):
+        with open(tmp_path / 'a.log', 'w') as f:
+            f.write(_line('t', 'a', 'INFO', 'a1'))
+        with open(tmp_path / 'b.log', 'w') as f:
+            f.write(_line('t', 'b', 'INFO', 'b1'))
+
+        async def run():
+            follower = LogFollower(str(tmp_path), poll_interval_s=0.01, use_inotify=False)
+            # As if b.log were removed between listing the files and reading them
+            listed = follower._paths()
+            (tmp_path / 'b.log').unlink()
+            follower._paths = lambda: listed
+            batches = []
+            try:
+                follower.subscribe(batches.append)
+                del follower._paths
+                with open(tmp_path / 'b.log', 'w') as f:
+                    f.write(_line('t', 'b', 'INFO', 'b2'))
+                await _wait_for(lambda: len(batches) > 0)
+                (tmp_path / 'a.log').unlink()
+                with open(tmp_path / 'b.log', 'a') as f:
+                    f.write(_line('t', 'b', 'INFO', 'b3'))
+                await _wait_for(lambda: len(batches) > 1)
+            finally:
+                follower.stop()
+            return batches, set(follower._files)
+
+        batches, followed = asyncio.run(run())
+        assert [[json.loads(line.text.split('\t')[2])['message'] for line in batch] for batch in batches] == \
+            [['b2'], ['b3']]
+        assert followed == {str(tmp_path / 'b.log')}
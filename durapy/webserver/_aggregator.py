@@ -0,0 +1,211 @@
+import collections
+import datetime
+import heapq
+import itertools
+import json
+import os
+import re
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import tornado.iostream
+import tornado.tcpserver
+
+from durapy.config import LogAggregatorConfiguration
+from durapy.metrics.base import MetricsSink, NoopMetricsSink
+from durapy.webserver._tail import LogFilter, LogLine, LogSource
+
+# Names of segment files, numbered in the order they were written.
+_SEGMENT_FORMAT = 'aggregated.{:06d}.log'
+_SEGMENT_PATTERN = re.compile(r'^aggregated\.(\d{6})\.log$')
+
+# Largest chunk read from a process's connection at once. Each chunk's complete lines are added as a single batch.
+_READ_CHUNK_BYTES = 64 * 1024
+
+# Longest line accepted from a process's connection; longer ones are discarded up to the next newline.
+_MAX_LINE_BYTES = 1024 * 1024
+
+
+def to_log_line(record: Dict) -> LogLine:
+    """
+    Formats a log record shipped by an AggregatorHandler the same way fluentd's file output does, i.e.
+    <ISO 8601 time>\tprocess.<process name>\t<JSON of the remaining fields>.
+    """
+    timestamp = datetime.datetime.fromtimestamp(record['time'], tz=datetime.timezone.utc).isoformat()
+    fields = {k: v for k, v in record.items() if k not in ('time', 'process_name')}
+    return LogLine(
+        text=f'{timestamp}\tprocess.{record["process_name"]}\t{json.dumps(fields)}',
+        timestamp=timestamp,
+        process_name=record['process_name'],
+        level=record.get('type'))
+
+
+def _to_valid_log_line(record) -> Optional[LogLine]:
+    """
+    The record as a LogLine, or None if it's malformed.
+    """
+    if not isinstance(record, dict) or not isinstance(record.get('process_name'), str):
+        return None
+    record_time = record.get('time')
+    if not isinstance(record_time, (int, float)) or isinstance(record_time, bool):
+        return None
+    try:
+        return to_log_line(record)
+    except (OverflowError, OSError, ValueError):
+        # Times out of range
+        return None
+
+
+class _SegmentLog:
+    """
+    Append-only log split across segment files of bounded size, deleting the oldest segments beyond a maximum count.
+    """
+
+    def __init__(self, log_dir: str, segment_max_bytes: int, max_segments: int):
+        self._log_dir = log_dir
+        self._segment_max_bytes = segment_max_bytes
+        self._max_segments = max_segments
+        os.makedirs(log_dir, exist_ok=True)
+
+        # Continue appending to the newest segment, e.g. after the webserver restarts
+        segments = self.segments()
+        self._index = segments[-1][0] if len(segments) > 0 else 0
+        self._file = open(self._path(self._index), 'a')
+
+    def segments(self) -> List[Tuple[int, str]]:
+        """
+        (index, path) of each segment file, oldest first.
+        """
+        ret = []
+        for filename in os.listdir(self._log_dir):
+            match = _SEGMENT_PATTERN.match(filename)
+            if match is not None:
+                ret.append((int(match.group(1)), os.path.join(self._log_dir, filename)))
+        return sorted(ret)
+
+    def write(self, lines: List[str]):
+        self._file.write(''.join(f'{line}\n' for line in lines))
+        self._file.flush()
+        if self._file.tell() >= self._segment_max_bytes:
+            self._rotate()
+
+    def close(self):
+        self._file.close()
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self._log_dir, _SEGMENT_FORMAT.format(index))
+
+    def _rotate(self):
+        self._file.close()
+        self._index += 1
+        self._file = open(self._path(self._index), 'a')
+        segments = self.segments()
+        for _, path in segments[:max(0, len(segments) - self._max_segments)]:
+            os.remove(path)
+
+
+class LogAggregator(LogSource):
+    """
+    The webserver's built-in log aggregator. Processes ship batches of log records to it over TCP (see
+    durapy.command._logging.AggregatorHandler); it keeps the most recent lines of each process in memory, appends all
+    lines to an on-disk segment log, and passes each batch on to subscribers, i.e. tail websockets.
+
+    Records that aren't JSON objects with a numeric `time` and a string `process_name` are dropped and counted in
+    durapy_log_aggregator_rejected_total.
+
+    Everything runs on the IOLoop's thread, so no locking is needed.
+    """
+
+    def __init__(self, config: LogAggregatorConfiguration, metrics_sink: Optional[MetricsSink] = None):
+        self._config = config
+        self._metrics = metrics_sink if metrics_sink is not None else NoopMetricsSink()
+        self._segments = _SegmentLog(config.log_dir, config.segment_max_bytes, config.max_segments)
+
+        # (time, line) of recent lines, by process name.
+        self._rings: Dict[str, Deque[Tuple[float, LogLine]]] = {}
+        self._subscribers: Set[Callable[[List[LogLine]], None]] = set()
+        self._server: Optional[_LogAggregatorServer] = None
+
+    def listen(self):
+        self._server = _LogAggregatorServer(self)
+        self._server.listen(self._config.port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        self._segments.close()
+
+    def add(self, records: List[Dict]):
+        lines = []
+        for record in records:
+            line = _to_valid_log_line(record)
+            if line is None:
+                self.reject()
+                continue
+            ring = self._rings.get(record['process_name'])
+            if ring is None:
+                ring = self._rings[record['process_name']] = collections.deque(maxlen=self._config.ring_size)
+            ring.append((record['time'], line))
+            lines.append(line)
+        if len(lines) == 0:
+            return
+        self._segments.write([line.text for line in lines])
+        for subscriber in list(self._subscribers):
+            subscriber(lines)
+
+    def reject(self, num: int = 1):
+        """
+        Counts records that were dropped as malformed.
+        """
+        self._metrics.increment('durapy_log_aggregator_rejected_total', num)
+
+    def recent(self, num: int, log_filter: Optional[LogFilter] = None) -> List[LogLine]:
+        entries = itertools.chain.from_iterable(self._rings.values())
+        if log_filter is not None:
+            entries = (e for e in entries if log_filter.matches(e[1]))
+        latest = heapq.nlargest(num, entries, key=lambda e: e[0])
+        return [line for _, line in reversed(latest)]
+
+    def subscribe(self, callback: Callable[[List[LogLine]], None]):
+        self._subscribers.add(callback)
+
+    def unsubscribe(self, callback: Callable[[List[LogLine]], None]):
+        self._subscribers.discard(callback)
+
+
+class _LogAggregatorServer(tornado.tcpserver.TCPServer):
+    def __init__(self, aggregator: LogAggregator):
+        super().__init__()
+        self._aggregator = aggregator
+
+    async def handle_stream(self, stream: tornado.iostream.IOStream, address):
+        remainder = b''
+        # Whether the rest of an overlong line is being discarded
+        discarding = False
+        try:
+            while True:
+                chunk = await stream.read_bytes(_READ_CHUNK_BYTES, partial=True)
+                if discarding:
+                    newline = chunk.find(b'\n')
+                    if newline < 0:
+                        continue
+                    chunk = chunk[newline + 1:]
+                    discarding = False
+                lines = (remainder + chunk).split(b'\n')
+                # Incomplete until the next chunk
+                remainder = lines.pop()
+                if len(remainder) > _MAX_LINE_BYTES:
+                    remainder = b''
+                    discarding = True
+                    self._aggregator.reject()
+                records = []
+                for line in lines:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Not logged, since the webserver's own logs come through here too
+                        self._aggregator.reject()
+                        continue
+                self._aggregator.add(records)
+        except tornado.iostream.StreamClosedError:
+            pass
@@ -0,0 +1,99 @@
+import concurrent.futures
+import logging
+import time
+from typing import Callable, Dict, Optional, TypeVar
+
+import tornado.ioloop
+import tornado.locks
+
+from durapy.metrics.base import MetricsSink
+
+_T = TypeVar('_T')
+
+# Pools of blocking calls made by the webserver's handlers, and how many calls of each may run at once.
+COMMANDS_POOL = 'commands'
+LIFECYCLE_POOL = 'lifecycle'
+DEPLOY_POOL = 'deploy'
+LOGS_POOL = 'logs'
+DEFAULT_POOL_LIMITS = {
+    # Command database calls, e.g. to Redis; quick, but on every page
+    COMMANDS_POOL: 8,
+    # Lifecycle database queries, e.g. to MySQL
+    LIFECYCLE_POOL: 2,
+    # Deploys over SSH, which can take minutes
+    DEPLOY_POOL: 4,
+    # Searches of the aggregated logs' index, which can scan many lines, and reads of profiles from the log directory
+    LOGS_POOL: 2,
+}
+
+
+class BlockingExecutor:
+    """
+    Runs the blocking calls made by webserver handlers on a bounded thread pool, so that the IOLoop keeps serving other
+    requests and websockets meanwhile. Each pool of calls has its own concurrency limit on top of that, so that e.g. a
+    few slow deploys can't take up every thread and hold up command database calls. Calls beyond a pool's limit wait
+    on the IOLoop, without taking up a thread.
+    """
+
+    def __init__(self, metrics_sink: MetricsSink, pool_limits: Optional[Dict[str, int]] = None):
+        self._metrics = metrics_sink
+        pool_limits = pool_limits if pool_limits is not None else DEFAULT_POOL_LIMITS
+        self._semaphores = {pool: tornado.locks.Semaphore(limit) for pool, limit in pool_limits.items()}
+        self._in_flight = {pool: 0 for pool in pool_limits}
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=sum(pool_limits.values()), thread_name_prefix='webserver-blocking')
+
+    async def run(self, pool: str, fn: Callable[..., _T], *args) -> _T:
+        """
+        Runs `fn(*args)` on the executor once the given pool has room, returning its result. Must be awaited on the
+        IOLoop.
+        """
+        start = time.perf_counter()
+        async with self._semaphores[pool]:
+            self._metrics.observe('durapy_webserver_blocking_wait_ms', 1e3 * (time.perf_counter() - start),
+                                  labels={'pool': pool})
+            self._in_flight[pool] += 1
+            self._metrics.set_gauge('durapy_webserver_blocking_in_flight', self._in_flight[pool], labels={'pool': pool})
+            try:
+                return await tornado.ioloop.IOLoop.current().run_in_executor(self._executor, fn, *args)
+            finally:
+                self._in_flight[pool] -= 1
+                self._metrics.set_gauge(
+                    'durapy_webserver_blocking_in_flight', self._in_flight[pool], labels={'pool': pool})
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class IOLoopLagMonitor:
+    """
+    Measures how late the IOLoop runs a callback scheduled every `interval_s`, i.e. how long it was kept busy by
+    something blocking it. Lag is recorded in durapy_webserver_ioloop_lag_ms, and lags over `warn_lag_s` are logged.
+    """
+
+    def __init__(self, metrics_sink: MetricsSink, interval_s: float = 0.5, warn_lag_s: float = 1.0):
+        self._metrics = metrics_sink
+        self._interval_s = interval_s
+        self._warn_lag_s = warn_lag_s
+        self._timeout = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self):
+        loop = tornado.ioloop.IOLoop.current()
+        expected = loop.time() + self._interval_s
+        self._timeout = loop.call_at(expected, self._check, expected)
+
+    def _check(self, expected: float):
+        lag_s = max(0.0, tornado.ioloop.IOLoop.current().time() - expected)
+        self._metrics.observe('durapy_webserver_ioloop_lag_ms', 1e3 * lag_s)
+        self._metrics.set_gauge('durapy_webserver_ioloop_lag_last_ms', 1e3 * lag_s)
+        if lag_s > self._warn_lag_s:
+            logging.warning(f'Webserver IOLoop was blocked for {lag_s:.2f}s.')
+        self._schedule()
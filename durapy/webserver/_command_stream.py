@@ -0,0 +1,74 @@
+import collections
+import dataclasses
+from typing import Callable, Deque, Dict, List, Set
+
+import tornado.ioloop
+
+from durapy.backends.base import CommandDatabase
+from durapy.command.model import PersistedCommand
+from durapy.webserver._blocking import BlockingExecutor, COMMANDS_POOL
+
+
+@dataclasses.dataclass
+class StreamedCommand:
+    key: str
+    type: str
+
+    # JSON-able description of the command, as returned by GET /api/commands.
+    description: Dict
+
+
+class CommandStream:
+    """
+    Live stream of newly persisted commands for /ws/commands websockets. It's fed by the webserver's own process runner
+    as it fetches commands (see ProcessRunner's `on_fetched`), so the command database is tailed once however many
+    websockets are open. Each command is described once, on the runner's thread, and that description is sent to every
+    subscriber. The most recent commands are kept so that reconnecting clients can resume from the last key they saw.
+
+    Everything other than #publish runs on the IOLoop's thread.
+    """
+
+    def __init__(
+            self,
+            command_db: CommandDatabase,
+            describe: Callable[[PersistedCommand], Dict],
+            blocking: BlockingExecutor,
+            ring_size: int = 1000):
+        self._command_db = command_db
+        self._describe = describe
+        self._blocking = blocking
+        self._loop = tornado.ioloop.IOLoop.current()
+        self._ring: Deque[StreamedCommand] = collections.deque(maxlen=ring_size)
+        self._subscribers: Set[Callable[[List[StreamedCommand]], None]] = set()
+
+    def publish(self, fetched: List[PersistedCommand]):
+        """
+        Describes and broadcasts freshly fetched commands. Safe to call from any thread.
+        """
+        batch = [StreamedCommand(key=p.key, type=p.command.type(), description=self._describe(p)) for p in fetched]
+        self._loop.add_callback(self._broadcast, batch)
+
+    def subscribe(self, callback: Callable[[List[StreamedCommand]], None]):
+        self._subscribers.add(callback)
+
+    def unsubscribe(self, callback: Callable[[List[StreamedCommand]], None]):
+        self._subscribers.discard(callback)
+
+    async def since(self, key: str, max_num: int) -> List[StreamedCommand]:
+        """
+        Up to `max_num` commands persisted after the one with the given key, oldest first. Served from memory if the key
+        is recent enough, and otherwise read from the command database.
+        """
+        ring = list(self._ring)
+        idx = next((i for i, c in enumerate(ring) if c.key == key), None)
+        if idx is not None:
+            return ring[idx + 1:idx + 1 + max_num]
+
+        persisted = await self._blocking.run(COMMANDS_POOL, lambda: self._command_db.fetch_from(max_num, cursor=key))
+        return [StreamedCommand(key=p.key, type=p.command.type(), description=self._describe(p)) for p in persisted]
+
+    def _broadcast(self, batch: List[StreamedCommand]):
+        self._ring.extend(batch)
+        for subscriber in list(self._subscribers):
+            subscriber(batch)
+
@@ -0,0 +1,428 @@
+import array
+import bisect
+import dataclasses
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import threading
+from typing import Dict, Iterator, List, Optional, Set
+
+from durapy.command.threading import LoggingThread
+
+# Tokens of messages that are indexed, and of search queries. Tokens are lowercased.
+_TOKEN_PATTERN = re.compile(r'[A-Za-z0-9_]{2,32}')
+
+# Bound on the number of distinct tokens indexed per line, so a single huge line can't blow up the index.
+_MAX_TOKENS_PER_LINE = 64
+
+# Lines are grouped into blocks of this many, each with the range of its lines' times, so that time-bounded searches
+# can skip over whole blocks.
+_BLOCK_SIZE = 1024
+
+# Number of lines indexed at a time while holding the lock, so searches aren't held up by a large backlog.
+_INDEX_CHUNK_LINES = 10000
+
+# Default bound on the number of lines kept in the index; roughly 100 bytes each.
+_DEFAULT_MAX_LINES = 2000000
+
+
+@dataclasses.dataclass
+class LogSearchResult:
+    # Position of the line in the index; pass as the cursor to continue after it.
+    line_id: int
+
+    # Seconds since the Unix epoch, or 0 if the line has no parseable time.
+    time: float
+    process_name: Optional[str]
+    level: Optional[str]
+    text: str
+
+
+@dataclasses.dataclass
+class LogSearchPage:
+    results: List[LogSearchResult]
+
+    # Cursor for the next page, or None if there are no more results.
+    next_cursor: Optional[int]
+
+
+class _IndexedFile:
+    def __init__(self, file_id: int, path: str, inode: int):
+        self.file_id = file_id
+        self.path = path
+        self.inode = inode
+        self.offset = 0
+        # Time of the previous line in this file, for lines without one
+        self.last_time = 0.0
+
+
+class LogIndex:
+    """
+    Incremental in-memory index of aggregated log files, i.e. those written by fluentd or by the built-in log
+    aggregator, in fluentd's file output format. Lines are numbered in the order they're indexed, which follows the
+    order they were written within each file; files are first indexed oldest first. For each line, the index keeps its
+    location, time, process and level, alongside postings lists (sorted arrays of line numbers) by process, by level
+    and by each token of the message, so searches only visit candidate lines.
+
+    A background thread indexes the existing files and then picks up appended lines and new files every
+    `poll_interval_s`. Searches may be made from any thread.
+
+    Lines of files that are deleted or replaced are no longer returned, and the oldest lines are evicted once they're
+    all in such files (e.g. as the log aggregator deletes its oldest segments), or once there are more than
+    `max_lines`. Line numbers aren't reused, so cursors stay valid across evictions.
+    """
+
+    def __init__(self, log_dir: str, poll_interval_s: float = 1.0, max_lines: int = _DEFAULT_MAX_LINES):
+        self._log_dir = log_dir
+        self._poll_interval_s = poll_interval_s
+        self._max_lines = max_lines
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[LoggingThread] = None
+
+        self._files: Dict[str, _IndexedFile] = {}
+        self._file_paths: List[Optional[str]] = []
+
+        # Line number of the first line still in the index; always a multiple of _BLOCK_SIZE.
+        self._base = 0
+
+        # Columns, indexed by line number - self._base
+        self._line_files = array.array('I')
+        self._line_offsets = array.array('Q')
+        self._line_times = array.array('d')
+        self._line_processes = array.array('I')
+        self._line_levels = array.array('B')
+
+        # (min, max) time of each block of lines, from the block starting at self._base
+        self._block_min_times = array.array('d')
+        self._block_max_times = array.array('d')
+
+        # Process names, by ID; ID 0 is for lines without a process.
+        self._process_names: List[Optional[str]] = [None]
+        self._process_ids: Dict[str, int] = {}
+
+        # Postings lists
+        self._by_process: Dict[int, array.array] = {}
+        self._by_level: Dict[int, array.array] = {}
+        self._by_token: Dict[str, array.array] = {}
+
+    def start(self):
+        self._thread = LoggingThread(target=self._run, name='log-indexer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def num_lines(self) -> int:
+        return len(self._line_files)
+
+    def search(
+            self,
+            query: str = '',
+            process_names: Optional[Set[str]] = None,
+            min_level: Optional[int] = None,
+            since: Optional[float] = None,
+            until: Optional[float] = None,
+            cursor: Optional[int] = None,
+            limit: int = 100,
+            max_scanned: int = 1000000) -> LogSearchPage:
+        """
+        Searches for lines containing every token of `query`, newest first, optionally only those of the given
+        processes, at or above the given level, and with times in [since, until] (in seconds since the Unix epoch).
+        Continues before `cursor`, if given. To bound the time taken, at most `max_scanned` candidate lines are
+        checked; if a page is cut short by this, it still has a cursor to continue from.
+        """
+        terms = _tokenize(query)
+        with self._lock:
+            end = self._end() if cursor is None else min(cursor, self._end())
+
+            # Every requirement is a union of postings lists; candidates come from the smallest one.
+            requirements = [[self._by_token.get(t, array.array('I'))] for t in terms]
+            if process_names is not None:
+                requirements.append([self._by_process[self._process_ids[p]]
+                                     for p in process_names if self._process_ids.get(p) in self._by_process])
+            if min_level is not None:
+                requirements.append([postings for level, postings in self._by_level.items() if level >= min_level])
+            driver = min(requirements, key=lambda r: sum(len(p) for p in r), default=None)
+            # Unless the time range spans fewer lines, by its blocks
+            if driver is not None and (since is not None or until is not None) and \
+                    self._num_in_blocks(end, since, until) < sum(len(p) for p in driver):
+                driver = None
+            token_postings = [r[0] for r in requirements[:len(terms)] if r is not driver]
+
+            if driver is None:
+                candidates = self._all_before(end, since, until)
+            else:
+                candidates = _merge_descending(driver, end)
+
+            results = []
+            next_cursor = None
+            num_scanned = 0
+            for line_id in candidates:
+                num_scanned += 1
+                if num_scanned > max_scanned or len(results) >= limit:
+                    next_cursor = line_id + 1
+                    break
+                if not self._matches(line_id, token_postings, process_names, min_level, since, until):
+                    continue
+                results.append(line_id)
+
+            located = []
+            for i, line_id in enumerate(results):
+                line = line_id - self._base
+                located.append((self._file_paths[self._line_files[line]], self._line_offsets[line]))
+                results[i] = LogSearchResult(
+                    line_id=line_id,
+                    time=self._line_times[line],
+                    process_name=self._process_names[self._line_processes[line]],
+                    level=logging.getLevelName(self._line_levels[line]) if self._line_levels[line] > 0 else None,
+                    text='')
+
+        # Read the lines themselves outside of the lock
+        for result, (path, offset) in zip(results, located):
+            result.text = _read_line(path, offset)
+        return LogSearchPage(results=results, next_cursor=next_cursor)
+
+    def index_once(self):
+        """
+        Indexes any new lines. Called periodically by the background thread.
+        """
+        paths = glob.glob(os.path.join(self._log_dir, '*log'))
+        # Oldest first, so line numbers roughly follow time
+        paths.sort(key=lambda p: _mtime(p))
+
+        deleted = set(self._files).difference(paths)
+        if len(deleted) > 0:
+            with self._lock:
+                for path in deleted:
+                    self._file_paths[self._files.pop(path).file_id] = None
+
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            indexed = self._files.get(path)
+            if indexed is None or indexed.inode != st.st_ino or st.st_size < indexed.offset:
+                # New, replaced or truncated; lines indexed from its previous incarnation can no longer be read
+                with self._lock:
+                    if indexed is not None:
+                        self._file_paths[indexed.file_id] = None
+                    indexed = self._files[path] = _IndexedFile(len(self._file_paths), path, st.st_ino)
+                    self._file_paths.append(path)
+            if st.st_size > indexed.offset:
+                self._index_file(indexed)
+
+        with self._lock:
+            self._evict()
+
+    def _run(self):
+        while True:
+            self.index_once()
+            if self._stop.wait(self._poll_interval_s):
+                return
+
+    def _index_file(self, indexed: _IndexedFile):
+        try:
+            f = open(indexed.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(indexed.offset)
+            while not self._stop.is_set():
+                lines = []
+                offset = indexed.offset
+                for _ in range(_INDEX_CHUNK_LINES):
+                    line = f.readline()
+                    # Incomplete lines are left for later
+                    if not line.endswith(b'\n'):
+                        break
+                    lines.append((offset, line))
+                    offset += len(line)
+                if len(lines) == 0:
+                    return
+                with self._lock:
+                    for line_offset, line in lines:
+                        self._add_line(indexed, line_offset, line.decode('utf-8', errors='replace').rstrip('\n'))
+                indexed.offset = offset
+                f.seek(offset)
+
+    def _end(self) -> int:
+        return self._base + len(self._line_files)
+
+    def _evict(self):
+        """
+        Evicts the oldest lines, whole blocks at a time, while they're all in files that are gone, and to bring the
+        index back under `max_lines`. Called with the lock held.
+        """
+        first_live = next((self._base + i for i, file_id in enumerate(self._line_files)
+                           if self._file_paths[file_id] is not None), self._end())
+        new_base = first_live - first_live % _BLOCK_SIZE
+        if self._end() - new_base > self._max_lines:
+            # Well under the bound, so the cost of evicting is spread over many lines
+            new_base = self._end() - self._max_lines * 9 // 10
+            new_base += -new_base % _BLOCK_SIZE
+        if new_base <= self._base:
+            return
+
+        num_lines = new_base - self._base
+        for column in (self._line_files, self._line_offsets, self._line_times, self._line_processes,
+                       self._line_levels):
+            del column[:num_lines]
+        del self._block_min_times[:num_lines // _BLOCK_SIZE]
+        del self._block_max_times[:num_lines // _BLOCK_SIZE]
+        for postings_by in (self._by_process, self._by_level, self._by_token):
+            for key, postings in list(postings_by.items()):
+                del postings[:bisect.bisect_left(postings, new_base)]
+                if len(postings) == 0:
+                    del postings_by[key]
+        self._base = new_base
+
+    def _add_line(self, indexed: _IndexedFile, offset: int, text: str):
+        line_id = self._end()
+        time, process_name, level, message = _parse(text)
+        if time is None:
+            time = indexed.last_time
+        indexed.last_time = time
+
+        process_id = 0
+        if process_name is not None:
+            process_id = self._process_ids.get(process_name)
+            if process_id is None:
+                process_id = self._process_ids[process_name] = len(self._process_names)
+                self._process_names.append(process_name)
+        levelno = logging.getLevelName(level) if level is not None else 0
+        levelno = levelno if isinstance(levelno, int) and 0 < levelno < 256 else 0
+
+        self._line_files.append(indexed.file_id)
+        self._line_offsets.append(offset)
+        self._line_times.append(time)
+        self._line_processes.append(process_id)
+        self._line_levels.append(levelno)
+
+        block = (line_id - self._base) // _BLOCK_SIZE
+        if block == len(self._block_min_times):
+            self._block_min_times.append(time)
+            self._block_max_times.append(time)
+        else:
+            self._block_min_times[block] = min(self._block_min_times[block], time)
+            self._block_max_times[block] = max(self._block_max_times[block], time)
+
+        if process_id != 0:
+            self._by_process.setdefault(process_id, array.array('I')).append(line_id)
+        if levelno != 0:
+            self._by_level.setdefault(levelno, array.array('I')).append(line_id)
+        for token in list(_tokenize(message))[:_MAX_TOKENS_PER_LINE]:
+            self._by_token.setdefault(token, array.array('I')).append(line_id)
+
+    def _num_in_blocks(self, end: int, since: Optional[float], until: Optional[float]) -> int:
+        """
+        Upper bound on the number of lines before `end` within [since, until], by the time ranges of their blocks.
+        """
+        return sum(_BLOCK_SIZE for block in range((end - self._base + _BLOCK_SIZE - 1) // _BLOCK_SIZE)
+                   if not self._block_outside(block, since, until))
+
+    def _block_outside(self, block: int, since: Optional[float], until: Optional[float]) -> bool:
+        return (since is not None and self._block_max_times[block] < since) or \
+            (until is not None and self._block_min_times[block] > until)
+
+    def _all_before(self, end: int, since: Optional[float], until: Optional[float]) -> Iterator[int]:
+        """
+        All line numbers before `end`, descending, skipping blocks entirely outside of [since, until].
+        """
+        block = (end - self._base - 1) // _BLOCK_SIZE
+        while block >= 0:
+            if not self._block_outside(block, since, until):
+                start = self._base + block * _BLOCK_SIZE
+                yield from range(min(end, start + _BLOCK_SIZE) - 1, start - 1, -1)
+            block -= 1
+
+    def _matches(
+            self,
+            line_id: int,
+            token_postings: List[array.array],
+            process_names: Optional[Set[str]],
+            min_level: Optional[int],
+            since: Optional[float],
+            until: Optional[float]) -> bool:
+        line = line_id - self._base
+        time = self._line_times[line]
+        if (since is not None and time < since) or (until is not None and time > until):
+            return False
+        if process_names is not None and self._process_names[self._line_processes[line]] not in process_names:
+            return False
+        if min_level is not None and self._line_levels[line] < min_level:
+            return False
+        if self._file_paths[self._line_files[line]] is None:
+            return False
+        return all(_contains(postings, line_id) for postings in token_postings)
+
+
+def _tokenize(text: str) -> Dict[str, None]:
+    # A dict rather than a set, to keep the order tokens appear in
+    return dict.fromkeys(t.lower() for t in _TOKEN_PATTERN.findall(text))
+
+
+def _parse(text: str):
+    """
+    Parses a line in fluentd's file output format into (time, process name, level, message).
+    """
+    tabs = text.split('\t', 2)
+    if len(tabs) != 3:
+        return None, None, None, text
+    try:
+        time = datetime.datetime.fromisoformat(tabs[0]).timestamp()
+    except ValueError:
+        time = None
+    process_name = tabs[1][len('process.'):] if tabs[1].startswith('process.') else None
+    try:
+        record = json.loads(tabs[2])
+        return time, process_name, record.get('type'), f'{record.get("message", "")} {record.get("stack_trace") or ""}'
+    except (ValueError, AttributeError):
+        return time, process_name, None, tabs[2]
+
+
+def _contains(postings: array.array, line_id: int) -> bool:
+    i = bisect.bisect_left(postings, line_id)
+    return i < len(postings) and postings[i] == line_id
+
+
+def _merge_descending(postings_lists: List[array.array], end: int) -> Iterator[int]:
+    """
+    Line numbers in any of the given postings lists that are before `end`, descending, without duplicates.
+    """
+    positions = [bisect.bisect_left(p, end) - 1 for p in postings_lists]
+    while True:
+        best = -1
+        for p, i in zip(postings_lists, positions):
+            if i >= 0 and p[i] > best:
+                best = p[i]
+        if best < 0:
+            return
+        yield best
+        for k, (p, i) in enumerate(zip(postings_lists, positions)):
+            if i >= 0 and p[i] == best:
+                positions[k] = i - 1
+
+
+def _read_line(path: Optional[str], offset: int) -> str:
+    if path is None:
+        return ''
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.readline().decode('utf-8', errors='replace').rstrip('\n')
+    except FileNotFoundError:
+        return ''
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0.0
@@ -1,5 +1,5 @@
 import dataclasses
-import distutils.util
+import functools
 import json
 import typing
 from enum import Enum
@@ -56,47 +56,204 @@ class FieldDescriptionForPopulating(DataClassJsonMixin):
     val: typing.Optional[str]
 
 
+class PopulationError(ValueError):
+    """
+    Raised when values submitted for a class's flattened fields can't be turned into an instance of it. Holds a message
+    per offending field ID.
+    """
+
+    def __init__(self, clazz: type, errors: typing.Dict[str, str]):
+        super().__init__(f'Invalid fields for {clazz.__name__}: ' + '; '.join(f'{k}: {v}' for k, v in errors.items()))
+        self.errors = errors
+
+
 def populate_from_field_descriptions_class(
         clazz: typing.Type[CommandT],
-        field_descriptions: typing.List[typing.Union[FieldDescription, FieldDescriptionForPopulating]]) -> CommandT:
-    exploded_params = {}
-
-    for field_description in field_descriptions:
-        key = field_description.id
-        val = field_description.val
-        nested_keys = key.split('.')
-        d = exploded_params
-        for nested_key in nested_keys[:-1]:
-            if nested_key in d:
-                d = d[nested_key]
-            else:
-                d[nested_key] = {}
-                d = d[nested_key]
-        d[nested_keys[-1]] = val
-
-    clazz_dict = {}
-    _populate_clazz_dict(exploded_params, clazz_dict, clazz)
-    return clazz.from_dict(clazz_dict)
-
-
-def _populate_clazz_dict(params_dict, clazz_dict, clazz: typing.Type[CommandT]):
-    for key, val in params_dict.items():
-        val_dataclass_type = only([d for d in dataclasses.fields(clazz) if d.name == key]).type
-        val_dataclass_type = _extract_from_optional(val_dataclass_type)
-        maybe_iterable_type = _extract_from_iterable(val_dataclass_type)
-        if isinstance(val, dict):
-            clazz_dict[key] = {}
-            _populate_clazz_dict(val, clazz_dict=clazz_dict[key], clazz=val_dataclass_type)
-        elif val_dataclass_type == bool and not isinstance(val, bool):
-            clazz_dict[key] = bool(distutils.util.strtobool(val))
-        elif maybe_iterable_type is not None:
-            # Single to double quotes
-            clazz_dict[key] = json.loads(val.replace("'", '"'))
-        else:
-            clazz_dict[key] = val_dataclass_type(val)
+        id_value_map: typing.Dict[str, typing.Any]) -> CommandT:
+    """
+    Creates an instance of a class from values of its flattened fields, keyed by field ID (see FieldDescription#id),
+    e.g. as submitted from the GUI. Fields that aren't given take their defaults. Raises PopulationError if any values
+    can't be converted to their field's type, or if required fields are missing.
+    """
+    return populator_for(clazz).populate(id_value_map)
+
+
+# Returned by a field's converter when no value was given, so that the field takes its default.
+_UNSET = object()
+
+
+@dataclasses.dataclass
+class _Setter:
+    # Attribute names leading from the populated instance to this field, e.g. ('nested', 'field_name').
+    path: typing.Tuple[str, ...]
+
+    # Converts a submitted value to the field's type, raising ValueError or TypeError if it can't.
+    convert: typing.Callable[[typing.Any], typing.Any]
+
+
+class _Node:
+    """
+    A dataclass to construct, from the converted values of its flattened fields.
+    """
+
+    def __init__(self, clazz: type, has_default: bool):
+        self.clazz = clazz
+        # Whether this can be left out if none of its fields are given, i.e. if it's nested with a default.
+        self.has_default = has_default
+        self.required: typing.Set[str] = set()
+        self.nested: typing.Dict[str, _Node] = {}
+
 
+class Populator:
+    """
+    Creates instances of a class from values of its flattened fields. Built once per class (see #populator_for), which
+    maps every flattened field ID straight to its typed converter, so populating doesn't repeat any reflection.
+    """
 
-def extract_flattened_field_descriptions_class(
+    def __init__(self, clazz: typing.Type[CommandT]):
+        self._clazz = clazz
+        self._setters: typing.Dict[str, _Setter] = {}
+        self._root = self._compile(clazz, (), has_default=False)
+
+    def populate(self, id_value_map: typing.Dict[str, typing.Any]) -> CommandT:
+        errors = {}
+        kwargs_by_parent: typing.Dict[typing.Tuple[str, ...], typing.Dict[str, typing.Any]] = {}
+        for field_id, val in id_value_map.items():
+            setter = self._setters.get(field_id)
+            if setter is None:
+                errors[field_id] = 'Unknown field.'
+                continue
+            # Even if the value turns out to be invalid, the nested instance holding it was meant to be set
+            kwargs_by_parent.setdefault(setter.path[:-1], {})
+            try:
+                converted = setter.convert(val)
+            except (ValueError, TypeError) as e:
+                errors[field_id] = f'Invalid value {val!r}: {e}'
+                continue
+            if converted is not _UNSET:
+                kwargs_by_parent[setter.path[:-1]][setter.path[-1]] = converted
+
+        instance = self._build(self._root, (), kwargs_by_parent, errors)
+        if len(errors) > 0:
+            raise PopulationError(self._clazz, errors)
+        return instance
+
+    def _compile(self, clazz: type, path: typing.Tuple[str, ...], has_default: bool) -> _Node:
+        node = _Node(clazz, has_default)
+        for field in dataclasses.fields(clazz):
+            field_type = _extract_from_optional(field.type)
+            is_optional = field_type != field.type
+            field_has_default = field.default is not dataclasses.MISSING or \
+                field.default_factory is not dataclasses.MISSING
+            if not field_has_default:
+                node.required.add(field.name)
+            if dataclasses.is_dataclass(field_type):
+                node.nested[field.name] = self._compile(
+                    field_type, path + (field.name,), has_default=field_has_default)
+            else:
+                field_path = path + (field.name,)
+                self._setters['.'.join(field_path)] = _Setter(
+                    path=field_path,
+                    convert=_field_converter(field_type, is_optional, field_has_default))
+        return node
+
+    def _build(
+            self,
+            node: _Node,
+            path: typing.Tuple[str, ...],
+            kwargs_by_parent: typing.Dict[typing.Tuple[str, ...], typing.Dict[str, typing.Any]],
+            errors: typing.Dict[str, str]) -> typing.Any:
+        kwargs = dict(kwargs_by_parent.get(path, {}))
+        for name, child in node.nested.items():
+            child_path = path + (name,)
+            if child.has_default and not any(p[:len(child_path)] == child_path for p in kwargs_by_parent):
+                continue
+            kwargs[name] = self._build(child, child_path, kwargs_by_parent, errors)
+        missing = node.required - kwargs.keys()
+        for name in sorted(missing):
+            # Unless it was given, but invalid
+            errors.setdefault('.'.join(path + (name,)), 'Required.')
+        if len(missing) > 0:
+            return None
+        return node.clazz(**kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def populator_for(clazz: typing.Type[CommandT]) -> Populator:
+    return Populator(clazz)
+
+
+def _field_converter(
+        field_type: type, is_optional: bool, has_default: bool) -> typing.Callable[[typing.Any], typing.Any]:
+    maybe_iterable_type = _extract_from_iterable(field_type)
+    if maybe_iterable_type is not None:
+        args = getattr(field_type, '__args__', None) or ()
+        element_convert = _scalar_converter(args[0]) \
+            if maybe_iterable_type in (list, tuple, set, frozenset) and len(args) == 1 else None
+        convert = functools.partial(_to_iterable, maybe_iterable_type, element_convert)
+    else:
+        convert = _scalar_converter(field_type)
+
+    def _convert(val):
+        # Blank values of anything but strings count as not given
+        if val is None or (val == '' and field_type is not str):
+            if is_optional:
+                return None
+            if has_default:
+                return _UNSET
+            raise ValueError('A value is required.')
+        return convert(val)
+    return _convert
+
+
+def _scalar_converter(t: type) -> typing.Callable[[typing.Any], typing.Any]:
+    if t is bool:
+        return _to_bool
+    if isinstance(t, type) and issubclass(t, Enum):
+        return functools.partial(_to_enum, t)
+    if t in (int, float, str):
+        return t
+    if isinstance(t, type):
+        return lambda val: val if isinstance(val, t) else t(val)
+    # E.g. typing.Any
+    return lambda val: val
+
+
+def _to_bool(val) -> bool:
+    if isinstance(val, bool):
+        return val
+    lowered = str(val).lower()
+    if lowered in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    if lowered in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError('Expected a boolean.')
+
+
+def _to_enum(enum_type: typing.Type[Enum], val) -> Enum:
+    if isinstance(val, enum_type):
+        return val
+    try:
+        return enum_type[val]
+    except KeyError:
+        raise ValueError(f'Expected one of {[e.name for e in enum_type]}.')
+
+
+def _to_iterable(iterable_type: type, element_convert: typing.Optional[typing.Callable], val):
+    if isinstance(val, str):
+        try:
+            val = json.loads(val)
+        except ValueError:
+            # Also accept Python-style literals with single quotes
+            val = json.loads(val.replace("'", '"'))
+    if element_convert is not None:
+        if not isinstance(val, (list, tuple, set, frozenset)):
+            raise ValueError('Expected a list.')
+        return iterable_type(element_convert(v) for v in val)
+    return val
+
+
+def _extract_flattened_field_descriptions_class(
         clazz: typing.Type[CommandT], existing_instance: typing.Optional[CommandT]) -> typing.List[FieldDescription]:
     properties = []
     for field in dataclasses.fields(clazz):
@@ -105,7 +262,7 @@ def extract_flattened_field_descriptions_class(
         is_optional = field_type != field.type
         if dataclasses.is_dataclass(field_type):
             existing_nested = getattr(existing_instance, field.name) if existing_instance is not None else None
-            nested_properties = extract_flattened_field_descriptions_class(field_type, existing_nested)
+            nested_properties = _extract_flattened_field_descriptions_class(field_type, existing_nested)
             for nested_property in nested_properties:
                 nested_property = dataclasses.replace(nested_property, **{
                     'id': f'{field.name}.{nested_property.id}',
@@ -158,6 +315,89 @@ def extract_flattened_field_descriptions_class(
     return properties
 
 
+@dataclasses.dataclass
+class _CompiledField:
+    # Attribute names leading from the described instance to this field, e.g. ('nested', 'field_name').
+    path: typing.Tuple[str, ...]
+
+    # JSON-able description of the field without an instance, i.e. with its placeholder but no value.
+    template: typing.Dict
+
+    # Converts a (non-None) value of the field to its description's `val`.
+    to_val: typing.Callable[[typing.Any], typing.Any]
+
+
+class ClassSchema:
+    """
+    Flattened field descriptions of a class (see FieldDescription), as JSON-able dicts. The dataclass reflection is
+    done once, when the schema is built; describing an instance is then a single pass over its flattened fields. Get
+    schemas via #schema_for, which caches them per class.
+    """
+
+    def __init__(self, clazz: typing.Type[CommandT]):
+        descriptions = _extract_flattened_field_descriptions_class(clazz, existing_instance=None)
+        self._fields = [
+            _CompiledField(path=path, template=fd.to_dict(encode_json=True), to_val=to_val)
+            for fd, (path, to_val) in zip(descriptions, _compile_fields(clazz, ()))]
+
+    def describe(self) -> typing.List[typing.Dict]:
+        """
+        Descriptions of the class's fields, with placeholders for those with defaults.
+        """
+        return [dict(f.template) for f in self._fields]
+
+    def describe_instance(self, instance: CommandT) -> typing.List[typing.Dict]:
+        """
+        Descriptions of the fields of an instance of the class, with their current values. Same as
+        #_extract_flattened_field_descriptions_class(clazz, instance) followed by FieldDescription#to_dict.
+        """
+        ret = []
+        for f in self._fields:
+            parent = instance
+            for name in f.path[:-1]:
+                parent = getattr(parent, name) if parent is not None else None
+            d = dict(f.template)
+            # Fields of a nested instance that's None are described as if there were no instance
+            if parent is not None:
+                d['placeholder'] = None
+                val = getattr(parent, f.path[-1])
+                if val is not None:
+                    d['val'] = f.to_val(val)
+            ret.append(d)
+        return ret
+
+
+@functools.lru_cache(maxsize=None)
+def schema_for(clazz: typing.Type[CommandT]) -> ClassSchema:
+    return ClassSchema(clazz)
+
+
+def _compile_fields(
+        clazz: type,
+        path: typing.Tuple[str, ...]) -> typing.Iterator[typing.Tuple[typing.Tuple[str, ...], typing.Callable]]:
+    """
+    (path, value converter) of each flattened field of a class, in the same order as
+    #_extract_flattened_field_descriptions_class.
+    """
+    for field in dataclasses.fields(clazz):
+        field_type = _extract_from_optional(field.type)
+        if dataclasses.is_dataclass(field_type):
+            yield from _compile_fields(field_type, path + (field.name,))
+        elif _extract_from_iterable(field_type) is not None:
+            yield path + (field.name,), json.dumps
+        elif issubclass(field_type, Enum):
+            yield path + (field.name,), lambda val: val.name
+        else:
+            yield path + (field.name,), _to_json_val
+
+
+def _to_json_val(val):
+    if isinstance(val, (str, int, float, bool, list, dict)):
+        return val
+    # Anything else is encoded the same way FieldDescription#to_dict would
+    return FieldDescriptionForPopulating(id='', val=val).to_dict(encode_json=True)['val']
+
+
 def _extract_from_optional(t: type) -> type:
     if hasattr(t, '__origin__') and \
             t.__origin__ == typing.Union and \
@@ -0,0 +1,60 @@
+import asyncio
+import time
+import typing
+from typing import List, Optional, Tuple
+
+from durapy.deploy.status.config import LifecycleDatabaseConfiguration
+from durapy.webserver._blocking import BlockingExecutor, LIFECYCLE_POOL
+
+if typing.TYPE_CHECKING:
+    from durapy.deploy.status.status import ProcessStatus, ProcessStatusDatabase
+
+
+class ProcessStatusCache:
+    """
+    Process statuses read from the lifecycle database through a single long-lived ProcessStatusDatabase, and so a
+    single engine and connection pool, for the webserver's lifetime. Results are reused for `ttl_s`, and concurrent
+    requests for statuses share a single in-flight query, so however many dashboards are open, the database is queried
+    at most about once per `ttl_s`.
+
+    Used from the IOLoop's thread.
+    """
+
+    def __init__(self, config: LifecycleDatabaseConfiguration, blocking: BlockingExecutor, ttl_s: float = 1.0):
+        self._config = config
+        self._blocking = blocking
+        self._ttl_s = ttl_s
+        self._db: Optional['ProcessStatusDatabase'] = None
+
+        # (time.monotonic() when the query started, statuses) of the last successful query
+        self._cached: Optional[Tuple[float, List['ProcessStatus']]] = None
+        self._in_flight: Optional[asyncio.Future] = None
+
+    async def fetch_all(self) -> List['ProcessStatus']:
+        if self._cached is not None and time.monotonic() - self._cached[0] < self._ttl_s:
+            return self._cached[1]
+        if self._in_flight is None:
+            self._in_flight = asyncio.ensure_future(self._fetch())
+        # Shielded, so that one request going away doesn't cancel the query for the others
+        return await asyncio.shield(self._in_flight)
+
+    def close(self):
+        if self._db is not None:
+            self._db.db.dispose()
+            self._db = None
+
+    async def _fetch(self) -> List['ProcessStatus']:
+        start = time.monotonic()
+        try:
+            statuses = await self._blocking.run(LIFECYCLE_POOL, self._fetch_blocking)
+        finally:
+            self._in_flight = None
+        self._cached = (start, statuses)
+        return statuses
+
+    def _fetch_blocking(self) -> List['ProcessStatus']:
+        if self._db is None:
+            # Imported here, as it pulls in sqlalchemy, which webservers without a lifecycle database don't need
+            from durapy.deploy.status.status import ProcessStatusDatabase
+            self._db = ProcessStatusDatabase(process_name=None, config=self._config)
+        return self._db.fetch_all()
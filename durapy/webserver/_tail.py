@@ -0,0 +1,261 @@
+import abc
+import collections
+import ctypes
+import ctypes.util
+import dataclasses
+import glob
+import json
+import logging
+import os
+from typing import Callable, Deque, Dict, List, Optional, Set
+
+import tornado.ioloop
+
+# Size of the tail of each existing file that is read when the follower starts, to backfill its ring.
+_INITIAL_BACKFILL_BYTES = 256 * 1024
+
+
+@dataclasses.dataclass
+class LogLine:
+    """
+    A line of aggregated logs, in fluentd's file output format: <time>\tprocess.<process name>\t<JSON record>.
+    """
+    text: str
+
+    # Parsed from the text, if it's in the expected format.
+    timestamp: str = ''
+    process_name: Optional[str] = None
+    level: Optional[str] = None
+
+    @staticmethod
+    def parse(text: str) -> 'LogLine':
+        line = LogLine(text=text)
+        tabs = text.split('\t', 2)
+        if len(tabs) != 3:
+            return line
+        line.timestamp = tabs[0]
+        if tabs[1].startswith('process.'):
+            line.process_name = tabs[1][len('process.'):]
+        try:
+            line.level = json.loads(tabs[2]).get('type')
+        except (ValueError, AttributeError):
+            pass
+        return line
+
+
+@dataclasses.dataclass
+class LogFilter:
+    """
+    Server-side filter of a tail client. Lines without a process or level are only kept if not filtering on it.
+    """
+
+    # Only lines of these processes, if given.
+    process_names: Optional[Set[str]] = None
+
+    # Only lines at or above this level (e.g. logging.WARNING), if given.
+    min_level: Optional[int] = None
+
+    def matches(self, line: LogLine) -> bool:
+        if self.process_names is not None and line.process_name not in self.process_names:
+            return False
+        if self.min_level is not None:
+            level = logging.getLevelName(line.level) if line.level is not None else None
+            if not isinstance(level, int) or level < self.min_level:
+                return False
+        return True
+
+
+class LogSource(abc.ABC):
+    """
+    Source of aggregated log lines for tail websockets: recent lines, plus batches of new lines as they arrive. Used
+    from the IOLoop's thread only.
+    """
+    @abc.abstractmethod
+    def recent(self, num: int, log_filter: Optional[LogFilter] = None) -> List[LogLine]:
+        """
+        The most recent `num` lines matching the filter, oldest first.
+        """
+        ...
+
+    @abc.abstractmethod
+    def subscribe(self, callback: Callable[[List[LogLine]], None]):
+        ...
+
+    @abc.abstractmethod
+    def unsubscribe(self, callback: Callable[[List[LogLine]], None]):
+        ...
+
+
+class _Inotify:
+    """
+    Minimal binding to Linux's inotify, watching a directory for files being written to or created.
+    """
+    _IN_MODIFY = 0x00000002
+    _IN_MOVED_TO = 0x00000080
+    _IN_CREATE = 0x00000100
+
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = self._IN_MODIFY | self._IN_MOVED_TO | self._IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch failed for {directory}')
+
+    def drain(self):
+        """
+        Discards pending events; the follower rescans its files on any event.
+        """
+        try:
+            while len(os.read(self.fd, 64 * 1024)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _FollowedFile:
+    def __init__(self, inode: int, offset: int):
+        self.inode = inode
+        self.offset = offset
+        # Trailing bytes not yet terminated by a newline
+        self.partial = b''
+
+
+class LogFollower(LogSource):
+    """
+    Follows the log files written by fluentd (see FluentDConfiguration), shared by all tail websockets. New lines are
+    appended to a ring buffer and broadcast to subscribers in batches, one batch per wakeup. Wakeups come from
+    inotify where available, and otherwise from polling.
+
+    Following starts with the first call to #recent or #subscribe, which must be on the IOLoop's thread.
+    """
+
+    def __init__(
+            self,
+            log_file_dir: str,
+            ring_size: int = 10000,
+            poll_interval_s: float = 0.5,
+            use_inotify: bool = True):
+        self._log_file_dir = log_file_dir
+        self._poll_interval_s = poll_interval_s
+        self._use_inotify = use_inotify
+        self._ring: Deque[LogLine] = collections.deque(maxlen=ring_size)
+        self._files: Dict[str, _FollowedFile] = {}
+        self._subscribers: Set[Callable[[List[LogLine]], None]] = set()
+
+        self._started = False
+        self._inotify: Optional[_Inotify] = None
+        self._poller: Optional[tornado.ioloop.PeriodicCallback] = None
+
+    def recent(self, num: int, log_filter: Optional[LogFilter] = None) -> List[LogLine]:
+        self._ensure_started()
+        ret = []
+        for line in reversed(self._ring):
+            if len(ret) >= num:
+                break
+            if log_filter is None or log_filter.matches(line):
+                ret.append(line)
+        return ret[::-1]
+
+    def subscribe(self, callback: Callable[[List[LogLine]], None]):
+        self._ensure_started()
+        self._subscribers.add(callback)
+
+    def unsubscribe(self, callback: Callable[[List[LogLine]], None]):
+        self._subscribers.discard(callback)
+
+    def stop(self):
+        """
+        Stops following for good.
+        """
+        if self._inotify is not None:
+            tornado.ioloop.IOLoop.current().remove_handler(self._inotify.fd)
+            self._inotify.close()
+            self._inotify = None
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        self._started = True
+
+        # Backfill from the end of each existing file, then only follow what's written from here on
+        backfill = []
+        for path in self._paths():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                # Removed since listing it; followed from the start if it appears again
+                continue
+            start = max(0, st.st_size - _INITIAL_BACKFILL_BYTES)
+            self._files[path] = _FollowedFile(st.st_ino, start)
+            lines = self._read(path, self._files[path])
+            # The first line is likely cut off
+            backfill.extend(lines[1:] if start > 0 else lines)
+        backfill.sort(key=lambda line: line.timestamp)
+        self._ring.extend(backfill)
+
+        if self._use_inotify:
+            try:
+                self._inotify = _Inotify(self._log_file_dir)
+            except (OSError, AttributeError, TypeError) as e:
+                logging.info(f'inotify is unavailable, so polling {self._log_file_dir} for logs: {e}')
+        if self._inotify is not None:
+            tornado.ioloop.IOLoop.current().add_handler(
+                self._inotify.fd, self._on_inotify, tornado.ioloop.IOLoop.READ)
+        else:
+            self._poller = tornado.ioloop.PeriodicCallback(self._scan, 1e3 * self._poll_interval_s)
+            self._poller.start()
+
+    def _on_inotify(self, fd, events):
+        self._inotify.drain()
+        self._scan()
+
+    def _paths(self) -> List[str]:
+        # Same files as `tail -F <dir>/*log`
+        return sorted(glob.glob(os.path.join(self._log_file_dir, '*log')))
+
+    def _scan(self):
+        batch = []
+        paths = self._paths()
+        # Forget removed files, e.g. rotated logs that were cleaned up
+        for path in set(self._files) - set(paths):
+            del self._files[path]
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                self._files.pop(path, None)
+                continue
+            followed = self._files.get(path)
+            if followed is None or followed.inode != st.st_ino or st.st_size < followed.offset:
+                # New, replaced or truncated; read it from the start
+                followed = self._files[path] = _FollowedFile(st.st_ino, 0)
+            if st.st_size > followed.offset:
+                batch.extend(self._read(path, followed))
+        if len(batch) == 0:
+            return
+        self._ring.extend(batch)
+        for subscriber in list(self._subscribers):
+            subscriber(batch)
+
+    @staticmethod
+    def _read(path: str, followed: _FollowedFile) -> List[LogLine]:
+        try:
+            with open(path, 'rb') as f:
+                f.seek(followed.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        followed.offset += len(data)
+        lines = (followed.partial + data).split(b'\n')
+        followed.partial = lines.pop()
+        return [LogLine.parse(line.decode('utf-8', errors='replace')) for line in lines]
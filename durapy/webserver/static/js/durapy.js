@@ -2,4 +2,7 @@
 export { initialize_commands_history } from "./durapy_commands_history.js";
 export { initialize_commands_send } from "./durapy_commands_send.js";
 export { initialize_process_statuses } from "./durapy_statuses.js";
+export { initialize_profiles } from "./durapy_profiles.js";
+export { initialize_memory_reports } from "./durapy_memory.js";
 export { WebSocketTailer } from "./durapy_tails.js";
+export { initialize_trace } from "./durapy_traces.js";
@@ -2,6 +2,16 @@ export { initialize_commands_history };
 
 let last_commands_offset = 0;
 const NUM_COMMANDS_PER_PAGE = 10;
+const RECONNECT_DELAY_MS = 1000;
+
+// Commands currently shown, newest first
+let shown_commands = [];
+
+// Key of the newest command received over the live stream, to resume from when reconnecting
+let last_streamed_key = null;
+
+// The single live stream websocket, shared across pages
+let command_socket = null;
 
 function load_last_commands() {
     const url = '/api/commands';
@@ -31,7 +41,31 @@ function last_commands_previous() {
     load_last_commands();
 }
 
+// Newly persisted commands are pushed over a websocket, and shown as they arrive while on the first page. Only one is
+// open at a time; it's reopened if it closes.
+function stream_commands() {
+    let params = new URLSearchParams();
+    if (last_streamed_key !== null) {
+        params.append('since', last_streamed_key);
+    }
+    let ws = command_socket = new WebSocket(`ws://${window.location.host}/ws/commands?${params.toString()}`);
+    ws.onmessage = function (event) {
+        let commands = JSON.parse(event.data).commands;
+        last_streamed_key = commands[commands.length - 1].key;
+        if (last_commands_offset !== 0) {
+            return;
+        }
+        let shown_keys = new Set(shown_commands.map(c => c.key));
+        let new_commands = commands.filter(c => !shown_keys.has(c.key)).reverse();
+        show_commands(new_commands.concat(shown_commands).slice(0, NUM_COMMANDS_PER_PAGE));
+    };
+    ws.onclose = function () {
+        setTimeout(stream_commands, RECONNECT_DELAY_MS);
+    };
+}
+
 function show_commands(commands) {
+    shown_commands = commands;
     $('#recent-commands-tbody').empty();
     let idx = last_commands_offset + 1;
     commands.forEach(function (command) {
@@ -60,6 +94,9 @@ function show_commands(commands) {
                 <a class="btn btn-link w-100" href="/commands/send?key=${command.key}" role="button">
                 Resend
                 </a>
+                <a class="btn btn-link w-100" href="/commands/trace?key=${command.key}" role="button">
+                Trace
+                </a>
             `);
 
         let tds = columns.map(c => `<td>${c}</td>`).join('');
@@ -96,4 +133,7 @@ function initialize_commands_history(id) {
     $('#last-commands-previous-btn').on('click', last_commands_previous);
     $('#last-commands-next-btn').on('click', last_commands_next);
     load_last_commands();
+    if (command_socket === null) {
+        stream_commands();
+    }
 }
\ No newline at end of file
@@ -48,8 +48,14 @@ function send_command(command_type, redirect_on_success) {
                 window.location.href = redirect_on_success;
             }
         },
-        error: function () {
-            console.log('ERROR! See logs.');
+        error: function (xhr) {
+            // Fields that couldn't be converted into the command are listed by their IDs
+            let errors = xhr.responseJSON !== undefined ? xhr.responseJSON.errors : undefined;
+            if (errors !== undefined) {
+                alert(Object.entries(errors).map(([id, message]) => `${id}: ${message}`).join('\n'));
+            } else {
+                console.log('ERROR! See logs.');
+            }
             form.find("button[type='submit']").prop('disabled', false);
         },
     });
@@ -0,0 +1,118 @@
+export { initialize_memory_reports };
+
+function _mib(bytes) {
+    if (bytes === null || bytes === undefined) {
+        return 'N/A';
+    }
+    return `${(bytes / (1024 * 1024)).toFixed(1)} MiB`;
+}
+
+function _list(lines) {
+    if (!lines || lines.length === 0) {
+        return '<p class="text-muted">None</p>';
+    }
+    let items = lines.map(l => `<li><code>${l}</code></li>`).join('');
+    return `<ul class="list-unstyled small">${items}</ul>`;
+}
+
+function send_action(process_name, action) {
+    $.post({
+        url: `/api/memory/${encodeURIComponent(process_name)}/${action}`,
+        dataType: 'json',
+        success: function (data) {
+            console.log('Sent ', data);
+        },
+        error: function () {
+            console.log('ERROR! See logs.');
+        },
+    });
+}
+
+function show_overview(id, reports) {
+    let rows = reports.map(function (r) {
+        let columns = [
+            `<a href="?process=${encodeURIComponent(r.process_name)}">${r.process_name}</a>`,
+            moment(r.received_at),
+            _mib(r.rss_bytes),
+            _mib(r.rss_growth_bytes),
+            r.tracing ? _mib(r.traced_bytes) : 'Not tracing',
+            r.num_past_commands,
+        ];
+        return '<tr>' + columns.map(c => `<td>${c}</td>`).join('') + '</tr>';
+    }).join('');
+    $(`#${id}`).html(`
+        <div class="table-responsive">
+            <table class="table table-striped table-sm">
+                <thead>
+                <tr>
+                    <th>Process</th>
+                    <th>Reported</th>
+                    <th>RSS</th>
+                    <th>RSS Growth</th>
+                    <th>Traced</th>
+                    <th>Past Commands</th>
+                </tr>
+                </thead>
+                <tbody>${rows}</tbody>
+            </table>
+        </div>
+    `);
+}
+
+function show_process(id, process_name, reports) {
+    let latest = reports.length > 0 ? reports[0] : null;
+    let contents = `
+        <h2 class="mt-2">Memory: ${process_name}</h2>
+        <div class="mb-3">
+            <button type="button" class="btn btn-sm btn-success" data-action="start">Start Tracing</button>
+            <button type="button" class="btn btn-sm btn-primary" data-action="snapshot">Snapshot</button>
+            <button type="button" class="btn btn-sm btn-danger" data-action="stop">Stop Tracing</button>
+        </div>
+    `;
+    if (latest === null) {
+        contents += '<p class="text-muted">No reports received yet.</p>';
+    } else {
+        let counts = Object.entries(latest.object_counts).map(([k, v]) => `${k}: ${v}`);
+        contents += `
+            <p>
+                Reported ${moment(latest.received_at)} (${latest.action}).
+                RSS ${_mib(latest.rss_bytes)} (${_mib(latest.rss_growth_bytes)} growth).
+                ${latest.tracing ? `Traced ${_mib(latest.traced_bytes)}.` : 'Not tracing.'}
+                ${latest.num_past_commands} past commands held.
+            </p>
+            <h5>Top allocations</h5>
+            ${_list(latest.top_allocations)}
+            <h5>Top growth since previous snapshot</h5>
+            ${_list(latest.top_growth)}
+            <h5>Object counts</h5>
+            ${_list(counts)}
+        `;
+    }
+    $(`#${id}`).html(contents);
+    $(`#${id} button[data-action]`).on('click', function () {
+        send_action(process_name, $(this).attr('data-action'));
+    });
+}
+
+function load_reports(id, process_name) {
+    let url = process_name === null ? '/api/memory' : `/api/memory/${encodeURIComponent(process_name)}`;
+    $.get({
+        url: url,
+        contentType: 'json',
+        success: function (data) {
+            if (process_name === null) {
+                show_overview(id, data.reports);
+            } else {
+                show_process(id, process_name, data.reports);
+            }
+            setTimeout(function () { load_reports(id, process_name); }, 2000);
+        },
+        error: function (x, y, z) {
+            console.log(x, y, z);
+        },
+    });
+}
+
+function initialize_memory_reports(id, process_name) {
+    load_reports(id, process_name === undefined ? null : process_name);
+}
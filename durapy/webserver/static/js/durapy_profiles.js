@@ -0,0 +1,58 @@
+export { initialize_profiles };
+
+function load_profiles() {
+    $.get({
+        url: '/api/profiles',
+        contentType: 'json',
+        success: function (data) {
+            show_profiles(data.profiles);
+            setTimeout(load_profiles, 5000);
+        },
+        error: function (x, y, z) {
+            console.log(x, y, z);
+        },
+    });
+}
+
+function show_profiles(profiles) {
+    $('#profiles-tbody').empty();
+    profiles.forEach(function (profile) {
+        let columns = [
+            profile.process_name,
+            profile.mode,
+            moment(profile.modified_at),
+            `${(profile.size_bytes / 1024).toFixed(1)} KiB`,
+            `<a href="/api/profiles/${encodeURIComponent(profile.filename)}">${profile.filename}</a>`,
+        ];
+        let tds = columns.map(c => `<td>${c}</td>`).join('');
+        $('#profiles-tbody').append(`<tr>${tds}</tr>`);
+    });
+}
+
+function initialize_profiles(id) {
+    let contents = `
+            <p>
+                Profile a process by sending it a <code>DURAPY_START_PROFILER</code> command. Sampling profiles are
+                collapsed stacks (e.g. for flamegraph.pl or speedscope); cProfile profiles can be read with pstats or
+                snakeviz.
+            </p>
+            <div class="table-responsive">
+                <table class="table table-striped table-sm">
+                    <thead>
+                    <tr>
+                        <th>Process</th>
+                        <th>Mode</th>
+                        <th>Written</th>
+                        <th>Size</th>
+                        <th>Download</th>
+                    </tr>
+                    </thead>
+                    <tbody id="profiles-tbody">
+                    </tbody>
+                </table>
+            </div>
+    `;
+
+    $(`#${id}`).html(contents);
+    load_profiles();
+}
@@ -1,5 +1,7 @@
 export { initialize_process_statuses };
 
+import { escapeHtml } from "./durapy_tails.js";
+
 let HEARTBEAT_THRESHOLD_SECS = 10;
 let RESTARTING_THRESHOLD_SECS = 30;
 
@@ -41,6 +43,8 @@ function show_statuses(statuses) {
         columns.push(`${status.process_name}`);
         if (status.last_heartbeat_ago > HEARTBEAT_THRESHOLD_SECS) {
             columns.push('<span class="badge badge-danger">Down</span>');
+        } else if (status.unhealthy_reason) {
+            columns.push(`<span class="badge badge-danger" title="${escapeHtml(status.unhealthy_reason)}">Unhealthy</span>`);
         } else if (status.last_started_ago < RESTARTING_THRESHOLD_SECS) {
             columns.push('<span class="badge badge-warning">Restarting</span>');
         } else {
@@ -1,4 +1,4 @@
-export { WebSocketTailer };
+export { WebSocketTailer, escapeHtml };
 
 function escapeHtml(string) {
     // https://stackoverflow.com/questions/24816/escaping-html-strings-with-jquery
@@ -19,8 +19,20 @@ function escapeHtml(string) {
 }
 
 class WebSocketTailer {
-    constructor(textarea_id) {
-        let ws = new WebSocket(`ws://${window.location.host}/ws/tail`);
+    // Options, all optional:
+    //   backfill: number of recent lines to show on connecting.
+    //   processes: list of processes whose lines to show; filtered by the server.
+    //   level: minimum level of lines to show, e.g. 'WARNING'; filtered by the server.
+    constructor(textarea_id, options = {}) {
+        let params = new URLSearchParams();
+        if (options.backfill !== undefined) {
+            params.append('backfill', options.backfill);
+        }
+        (options.processes || []).forEach(p => params.append('process', p));
+        if (options.level !== undefined) {
+            params.append('level', options.level);
+        }
+        let ws = new WebSocket(`ws://${window.location.host}/ws/tail?${params.toString()}`);
         let logs = $('#' + textarea_id);
 
         ws.onopen = function () {
@@ -33,8 +45,18 @@ class WebSocketTailer {
         this.whitelist_processes = null;
 
         let that = this;
+        // Each message holds a batch of newline-delimited lines
         ws.onmessage = function (event) {
-            let tabs = event.data.split("\t");
+            let lines = event.data.split("\n").map(show_line).filter(l => l !== null);
+            if (lines.length === 0) {
+                return;
+            }
+            logs.html(logs.html() + lines.join(''));
+            logs[0].scrollTop = logs[0].scrollHeight;
+        };
+
+        function show_line(data) {
+            let tabs = data.split("\t");
 
             let timestamp = '';
             let app_name = '';
@@ -47,7 +69,7 @@ class WebSocketTailer {
 
                 if (that.whitelist_processes !== null && !that.whitelist_processes.includes(app_name)) {
                     // Not whitelisted; ignore.
-                    return;
+                    return null;
                 }
 
                 try {
@@ -59,13 +81,12 @@ class WebSocketTailer {
                     message_message = tabs[2];
                 }
             } else {
-                message_message = event.data;
+                message_message = data;
             }
 
             let line = `${timestamp}\t${app_name}\t${message_type}\t${message_message}`;
-            logs.html(logs.html() + escapeHtml(line) + '\n');
-            logs[0].scrollTop = logs[0].scrollHeight;
-        };
+            return escapeHtml(line) + '\n';
+        }
         this.ws = ws;
     }
 
@@ -0,0 +1,55 @@
+export { initialize_trace };
+
+function show_trace(id, key, trace) {
+    let rows = trace.hops.map(function (hop) {
+        let indent = '&nbsp;&nbsp;&nbsp;&nbsp;'.repeat(hop.depth);
+        let type = hop.key === key ? `<strong>${hop.type}</strong>` : hop.type;
+        let columns = [
+            `${indent}${type}`,
+            new Date(hop.timestamp_ms).toLocaleString(),
+            hop.latency_ms === null ? '' : `+${hop.latency_ms} ms`,
+            `<a href="?key=${encodeURIComponent(hop.key)}"><code>${hop.key}</code></a>`,
+            `<code>${JSON.stringify(hop.command)}</code>`,
+        ];
+        return '<tr>' + columns.map(c => `<td>${c}</td>`).join('') + '</tr>';
+    }).join('');
+
+    let truncated = trace.truncated ?
+        '<p class="text-warning">The history scan stopped early; later commands in this chain may be missing.</p>' :
+        '';
+    $(`#${id}`).html(`
+        <p>
+            ${trace.hops.length} command(s) in the chain started by <code>${trace.root_key}</code>, spanning
+            ${trace.total_latency_ms} ms.
+        </p>
+        ${truncated}
+        <div class="table-responsive">
+            <table class="table table-striped table-sm">
+                <thead>
+                <tr>
+                    <th>Type</th>
+                    <th>Time</th>
+                    <th>Hop Latency</th>
+                    <th>Key</th>
+                    <th>Command</th>
+                </tr>
+                </thead>
+                <tbody>${rows}</tbody>
+            </table>
+        </div>
+    `);
+}
+
+function initialize_trace(id, key) {
+    $.get({
+        url: `/api/traces/${encodeURIComponent(key)}`,
+        contentType: 'json',
+        success: function (data) {
+            show_trace(id, key, data);
+        },
+        error: function (x, y, z) {
+            $(`#${id}`).html(`<p class="text-muted">Could not find command ${key}.</p>`);
+            console.log(x, y, z);
+        },
+    });
+}
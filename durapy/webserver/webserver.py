@@ -1,12 +1,14 @@
 import asyncio
+import collections
 import dataclasses
 import functools
+import hashlib
 import logging
 import os
 import signal
+import threading
 import pendulum
-from asyncio import subprocess
-from typing import List, Type, Optional, Callable, Any
+from typing import List, Type, Optional, Callable, Any, Dict, Deque, Set, Tuple
 
 import tornado.escape
 import tornado.ioloop
@@ -15,20 +17,61 @@ import tornado.websocket
 from more_itertools import only
 
 from durapy.backends.base import CommandDatabase, CommandDatabaseFactory
-from durapy.command._logging import log_to_stdout, log_to_file
+from durapy.command._logging import log_to_stdout, log_to_file, log_file_for
+from durapy.command._profiler import PROFILE_EXTENSIONS
+from durapy.command.builtin import with_builtin_command_classes, MemoryReportCommand, MemoryDiagnosticsCommand, \
+    MemoryAction
 from durapy.command.command import CommandRegistry
-from durapy.command.model import BaseCommand, Context
+from durapy.command.model import BaseCommand, Context, PersistedCommand
 from durapy.command.runner import ProcessRunner
-from durapy.config import Configuration, FluentDConfiguration
+from durapy.command.tracing import fetch_trace
+from durapy.config import Configuration
 from durapy.deploy import lifecycle
-from durapy.deploy.status.status import ProcessStatusDatabase
 from durapy.deploy.target import DeployTarget
-from durapy.webserver._inspect import extract_flattened_field_descriptions_class, \
+from durapy.metrics.memory import InMemoryMetricsSink
+from durapy.metrics.prometheus import render_prometheus_text, CONTENT_TYPE as PROMETHEUS_CONTENT_TYPE
+from durapy.webserver._aggregator import LogAggregator
+from durapy.webserver._blocking import BlockingExecutor, IOLoopLagMonitor, COMMANDS_POOL, DEPLOY_POOL, LOGS_POOL
+from durapy.webserver._command_stream import CommandStream, StreamedCommand
+from durapy.webserver._index import LogIndex
+from durapy.webserver._statuses import ProcessStatusCache
+from durapy.webserver._tail import LogFilter, LogFollower, LogLine, LogSource
+from durapy.webserver._inspect import schema_for, populator_for, \
     populate_from_field_descriptions_class, \
-    FieldDescriptionForPopulating
+    FieldDescriptionForPopulating, PopulationError
 from durapy.webserver.json_handler import JsonHandler
 
 
+def describe_persisted_command(persisted_command: PersistedCommand) -> Dict:
+    """
+    JSON-able description of a persisted command, as returned by the command APIs: its PersistedCommand fields, plus
+    its type and flattened field descriptions.
+    """
+    d = persisted_command.to_dict(encode_json=True)
+    d['type'] = persisted_command.command.type()
+    d['field_descriptions'] = schema_for(persisted_command.command.__class__).describe_instance(
+        persisted_command.command)
+    return d
+
+
+# Persisted commands never change, so responses describing a single one can be cached indefinitely.
+_IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+@functools.lru_cache(maxsize=None)
+def _command_types_response(command_classes: Tuple[Type[BaseCommand], ...]) -> Tuple[str, str]:
+    """
+    (JSON body, ETag) of the GET /api/command-types response, which only depends on the command classes.
+    """
+    body = tornado.escape.json_encode({
+        'command_types': [{
+            'type': clazz.type(),
+            'field_descriptions': schema_for(clazz).describe(),
+        } for clazz in command_classes],
+    })
+    return body, f'"{hashlib.sha1(body.encode("utf-8")).hexdigest()}"'
+
+
 class CommandTypesHandler(JsonHandler):
     """
     GET /api/command-types: returns a list of the registered commands for this DuraPy instance. Form of:
@@ -46,6 +89,8 @@ class CommandTypesHandler(JsonHandler):
             ...
         ]
     }
+    The response only changes with the command classes, so it's built once and served with an ETag; clients
+    revalidate with If-None-Match and get a 304 while it's unchanged.
     """
     def __init__(
             self,
@@ -56,46 +101,51 @@ class CommandTypesHandler(JsonHandler):
         self._command_classes = command_classes
 
     def get(self):
-        ret = []
-        for clazz in self._command_classes:
-            field_descriptions = extract_flattened_field_descriptions_class(clazz, existing_instance=None)
-            ret.append({
-                'type': clazz.type(),
-                'field_descriptions': [fd.to_dict(encode_json=True) for fd in field_descriptions],
-            })
-        return self.write({
-            'command_types': ret,
-        })
+        body, etag = _command_types_response(tuple(self._command_classes))
+        # Clients may cache the response, but must check that it's still current, e.g. after a redeploy
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        return self.write(body)
 
 
 class CommandGetHandler(JsonHandler):
     """
     GET /api/commands/<command key>: finds a command according to its key (found in the PersistedCommand). Returns 404
-    if it cannot be found. Otherwise, it returns the similar fields as seen in the GET /api/commands response.
+    if it cannot be found. Otherwise, it returns the similar fields as seen in the GET /api/commands response. Persisted
+    commands never change, so found commands are marked as cacheable indefinitely, and revalidating with If-None-Match
+    returns a 304 without looking the command up.
     """
     def __init__(
             self,
             *args,
             command_db: CommandDatabase,
+            blocking: BlockingExecutor,
             **kwargs):
         super().__init__(*args, **kwargs)
         self._command_db = command_db
+        self._blocking = blocking
+
+    async def get(self, key):
+        # Keys are never reused, so a client holding any version of this response holds the current one
+        self.set_header('Etag', f'"{key}"')
+        if self.check_etag_header():
+            self.set_header('Cache-Control', _IMMUTABLE_CACHE_CONTROL)
+            self.set_status(304)
+            return
 
-    def get(self, key):
-        persisted_command = self._command_db.fetch_by_key(key)
+        persisted_command = await self._blocking.run(COMMANDS_POOL, self._command_db.fetch_by_key, key)
         if persisted_command is None:
             logging.info(f'Could not find key {key}.')
             self.send_error(404)
             return
 
-        d = persisted_command.to_dict(encode_json=True)
-        d['type'] = persisted_command.command.type()
-        field_descriptions = extract_flattened_field_descriptions_class(
-            clazz=persisted_command.command.__class__,
-            existing_instance=persisted_command.command)
-        d['field_descriptions'] = [fd.to_dict(encode_json=True) for fd in field_descriptions]
+        self.set_header('Cache-Control', _IMMUTABLE_CACHE_CONTROL)
         return self.write({
-            'command': d
+            'command': describe_persisted_command(persisted_command)
         })
 
 
@@ -130,37 +180,32 @@ class CommandCrudHandler(JsonHandler):
                     },
                 ],
             }
+            Field descriptions that can't be converted into the command are rejected with a 400 response of the form
+            {'errors': {<field ID>: <message>, ...}}.
     """
     def __init__(
             self,
             *args,
             command_db: CommandDatabase,
             command_classes: List[Type[BaseCommand]],
+            blocking: BlockingExecutor,
             **kwargs):
         super().__init__(*args, **kwargs)
         self._command_db = command_db
         self._command_classes = command_classes
+        self._blocking = blocking
 
-    def get(self):
+    async def get(self):
         num = int(self.get_argument('num', default=str(10)))
         offset = int(self.get_argument('offset', default=str(0)))
 
-        last_persisted_commands = self._command_db.fetch_last(num, offset=offset)
-        response_commmands = []
-        for persisted_command in last_persisted_commands:
-            d = persisted_command.to_dict(encode_json=True)
-            d['type'] = persisted_command.command.type()
-            field_descriptions = extract_flattened_field_descriptions_class(
-                clazz=persisted_command.command.__class__,
-                existing_instance=persisted_command.command)
-            d['field_descriptions'] = [fd.to_dict(encode_json=True) for fd in field_descriptions]
-
-            response_commmands.append(d)
+        last_persisted_commands = await self._blocking.run(
+            COMMANDS_POOL, lambda: self._command_db.fetch_last(num, offset=offset))
         return self.write({
-            'commands': response_commmands
+            'commands': [describe_persisted_command(p) for p in last_persisted_commands]
         })
 
-    def post(self):
+    async def post(self):
         if 'type' not in self.json_args:
             logging.info(f'Could not find key "type" in command to send? Command={self.json_args}')
             self.send_error(400)
@@ -176,13 +221,20 @@ class CommandCrudHandler(JsonHandler):
         if 'command' in self.json_args:
             command_to_send = self._from_command(clazz)
         elif 'field_descriptions' in self.json_args:
-            command_to_send = self._from_field_descriptions(clazz)
+            try:
+                command_to_send = self._from_field_descriptions(clazz)
+            except PopulationError as e:
+                logging.info(f'Invalid field descriptions when attempting to create a new command: {e}')
+                self.set_status(400)
+                return self.write({
+                    'errors': e.errors,
+                })
         else:
             logging.info(f'Invalid format when attempting to create a new command. params={self.json_args}')
             self.send_error(400)
             return
 
-        sent = self._command_db.send_command(command_to_send)
+        sent = await self._blocking.run(COMMANDS_POOL, self._command_db.send_command, command_to_send)
         logging.info('Sent command: {}'.format(sent))
         d = sent.to_dict(encode_json=True)
         d['type'] = command_to_send.type()
@@ -196,70 +248,511 @@ class CommandCrudHandler(JsonHandler):
 
     def _from_field_descriptions(self, clazz: Type[BaseCommand]) -> BaseCommand:
         fds = [FieldDescriptionForPopulating.from_dict(d) for d in self.json_args['field_descriptions']]
-        return populate_from_field_descriptions_class(clazz, fds)
+        return populate_from_field_descriptions_class(clazz, id_value_map={fd.id: fd.val for fd in fds})
+
+
+class ScheduledCommandsHandler(JsonHandler):
+    """
+    API handle for commands in the command database's shared schedule (see ProcessRunner's `shared_schedule`).
+        GET /api/scheduled-commands: returns a json response with key 'scheduled_commands', in order of when they are
+        due, where each element has the structure:
+            {
+                'schedule_id': <schedule ID>,
+                'at_ms': <when the command is due, in milliseconds since the Unix epoch>,
+                'type': <command type>,
+                'command': {
+                    <command fields>,
+                },
+            }
+
+        DELETE /api/scheduled-commands/<schedule ID>: cancels a scheduled command. Returns 404 if it was already sent
+        or cancelled.
+    """
+    def __init__(
+            self,
+            *args,
+            command_db: CommandDatabase,
+            blocking: BlockingExecutor,
+            **kwargs):
+        super().__init__(*args, **kwargs)
+        self._command_db = command_db
+        self._blocking = blocking
+
+    async def get(self):
+        num = int(self.get_argument('num', default=str(100)))
+        scheduled_commands = []
+        for scheduled in await self._blocking.run(COMMANDS_POOL, self._command_db.fetch_scheduled, num):
+            scheduled_commands.append({
+                'schedule_id': scheduled.schedule_id,
+                'at_ms': scheduled.at_ms,
+                'type': scheduled.command.type(),
+                'command': scheduled.command.to_dict(encode_json=True),
+            })
+        return self.write({
+            'scheduled_commands': scheduled_commands
+        })
+
+    async def delete(self, schedule_id):
+        if await self._blocking.run(COMMANDS_POOL, self._command_db.claim_scheduled, schedule_id) is None:
+            self.send_error(404)
+            return
+        logging.info(f'Cancelled scheduled command {schedule_id}.')
+        return self.write({
+            'schedule_id': schedule_id
+        })
+
+
+class TraceHandler(JsonHandler):
+    """
+    GET /api/traces/<command key>: rebuilds the causal chain containing a command, i.e. the command that started it and
+    every command sent while handling a command in the chain (see durapy.command.tracing). Returns 404 if the command
+    cannot be found. Otherwise, returns:
+        {
+            'root_key': <key of the command that started the chain>,
+            'truncated': <whether the history scan stopped before the end of the chain>,
+            'total_latency_ms': <time between the root and the last command in the chain>,
+            'hops': [
+                {
+                    **<PersistedCommand fields>,
+                    'type': <command type>,
+                    'depth': <number of hops from the root>,
+                    'latency_ms': <time since the parent command was sent, or null for the root>,
+                },
+                ...
+            ],
+        }
+    Query parameters `max_commands` and `max_duration_ms` bound the history scan.
+    """
+    def __init__(
+            self,
+            *args,
+            command_db: CommandDatabase,
+            blocking: BlockingExecutor,
+            **kwargs):
+        super().__init__(*args, **kwargs)
+        self._command_db = command_db
+        self._blocking = blocking
+
+    async def get(self, key):
+        max_commands = int(self.get_argument('max_commands', default=str(1000)))
+        max_duration_ms = int(self.get_argument('max_duration_ms', default=str(60 * 1000)))
+        trace = await self._blocking.run(
+            COMMANDS_POOL,
+            lambda: fetch_trace(self._command_db, key, max_commands=max_commands, max_duration_ms=max_duration_ms))
+        if trace is None:
+            logging.info(f'Could not find key {key}.')
+            self.send_error(404)
+            return
+
+        hops = []
+        for hop in trace.hops:
+            d = hop.persisted_command.to_dict(encode_json=True)
+            d['type'] = hop.persisted_command.command.type()
+            d['depth'] = hop.depth
+            d['latency_ms'] = hop.latency_ms
+            hops.append(d)
+        return self.write({
+            'root_key': trace.root_key,
+            'truncated': trace.truncated,
+            'total_latency_ms': trace.total_latency_ms(),
+            'hops': hops,
+        })
 
 
 class TailWebSocketHandler(tornado.websocket.WebSocketHandler):
     """
     Websocket handler for displaying aggregated logs across your services. Once the websocket is open, this will
-    write back log lines, with 1 log line (delimited by a newline) per message. This is only used if there is a
-    FluentDConfiguration configured so DuraPy knows where to find the aggregated logs.
+    write back log lines in batches, with each message holding one or more newline-delimited lines. This is only used
+    if there is a LogAggregatorConfiguration or a FluentDConfiguration configured so DuraPy knows where to find the
+    aggregated logs. With the built-in log aggregator, lines are served straight from its memory; with fluentd, its
+    log files are followed by a single follower shared by all websockets.
+
+    Query parameters:
+        backfill: number of recent lines sent when the websocket is opened. Defaults to 100.
+        process: only send lines of this process. Can be given several times.
+        level: only send lines at or above this level, e.g. WARNING.
+
+    Websockets that fall too far behind, i.e. whose client doesn't read lines as fast as they're logged, are closed
+    rather than buffering lines without bound.
     """
 
-    def __init__(self, *args, fluentd_config: FluentDConfiguration, **kwargs):
+    _DEFAULT_BACKFILL_LINES = 100
+    _MAX_BACKFILL_LINES = 10000
+    _MAX_UNSENT_CHARS = 8 * 1024 * 1024
+
+    def __init__(self, *args, log_source: Optional[LogSource], **kwargs):
         super(TailWebSocketHandler, self).__init__(*args, **kwargs)
-        self._fluentd_config = fluentd_config
-        self._process = None
-        self._closing = False
+        self._log_source = log_source
+        self._filter = LogFilter()
+        # Size of messages written but not yet sent to the client
+        self._num_unsent_chars = 0
 
-    async def open(self):
-        if self._fluentd_config is None:
+    def open(self):
+        if self._log_source is None:
+            return
+
+        process_names = self.get_arguments('process')
+        level = self.get_argument('level', default=None)
+        self._filter = LogFilter(
+            process_names=set(process_names) if len(process_names) > 0 else None,
+            min_level=logging.getLevelName(level.upper()) if level is not None else None)
+        if self._filter.min_level is not None and not isinstance(self._filter.min_level, int):
+            self.close(reason=f'Unknown level {level}.')
+            return
+        backfill = self.get_argument('backfill', default=str(self._DEFAULT_BACKFILL_LINES))
+        try:
+            backfill = max(0, min(int(backfill), self._MAX_BACKFILL_LINES))
+        except ValueError:
+            self.close(reason=f'Invalid backfill {backfill}.')
+            return
+
+        self._write_lines(self._log_source.recent(backfill, self._filter))
+        self._log_source.subscribe(self._on_lines)
+
+    def _on_lines(self, lines: List[LogLine]):
+        self._write_lines([line for line in lines if self._filter.matches(line)])
+
+    def _write_lines(self, lines: List[LogLine]):
+        if len(lines) == 0:
+            return
+        if self._num_unsent_chars > self._MAX_UNSENT_CHARS:
+            # Stop feeding it right away; the webserver's own logs would otherwise keep coming through here
+            self._log_source.unsubscribe(self._on_lines)
+            logging.warning(f'Closing log tail websocket, which fell {self._num_unsent_chars} characters behind.')
+            self.close(reason='Too far behind.')
+            return
+
+        message = '\n'.join(line.text for line in lines)
+        try:
+            sent = self.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        self._num_unsent_chars += len(message)
+        sent.add_done_callback(functools.partial(self._on_sent, len(message)))
+
+    def _on_sent(self, num_chars: int, sent: 'asyncio.Future'):
+        self._num_unsent_chars -= num_chars
+        # Retrieved, so that a websocket closing mid-send isn't reported as an unhandled error
+        sent.exception()
+
+    def on_close(self):
+        if self._log_source is not None:
+            self._log_source.unsubscribe(self._on_lines)
+
+
+class LogSearchHandler(JsonHandler):
+    """
+    GET /api/logs/search: searches the aggregated logs (see LogIndex), newest first. Returns 404 if there are no
+    aggregated logs configured. Otherwise, returns:
+        {
+            'results': [
+                {
+                    'line_id': <position of the line in the index>,
+                    'time': <ISO 8601 time of the line, or null>,
+                    'process_name': <process that logged the line, or null>,
+                    'level': <level of the line, or null>,
+                    'text': <the line, as written to the aggregated logs>,
+                },
+                ...
+            ],
+            'next_cursor': <cursor for the next page, or null if there are no more results>,
+            'num_indexed_lines': <number of lines currently in the index>,
+        }
+
+    Query parameters:
+        q: only lines whose message contains every word of this query, case-insensitively.
+        process: only lines of this process. Can be given several times.
+        level: only lines at or above this level, e.g. WARNING.
+        since, until: only lines logged within this range, as ISO 8601 times.
+        cursor: continues from the `next_cursor` of a previous page.
+        num: page size. Defaults to 100.
+    """
+
+    _DEFAULT_NUM = 100
+    _MAX_NUM = 1000
+
+    def __init__(self, *args, log_index: Optional[LogIndex], blocking: BlockingExecutor, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._log_index = log_index
+        self._blocking = blocking
+
+    async def get(self):
+        if self._log_index is None:
+            self.send_error(404)
             return
 
-        # Not sure how this would happen, but just in case
-        if self._process is not None:
-            self._process.terminate()
-            self._process.wait()
-            self._process = None
+        process_names = self.get_arguments('process')
+        level = self.get_argument('level', default=None)
+        min_level = logging.getLevelName(level.upper()) if level is not None else None
+        if min_level is not None and not isinstance(min_level, int):
+            logging.info(f'Unknown level {level} to search logs for.')
+            self.send_error(400)
+            return
+        try:
+            since = self._time_argument('since')
+            until = self._time_argument('until')
+            cursor = self.get_argument('cursor', default=None)
+            cursor = int(cursor) if cursor is not None else None
+            num = int(self.get_argument('num', default=str(self._DEFAULT_NUM)))
+        except ValueError as e:
+            logging.info(f'Invalid arguments to search logs with: {e}')
+            self.send_error(400)
+            return
+
+        # Searches can scan many lines, and contend with the indexer for the index's lock
+        page = await self._blocking.run(LOGS_POOL, functools.partial(
+            self._log_index.search,
+            query=self.get_argument('q', default=''),
+            process_names=set(process_names) if len(process_names) > 0 else None,
+            min_level=min_level,
+            since=since,
+            until=until,
+            cursor=cursor,
+            limit=max(1, min(num, self._MAX_NUM))))
+        return self.write({
+            'results': [{
+                'line_id': r.line_id,
+                'time': pendulum.from_timestamp(r.time).isoformat() if r.time > 0 else None,
+                'process_name': r.process_name,
+                'level': r.level,
+                'text': r.text,
+            } for r in page.results],
+            'next_cursor': page.next_cursor,
+            'num_indexed_lines': self._log_index.num_lines(),
+        })
+
+    def _time_argument(self, name: str) -> Optional[float]:
+        value = self.get_argument(name, default=None)
+        if value is None:
+            return None
+        parsed = pendulum.parse(value)
+        if not isinstance(parsed, pendulum.DateTime):
+            raise ValueError(f'{name}={value} is not a time.')
+        return parsed.timestamp()
 
-        self._process = await subprocess.create_subprocess_shell(
-            f'{self._fluentd_config.tail_bin} -n 100 -F {self._fluentd_config.log_file_dir}/*log',
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
 
-        tornado.ioloop.IOLoop.current().spawn_callback(self._forward_messages)
+class CommandStreamWebSocketHandler(tornado.websocket.WebSocketHandler):
+    """
+    Websocket handler streaming newly persisted commands, as they're fetched by the webserver's own process runner (see
+    CommandStream). Each message is a JSON object {'commands': [...]} holding one or more commands, oldest first, each
+    in the same form as in the GET /api/commands response.
 
-    async def _forward_messages(self):
+    Query parameters:
+        type: only send commands of this type. Can be given several times.
+        since: key of the last command seen, e.g. when reconnecting. Commands persisted after it are sent first.
+    """
+
+    _MAX_RESUMED_COMMANDS = 1000
+    _RESUME_TIMEOUT_S = 10.0
+
+    def __init__(self, *args, command_stream: CommandStream, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._command_stream = command_stream
+        self._types: Optional[Set[str]] = None
+        # Commands that arrive while resuming, sent once the resumed commands have been
+        self._buffered: Optional[List[StreamedCommand]] = None
+
+    async def open(self):
+        types = self.get_arguments('type')
+        self._types = set(types) if len(types) > 0 else None
+        since = self.get_argument('since', default=None)
+        if since is None:
+            self._command_stream.subscribe(self._on_commands)
+            return
+
+        self._buffered = []
+        self._command_stream.subscribe(self._on_commands)
+        resumed = []
         try:
-            while True:
-                if self._closing:
-                    break
-
-                retcode = self._process.returncode
-                if retcode is not None:
-                    logging.info('Process exited: stdout/stderr:')
-                    stdout, stderr = await self._process.communicate()
-                    logging.info(stdout)
-                    logging.info(stderr)
-                    break
-
-                try:
-                    # Read lines output by our fluentd logging aggregation daemon
-                    line = await asyncio.wait_for(self._process.stdout.readline(), 0.1)
-                    await self.write_message(line)
-                except asyncio.TimeoutError:
-                    pass
+            resumed = await asyncio.wait_for(
+                self._command_stream.since(since, self._MAX_RESUMED_COMMANDS), self._RESUME_TIMEOUT_S)
+        except Exception as e:
+            logging.warning(f'Could not resume streaming commands after {since}; only streaming new commands: {e}')
         finally:
-            self.close()
+            # Never left buffering, however resuming ends
+            buffered, self._buffered = self._buffered, None
+        resumed_keys = {c.key for c in resumed}
+        self._write_commands(resumed + [c for c in buffered if c.key not in resumed_keys])
+
+    def _on_commands(self, commands: List[StreamedCommand]):
+        if self._buffered is not None:
+            self._buffered.extend(commands)
+        else:
+            self._write_commands(commands)
 
-            # And then if it hasn't already exited, kill it
-            if self._process.returncode is None:
-                self._process.terminate()
-                logging.info('Tail process terminating.')
-                return await self._process.wait()  # Wait for the child process to exit
+    def _write_commands(self, commands: List[StreamedCommand]):
+        if self._types is not None:
+            commands = [c for c in commands if c.type in self._types]
+        if len(commands) == 0:
+            return
+        try:
+            self.write_message({'commands': [c.description for c in commands]})
+        except tornado.websocket.WebSocketClosedError:
+            pass
 
     def on_close(self):
-        self._closing = True
+        self._command_stream.unsubscribe(self._on_commands)
+
+
+class ProfilesHandler(JsonHandler):
+    """
+    API handle for profiles written by processes in response to a StartProfilerCommand. Only profiles written on the
+    machine running the webserver (i.e. next to its log file) are available.
+        GET /api/profiles: returns a json response with key 'profiles', newest first, where each element has the
+        structure:
+            {
+                'filename': <filename>,
+                'process_name': <process that wrote the profile>,
+                'mode': <profiler mode>,
+                'size_bytes': <file size>,
+                'modified_at': <ISO 8601 timestamp>,
+            }
+
+        GET /api/profiles/<filename>: downloads a profile.
+    """
+    def __init__(self, *args, profile_dir: str, blocking: BlockingExecutor, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._profile_dir = profile_dir
+        self._blocking = blocking
+
+    async def get(self, filename: Optional[str] = None):
+        profiles = await self._blocking.run(LOGS_POOL, _list_profiles, self._profile_dir)
+        if filename is None:
+            return self.write({
+                'profiles': profiles
+            })
+
+        # Only serve files that are listed, so arbitrary paths can't be requested
+        if filename not in {p['filename'] for p in profiles}:
+            self.send_error(404)
+            return
+        contents = await self._blocking.run(LOGS_POOL, _read_file, os.path.join(self._profile_dir, filename))
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('Content-Disposition', f'attachment; filename="{filename}"')
+        self.write(contents)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _list_profiles(profile_dir: str) -> List[dict]:
+    extensions = {ext: mode for mode, ext in PROFILE_EXTENSIONS.items()}
+    profiles = []
+    for entry in os.scandir(profile_dir):
+        # Written as <process name>.<timestamp>.<extension>
+        split = entry.name.rsplit('.', 2)
+        if not entry.is_file() or len(split) != 3 or split[2] not in extensions:
+            continue
+        stat = entry.stat()
+        profiles.append({
+            'filename': entry.name,
+            'process_name': split[0],
+            'mode': extensions[split[2]].name,
+            'size_bytes': stat.st_size,
+            'modified_at': pendulum.from_timestamp(stat.st_mtime, 'UTC').isoformat(),
+            '_mtime': stat.st_mtime,
+        })
+    profiles.sort(key=lambda p: p['_mtime'], reverse=True)
+    for p in profiles:
+        del p['_mtime']
+    return profiles
+
+
+class _MemoryReports:
+    """
+    Keeps the most recent MemoryReportCommands received by the webserver, per process. Written by the webserver's
+    process runner and read by request handlers, so guarded by a lock.
+    """
+    def __init__(self, max_reports_per_process: int = 50):
+        self._lock = threading.Lock()
+        self._reports: Dict[str, Deque[dict]] = collections.defaultdict(
+            lambda: collections.deque(maxlen=max_reports_per_process))
+
+    def on_report(self, report: MemoryReportCommand, context: Context):
+        d = report.to_dict(encode_json=True)
+        d['received_at'] = pendulum.now('UTC').isoformat()
+        with self._lock:
+            self._reports[report.process_name].appendleft(d)
+
+    def latest(self) -> List[dict]:
+        with self._lock:
+            return [reports[0] for _, reports in sorted(self._reports.items()) if len(reports) > 0]
+
+    def for_process(self, process_name: str) -> List[dict]:
+        with self._lock:
+            return list(self._reports.get(process_name, []))
+
+
+class MemoryReportsHandler(JsonHandler):
+    """
+    API handle for memory diagnostics of processes (see MemoryDiagnosticsCommand). Reports are those received since the
+    webserver started.
+        GET /api/memory: returns a json response with key 'reports', holding the latest MemoryReportCommand fields of
+        each process.
+
+        GET /api/memory/<process name>: returns a json response with key 'reports', holding that process's recent
+        reports, newest first.
+
+        POST /api/memory/<process name>/<action>: sends a MemoryDiagnosticsCommand with the given action ('start',
+        'snapshot' or 'stop') to the process. Optionally takes a json payload of further command fields, e.g.
+        {'top_n': 20}.
+    """
+    def __init__(
+            self,
+            *args,
+            memory_reports: _MemoryReports,
+            command_db: CommandDatabase,
+            blocking: BlockingExecutor,
+            **kwargs):
+        super().__init__(*args, **kwargs)
+        self._memory_reports = memory_reports
+        self._command_db = command_db
+        self._blocking = blocking
+
+    def get(self, process_name: Optional[str] = None):
+        if process_name is None:
+            reports = self._memory_reports.latest()
+        else:
+            reports = self._memory_reports.for_process(process_name)
+        return self.write({
+            'reports': reports
+        })
+
+    async def post(self, process_name: str, action: str):
+        if action not in MemoryAction.__members__:
+            self.send_error(400)
+            return
+        fields = self.json_args or {}
+        try:
+            command = MemoryDiagnosticsCommand.from_dict({
+                **fields,
+                'process_name': process_name,
+                'action': action,
+            })
+        except (TypeError, ValueError, KeyError) as e:
+            logging.info(f'Invalid fields for memory diagnostics: {fields} ({e})')
+            self.send_error(400)
+            return
+        sent = await self._blocking.run(COMMANDS_POOL, self._command_db.send_command, command)
+        return self.write({
+            'command': sent.to_dict(encode_json=True)
+        })
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    GET /metrics: returns the metrics of this webserver's process (including its embedded DuraPy process runner) in the
+    Prometheus text exposition format.
+    """
+    def __init__(self, *args, metrics_sink: InMemoryMetricsSink, **kwargs):
+        super(MetricsHandler, self).__init__(*args, **kwargs)
+        self._metrics_sink = metrics_sink
+
+    def get(self):
+        self.set_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.write(render_prometheus_text(self._metrics_sink))
 
 
 class CompositeStaticFileHandler(tornado.web.StaticFileHandler):
@@ -298,24 +791,28 @@ class DeployGetHandler(JsonHandler):
             ...
         ],
     }
+    Statuses are read through the webserver's ProcessStatusCache, so they may be up to its TTL old.
     """
-    def __init__(self, *args, configuration: Configuration, **kwargs):
+    def __init__(
+            self,
+            *args,
+            configuration: Configuration,
+            process_statuses: Optional[ProcessStatusCache],
+            **kwargs):
         super(DeployGetHandler, self).__init__(*args, **kwargs)
-        if configuration.deploy is not None and configuration.deploy.lifecycle_database_configuration is not None:
-            self._config = configuration.deploy.lifecycle_database_configuration
+        self._process_statuses = process_statuses
+        if configuration.deploy is not None:
             self._target_processes = [t.name for t in configuration.deploy.deploy_targets]
         else:
-            self._config = None
-            self._targets = []
+            self._target_processes = []
 
-    def get(self):
-        if self._config is None:
+    async def get(self):
+        if self._process_statuses is None:
             return self.write({
                 'statuses': []
             })
 
-        with ProcessStatusDatabase(process_name=None, config=self._config) as db:
-            fetched = db.fetch_all()
+        fetched = await self._process_statuses.fetch_all()
 
         statuses = []
         for f in fetched:
@@ -330,21 +827,29 @@ class DeployGetHandler(JsonHandler):
 
 
 class _LifecycleHandler(JsonHandler):
-    def __init__(self, *args, lifecycle_cmd: Callable[[DeployTarget], Any], configuration: Configuration, **kwargs):
+    def __init__(
+            self,
+            *args,
+            lifecycle_cmd: Callable[[DeployTarget], Any],
+            configuration: Configuration,
+            blocking: BlockingExecutor,
+            **kwargs):
         super(_LifecycleHandler, self).__init__(*args, **kwargs)
         self._cmd = lifecycle_cmd
+        self._blocking = blocking
         if configuration.deploy is not None:
             self._targets = configuration.deploy.deploy_targets
         else:
             self._targets = []
 
-    def post(self, target_name: str):
+    async def post(self, target_name: str):
         target = only([t for t in self._targets if t.name == target_name])
         if target is None:
             self.write_error(404)
             return
 
-        success, outs, errs = self._cmd(target)
+        # Runs commands over SSH, which can take a while
+        success, outs, errs = await self._blocking.run(DEPLOY_POOL, self._cmd, target)
         logging.info(f'Success: {success}, outs={outs}, errs={errs}')
         return self.write({
             'success': success,
@@ -354,27 +859,27 @@ class _LifecycleHandler(JsonHandler):
 
 
 class DeployUpdateHandler(_LifecycleHandler):
-    def __init__(self, *args, configuration: Configuration, **kwargs):
+    def __init__(self, *args, configuration: Configuration, blocking: BlockingExecutor, **kwargs):
         super(DeployUpdateHandler, self).__init__(
-            *args, lifecycle_cmd=lifecycle.update, configuration=configuration, **kwargs)
+            *args, lifecycle_cmd=lifecycle.update, configuration=configuration, blocking=blocking, **kwargs)
 
 
 class DeployStartHandler(_LifecycleHandler):
-    def __init__(self, *args, configuration: Configuration, **kwargs):
+    def __init__(self, *args, configuration: Configuration, blocking: BlockingExecutor, **kwargs):
         super(DeployStartHandler, self).__init__(
-            *args, lifecycle_cmd=lifecycle.start, configuration=configuration, **kwargs)
+            *args, lifecycle_cmd=lifecycle.start, configuration=configuration, blocking=blocking, **kwargs)
 
 
 class DeployRestartHandler(_LifecycleHandler):
-    def __init__(self, *args, configuration: Configuration, **kwargs):
+    def __init__(self, *args, configuration: Configuration, blocking: BlockingExecutor, **kwargs):
         super(DeployRestartHandler, self).__init__(
-            *args, lifecycle_cmd=lifecycle.restart, configuration=configuration, **kwargs)
+            *args, lifecycle_cmd=lifecycle.restart, configuration=configuration, blocking=blocking, **kwargs)
 
 
 class DeployStopHandler(_LifecycleHandler):
-    def __init__(self, *args, configuration: Configuration, **kwargs):
+    def __init__(self, *args, configuration: Configuration, blocking: BlockingExecutor, **kwargs):
         super(DeployStopHandler, self).__init__(
-            *args, lifecycle_cmd=lifecycle.stop, configuration=configuration, **kwargs)
+            *args, lifecycle_cmd=lifecycle.stop, configuration=configuration, blocking=blocking, **kwargs)
 
 
 class _StaticCommandDatabaseFactory(CommandDatabaseFactory):
@@ -394,7 +899,9 @@ class DurapyWebserver:
             webserver_dir: str,
             configuration: Configuration,
             registry: CommandRegistry = None,
-            webserver_port: int = 5001):
+            webserver_port: int = 5001,
+            metrics_sink: Optional[InMemoryMetricsSink] = None,
+            status_cache_ttl_s: float = 1.0):
         """
         @param webserver_dir: the directory containing static/ and templates/ directory, which contain css/js/img files
         and the HTML template files, respectively. This directory will be searched in addition to durapy's static/
@@ -403,6 +910,10 @@ class DurapyWebserver:
         @param registry: a command registry to be registered for this webserver. Useful for making this webserver
         also be able to respond to commands like any other DuraPy service.
         @param webserver_port: port on which to listen for the Tornado HTTP webserver.
+        @param metrics_sink: sink for this webserver's metrics, served at /metrics. Defaults to a new
+        InMemoryMetricsSink.
+        @param status_cache_ttl_s: how long process statuses read from the lifecycle database, if configured, are
+        reused for before being read again.
         """
         self._webserver_dir = webserver_dir
         self._webserver_port = webserver_port
@@ -412,18 +923,63 @@ class DurapyWebserver:
         else:
             self._registry = CommandRegistry()
 
+        # Built-in control commands can be sent and displayed like any other command
+        self._command_classes = with_builtin_command_classes(configuration.command_classes)
         self._command_db = configuration.command_db_factory.create(
             command_prefix=configuration.command_prefix,
-            command_classes=configuration.command_classes)
+            command_classes=self._command_classes)
         self._configuration = dataclasses.replace(
             configuration,
             command_db_factory=_StaticCommandDatabaseFactory(self._command_db))
-        self._command_classes = configuration.command_classes
-        self._fluentd_config = configuration.fluentd
+        self._metrics_sink = metrics_sink if metrics_sink is not None else InMemoryMetricsSink()
+        self._log_aggregator = LogAggregator(configuration.log_aggregator, self._metrics_sink) \
+            if configuration.log_aggregator is not None else None
+
+        # Where tail websockets get their lines from: the built-in aggregator, else fluentd's output if configured
+        self._log_source: Optional[LogSource] = self._log_aggregator
+        if self._log_source is None and configuration.fluentd is not None:
+            self._log_source = LogFollower(configuration.fluentd.log_file_dir)
+
+        # Searchable index of the same logs, as written to disk
+        self._log_index: Optional[LogIndex] = None
+        if configuration.log_aggregator is not None:
+            self._log_index = LogIndex(configuration.log_aggregator.log_dir)
+        elif configuration.fluentd is not None:
+            self._log_index = LogIndex(configuration.fluentd.log_file_dir)
+
+        # Each command class only needs to be inspected once, so do it up front
+        _command_types_response(tuple(self._command_classes))
+        for clazz in self._command_classes:
+            populator_for(clazz)
+
+        # Handlers' blocking calls run off of the IOLoop, within per-pool limits; how well that works shows in the
+        # IOLoop's lag
+        self._blocking = BlockingExecutor(self._metrics_sink)
+        self._ioloop_lag_monitor = IOLoopLagMonitor(self._metrics_sink)
+
+        # Fed by this webserver's process runner, which already tails the command database
+        self._command_stream = CommandStream(self._command_db, describe_persisted_command, self._blocking)
+
+        # A single engine for the webserver's lifetime, rather than one per request
+        self._process_statuses: Optional[ProcessStatusCache] = None
+        if configuration.deploy is not None and configuration.deploy.lifecycle_database_configuration is not None:
+            self._process_statuses = ProcessStatusCache(
+                configuration.deploy.lifecycle_database_configuration, self._blocking, ttl_s=status_cache_ttl_s)
+
+        # Profiles are written next to each process's log file; this finds those of processes on this machine
+        self._profile_dir = os.path.dirname(log_file_for('webserver'))
+
+        # Memory reports are sent as commands, so they're collected by this webserver's process runner
+        self._memory_reports = _MemoryReports()
+        if MemoryReportCommand not in self._registry._get_registered_handlers():
+            self._registry.register_static_method(MemoryReportCommand, self._memory_reports.on_report)
 
     def command_database(self) -> CommandDatabase:
         return self._command_db
 
+    def metrics_sink(self) -> InMemoryMetricsSink:
+        return self._metrics_sink
+
     def new_application(self) -> tornado.web.Application:
         """
         Creates a new Tornado application, suitable for extending according to the use case.
@@ -438,19 +994,64 @@ class DurapyWebserver:
                 (r"/api/commands", CommandCrudHandler, dict(
                     command_db=self._command_db,
                     command_classes=self._command_classes,
+                    blocking=self._blocking,
                 )),
                 (r"/api/commands/([^/]+)", CommandGetHandler, dict(
                     command_db=self._command_db,
+                    blocking=self._blocking,
+                )),
+                (r"/api/scheduled-commands", ScheduledCommandsHandler, dict(
+                    command_db=self._command_db,
+                    blocking=self._blocking,
+                )),
+                (r"/api/scheduled-commands/([^/]+)", ScheduledCommandsHandler, dict(
+                    command_db=self._command_db,
+                    blocking=self._blocking,
+                )),
+                (r"/api/traces/([^/]+)", TraceHandler, dict(
+                    command_db=self._command_db,
+                    blocking=self._blocking,
                 )),
                 (r"/api/command-types", CommandTypesHandler, dict(
                     command_classes=self._command_classes,
                 )),
-                (r"/api/deploy", DeployGetHandler, dict(configuration=self._configuration)),
-                (r"/api/deploy/([A-Za-z_-]*)/update", DeployUpdateHandler, dict(configuration=self._configuration)),
-                (r"/api/deploy/([A-Za-z_-]*)/start", DeployStartHandler, dict(configuration=self._configuration)),
-                (r"/api/deploy/([A-Za-z_-]*)/restart", DeployRestartHandler, dict(configuration=self._configuration)),
-                (r"/api/deploy/([A-Za-z_-]*)/stop", DeployStopHandler, dict(configuration=self._configuration)),
-                (r"/ws/tail", TailWebSocketHandler, dict(fluentd_config=self._fluentd_config)),
+                (r"/api/deploy", DeployGetHandler, dict(
+                    configuration=self._configuration, process_statuses=self._process_statuses)),
+                (r"/api/deploy/([A-Za-z_-]*)/update", DeployUpdateHandler, dict(
+                    configuration=self._configuration, blocking=self._blocking)),
+                (r"/api/deploy/([A-Za-z_-]*)/start", DeployStartHandler, dict(
+                    configuration=self._configuration, blocking=self._blocking)),
+                (r"/api/deploy/([A-Za-z_-]*)/restart", DeployRestartHandler, dict(
+                    configuration=self._configuration, blocking=self._blocking)),
+                (r"/api/deploy/([A-Za-z_-]*)/stop", DeployStopHandler, dict(
+                    configuration=self._configuration, blocking=self._blocking)),
+                (r"/ws/tail", TailWebSocketHandler, dict(log_source=self._log_source)),
+                (r"/ws/commands", CommandStreamWebSocketHandler, dict(command_stream=self._command_stream)),
+                (r"/api/logs/search", LogSearchHandler, dict(log_index=self._log_index, blocking=self._blocking)),
+                (r"/api/profiles", ProfilesHandler, dict(
+                    profile_dir=self._profile_dir,
+                    blocking=self._blocking,
+                )),
+                (r"/api/profiles/([^/]+)", ProfilesHandler, dict(
+                    profile_dir=self._profile_dir,
+                    blocking=self._blocking,
+                )),
+                (r"/api/memory", MemoryReportsHandler, dict(
+                    memory_reports=self._memory_reports,
+                    command_db=self._command_db,
+                    blocking=self._blocking,
+                )),
+                (r"/api/memory/([^/]+)", MemoryReportsHandler, dict(
+                    memory_reports=self._memory_reports,
+                    command_db=self._command_db,
+                    blocking=self._blocking,
+                )),
+                (r"/api/memory/([^/]+)/([a-z]+)", MemoryReportsHandler, dict(
+                    memory_reports=self._memory_reports,
+                    command_db=self._command_db,
+                    blocking=self._blocking,
+                )),
+                (r"/metrics", MetricsHandler, dict(metrics_sink=self._metrics_sink)),
             ],
             template_path=os.path.join(self._webserver_dir, 'templates'),
 
@@ -475,16 +1076,33 @@ class DurapyWebserver:
             configuration=self._configuration,
             process_name='webserver',
             command_registry=self._registry,
-            override_signal_handlers=False)
+            override_signal_handlers=False,
+            metrics_sink=self._metrics_sink,
+            on_fetched=self._command_stream.publish)
 
         http_server = app.listen(self._webserver_port)
+        if self._log_aggregator is not None:
+            self._log_aggregator.listen()
+        if self._log_index is not None:
+            self._log_index.start()
+        self._ioloop_lag_monitor.start()
 
         orig_sigint = signal.getsignal(signal.SIGINT)
         orig_sigterm = signal.getsignal(signal.SIGTERM)
 
         def handler(orig, signum=None, frame=None):
             http_server.stop()
+            if self._log_aggregator is not None:
+                self._log_aggregator.stop()
+            if self._log_index is not None:
+                self._log_index.stop()
+            if isinstance(self._log_source, LogFollower):
+                self._log_source.stop()
             runner.stop()
+            self._ioloop_lag_monitor.stop()
+            if self._process_statuses is not None:
+                self._process_statuses.close()
+            self._blocking.shutdown()
             loop = tornado.ioloop.IOLoop.current()
             if loop is not None:
                 loop.stop()
@@ -0,0 +1,7 @@
+import * as durapy from "./durapy.js";
+
+$(document).ready(function() {
+    // Shows the causal chain of the command given by e.g. /commands/trace?key=<command key>
+    let key = new URLSearchParams(window.location.search).get('key');
+    durapy.initialize_trace('trace-container', key);
+});
@@ -0,0 +1,7 @@
+import * as durapy from "./durapy.js";
+
+$(document).ready(function() {
+    // Shows all processes, or a single process's page if given e.g. /memory?process=<process name>
+    let process_name = new URLSearchParams(window.location.search).get('process');
+    durapy.initialize_memory_reports('memory-container', process_name);
+});
@@ -0,0 +1,5 @@
+import * as durapy from "./durapy.js";
+
+$(document).ready(function() {
+    durapy.initialize_profiles('profiles-container');
+});
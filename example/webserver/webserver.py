@@ -20,6 +20,11 @@ class CommandsSendHandler(tornado.web.RequestHandler):
         self.render('commands_send.html', title='Send Commands')
 
 
+class CommandsTraceHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.render('commands_trace.html', title='Command Trace')
+
+
 class LoggingHandler(tornado.web.RequestHandler):
     def get(self):
         self.render('logging.html', title='Logging')
@@ -29,6 +34,16 @@ class StatusesHandler(tornado.web.RequestHandler):
         self.render('statuses.html', title='Statuses')
 
 
+class ProfilesHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.render('profiles.html', title='Profiles')
+
+
+class MemoryHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.render('memory.html', title='Memory')
+
+
 def main_webserver():
     webserver_dir = os.path.dirname(os.path.realpath(__file__))
     ws = DurapyWebserver(
@@ -47,8 +62,11 @@ def main_webserver():
             (r"/", CommandsHistoryHandler),
             (r"/commands/history", CommandsHistoryHandler),
             (r"/commands/send", CommandsSendHandler),
+            (r"/commands/trace", CommandsTraceHandler),
             (r"/logging", LoggingHandler),
             (r"/statuses", StatusesHandler),
+            (r"/profiles", ProfilesHandler),
+            (r"/memory", MemoryHandler),
             (r'/(favicon.ico)', tornado.web.StaticFileHandler, {"path": os.path.join(webserver_dir, 'static')}),
         ]
     )
@@ -1,7 +1,7 @@
 import dataclasses
 
 from durapy.backends.redis import RedisCommandDatabaseFactory
-from durapy.command.model import BaseCommand
+from durapy.command.model import BaseCommand, CommandPriority
 from durapy.config import Configuration, FluentDConfiguration, DeployConfiguration
 from durapy.deploy.status.config import LifecycleDatabaseConfiguration
 
@@ -40,6 +40,10 @@ class EndSessionCommand(BaseCommand):
     def type() -> str:
         return 'END_SESSION'
 
+    @staticmethod
+    def priority() -> CommandPriority:
+        return CommandPriority.HIGH
+
 
 ALL_COMMAND_CLASSES = [
     InitiateSessionCommand,
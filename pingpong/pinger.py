@@ -1,5 +1,5 @@
 import logging
-import queue
+import threading
 import time
 import uuid
 
@@ -9,41 +9,40 @@ from durapy.command.threading import LoggingThread
 from durapy.command.runner import ProcessRunner
 from durapy.command.model import BaseController, Context
 
+_PING_PERIOD_S = 3.0
+
 
 class Pinger(BaseController):
     def __init__(self, initiate: InitiateSessionCommand, context: Context):
         self._prefix = initiate.prefix
-        self._is_running = True
-        self._pending_pings = queue.Queue()
+        self._stopped = threading.Event()
 
         self._pinger_thread = LoggingThread(target=self._ping_forever, args=(context,))
         self._pinger_thread.start()
 
     def _ping_forever(self, context: Context):
-        while self._is_running:
+        # Pings are due at start + n * period, so time spent waiting for a pong doesn't push back later pings
+        start_s = time.monotonic()
+        num_periods = 0
+        while not self._stopped.is_set():
             ping_key = f'{self._prefix}-{str(uuid.uuid4())}'
             logging.info(f'Sending ping: {ping_key}.')
-            self._pending_pings.put_nowait(ping_key)
-            context.send_command(PingCommand(
-                key=ping_key,
-            ))
-            time.sleep(3)
-
-    def handle_pong(self, pong: PongCommand, context: Context):
-        try:
-            pending_ping = self._pending_pings.get_nowait()
-        except queue.Empty:
-            logging.warning(f'Received unsolicited pong? key={pong.input_key}.')
-            return
+            try:
+                pong = context.send_and_wait(PingCommand(key=ping_key), PongCommand, timeout_s=_PING_PERIOD_S)
+            except TimeoutError:
+                logging.warning(f'No pong received for ping {ping_key}.')
+            else:
+                if pong.command.input_key == ping_key:
+                    logging.info(f'PING/PONG matched on key={ping_key}. Output key={pong.command.output_key}.')
 
-        if pending_ping == pong.input_key:
-            logging.info(f'PING/PONG matched on key={pong.input_key}. Output key={pong.output_key}.')
+            num_periods = max(num_periods + 1, int((time.monotonic() - start_s) // _PING_PERIOD_S))
+            self._stopped.wait(max(0.0, start_s + num_periods * _PING_PERIOD_S - time.monotonic()))
 
     def handle_end_session(self, command: EndSessionCommand, context: Context):
         self.stop(context)
 
     def stop(self, context: Context):
-        self._is_running = False
+        self._stopped.set()
         self._pinger_thread.join()
 
 
@@ -53,9 +52,6 @@ if __name__ == '__main__':
         .register_controller_creator(
             command_class=InitiateSessionCommand,
             controller_creator=Pinger)
-        .register_controller_method(
-            command_class=PongCommand,
-            controller_method=Pinger.handle_pong)
         .register_controller_deleter(
             command_class=EndSessionCommand,
             controller_method=Pinger.handle_end_session)